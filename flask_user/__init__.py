@@ -15,6 +15,9 @@ class ConfigError(Exception):
 class EmailError(Exception):
     pass
 
+class DuplicateValueError(Exception):
+    pass
+
 
 # Export Flask-Login's current user
 from flask_login import current_user    # pass through Flask-Login's current_user
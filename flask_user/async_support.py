@@ -0,0 +1,221 @@
+""" This module implements asyncio support for Flask-User, for ASGI deployments
+and async Flask views: async variants of UserMixin.get_user_by_token()
+and of the @login_required, @roles_accepted and @roles_required decorators.
+
+Database I/O goes through the AsyncDbAdapter assigned to ``user_manager.async_db_adapter``::
+
+    class CustomUserManager(UserManager):
+        def customize(self, app):
+            self.async_db_adapter = AsyncSQLDbAdapter(app, async_session)
+
+This module requires Python 3.5+ and is not imported by ``flask_user``.
+"""
+
+# Author: Ling Thio <ling.thio@gmail.com>
+# Copyright (c) 2013 Ling Thio
+
+import inspect
+from functools import wraps
+from flask import current_app, g, session
+from flask_login import current_user
+
+from .decorators import _get_auth_claims, _set_auth_claims
+from . import ConfigError
+from .user_mixin import _get_preloaded_user, _set_preloaded_user, compile_role_requirements, \
+    match_role_requirements, match_session_version, verify_user_token
+
+
+async def get_user_by_token_async(token, expiration_in_seconds=None):
+    """ Async variant of ``UserMixin.get_user_by_token()``.
+
+    | Returns the User of a valid user token.
+    | Returns None otherwise.
+    """
+    user_manager = current_app.user_manager
+    async_db_adapter = _get_async_db_adapter(user_manager)
+
+    # Verifying a token is CPU-bound: only the user lookup awaits I/O
+    data_items = verify_user_token(token, expiration_in_seconds)
+    if not data_items:
+        return None
+
+    # Load user by User ID
+    user_id = data_items[0]
+    session_version = data_items[1]
+    user = await async_db_adapter.get_object(user_manager.db_manager.UserClass, user_id)
+
+    # Verify session_version or password_ends_with
+    return user if user and match_session_version(user, session_version) else None
+
+
+async def load_current_user_async():
+    """ Load the user of the Flask-Login user session with the AsyncDbAdapter,
+    and make it available as ``current_user``.
+
+    Sessions without a user token (for example: remember-me cookies)
+    are handled by the regular Flask-Login user loader.
+
+    The user is handed to Flask-User's Flask-Login user loader through ``flask.g``,
+    so that ``current_user`` loads it without synchronous I/O.
+    """
+    # Flask-Login 0.5+ uses '_user_id', older versions use 'user_id'
+    user_token = session.get('_user_id') or session.get('user_id')
+    if user_token and _get_preloaded_user(user_token) is None:
+        _set_preloaded_user(user_token, await get_user_by_token_async(user_token))
+    return current_user._get_current_object()
+
+
+async def user_has_confirmed_email_async(user):
+    """| Async variant of ``DBManager.user_has_confirmed_email()``.
+    | Returns True if user has a confirmed email.
+    | Return False otherwise."""
+    user_manager = current_app.user_manager
+    if not user_manager.USER_ENABLE_EMAIL: return True
+    if not user_manager.USER_ENABLE_CONFIRM_EMAIL: return True
+
+    # Handle multiple emails per user: Probe for at least one confirmed email
+    UserEmailClass = user_manager.db_manager.UserEmailClass
+    if UserEmailClass:
+        return await _get_async_db_adapter(user_manager).exists_object(
+            UserEmailClass, user_id=user.id, email_confirmed_at__ne=None)
+
+    # Handle single email per user
+    return True if user.email_confirmed_at else False
+
+
+async def get_user_role_set_async(user):
+    """ Async variant of ``DBManager.get_user_role_set()``.
+
+    Loads the user's roles with the AsyncDbAdapter, if needed, and returns a frozenset of role names.
+    """
+    user_manager = current_app.user_manager
+    if not hasattr(user, 'roles'):
+        return frozenset()
+    await _get_async_db_adapter(user_manager).load_related(user, 'roles')
+
+    # user.roles is a list of Role objects (SQL) or a list of role names (others)
+    return frozenset(getattr(role, 'name', role) for role in user.roles)
+
+
+def login_required_async(view_function):
+    """ Async variant of the @login_required decorator.
+
+    Example::
+
+        @route('/member_page')
+        @login_required_async
+        async def member_page():  # User must be logged in
+            ...
+
+    | Calls unauthorized_view() when the user is not logged in
+        or when the user has not confirmed their email address.
+    | Calls the decorated view otherwise.
+    """
+    @wraps(view_function)    # Tells debuggers that is is a function wrapper
+    async def decorator(*args, **kwargs):
+        user_manager = current_app.user_manager
+
+        # User must be logged in with a confirmed email address
+        allowed = await _is_logged_in_with_confirmed_email_async(user_manager)
+        if not allowed:
+            # Redirect to unauthenticated page
+            return user_manager.unauthenticated_view()
+
+        # It's OK to call the view
+        return await _call_view(view_function, args, kwargs)
+
+    return decorator
+
+
+def roles_accepted_async(*role_names):
+    """| Async variant of the @roles_accepted decorator.
+    | The current user must be logged in,
+        and have *at least one* of the specified roles (OR operation).
+    """
+    # roles_accepted(a, b) accepts A OR B: compile (role_names,)
+    return _roles_decorator(compile_role_requirements(role_names))
+
+
+def roles_required_async(*role_names):
+    """| Async variant of the @roles_required decorator.
+    | The current user must be logged in,
+        and have *all* of the specified roles (AND operation).
+    """
+    return _roles_decorator(compile_role_requirements(*role_names))
+
+
+def _roles_decorator(compiled_requirements):
+    def wrapper(view_function):
+
+        @wraps(view_function)    # Tells debuggers that is is a function wrapper
+        async def decorator(*args, **kwargs):
+            user_manager = current_app.user_manager
+
+            # User must be logged in with a confirmed email address
+            allowed = await _is_logged_in_with_confirmed_email_async(user_manager)
+            if not allowed:
+                # Redirect to unauthenticated page
+                return user_manager.unauthenticated_view()
+
+            # User must have the required roles
+            auth_claims = _get_auth_claims(user_manager)
+            role_names = auth_claims[1] if auth_claims else None
+            if role_names is None:
+                role_names = await get_user_role_set_async(current_user._get_current_object())
+                if auth_claims:
+                    _set_auth_claims(user_manager, auth_claims[0], role_names)
+            if not match_role_requirements(role_names, compiled_requirements):
+                # Redirect to the unauthorized page
+                return user_manager.unauthorized_view()
+
+            # It's OK to call the view
+            return await _call_view(view_function, args, kwargs)
+
+        return decorator
+
+    return wrapper
+
+
+async def _is_logged_in_with_confirmed_email_async(user_manager):
+    # Async variant of decorators._is_logged_in_with_confirmed_email()
+    unconfirmed_email_allowed = \
+        getattr(g, '_flask_user_allow_unconfirmed_email', False)
+
+    # User must be logged in. The user is loaded even with auth claims.
+    user = await load_current_user_async()
+    if not user_manager.call_or_get(user.is_authenticated):
+        return False
+
+    # Views that allow unconfirmed email addresses do not probe for a confirmed email
+    if unconfirmed_email_allowed:
+        return True
+
+    # Use signed auth claims, if available, to avoid probing the database for a confirmed email
+    auth_claims = _get_auth_claims(user_manager)
+    if auth_claims:
+        has_confirmed_email = auth_claims[0]
+    else:
+        has_confirmed_email = await user_has_confirmed_email_async(user)
+
+        # Issue signed auth claims for subsequent requests
+        if user_manager.USER_ENABLE_AUTH_CLAIMS:
+            _set_auth_claims(user_manager, has_confirmed_email)
+
+    return has_confirmed_email
+
+
+async def _call_view(view_function, args, kwargs):
+    # Decorated views may be sync or async
+    response = view_function(*args, **kwargs)
+    if inspect.isawaitable(response):
+        response = await response
+    return response
+
+
+def _get_async_db_adapter(user_manager):
+    async_db_adapter = getattr(user_manager, 'async_db_adapter', None)
+    if async_db_adapter is None:
+        raise ConfigError('Async Flask-User functions require an AsyncDbAdapter. '
+                          'Assign one to user_manager.async_db_adapter in UserManager.customize().')
+    return async_db_adapter
+
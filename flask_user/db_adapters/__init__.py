@@ -3,3 +3,4 @@ from .sql_db_adapter import SQLDbAdapter
 from .mongo_db_adapter import MongoDbAdapter
 from .dynamo_db_adapter import DynamoDbAdapter
 from .pynamo_db_adapter import PynamoDbAdapter
+from .sharded_db_adapter import ShardedDbAdapter, SQLShardLookupIndex
@@ -0,0 +1,85 @@
+"""This module defines the AsyncDbAdapter interface, for ASGI deployments with async database drivers.
+
+Async DbAdapters require Python 3.5+. Unlike the synchronous DbAdapters,
+they are not imported by ``flask_user.db_adapters``: import them from their own modules.
+"""
+
+# Author: Ling Thio <ling.thio@gmail.com>
+# Copyright (c) 2013 Ling Thio
+
+from __future__ import print_function
+
+from flask_user.db_adapters import DbAdapterInterface
+
+
+class AsyncDbAdapterInterface(object):
+    """ Define the AsyncDbAdapter interface to find, add and commit
+    database objects without blocking the event loop.
+
+    The methods mirror their synchronous DbAdapterInterface counterparts, as coroutines.
+    """
+
+    def __init__(self, app, db):
+        """
+        Args:
+            app(Flask): The Flask appliation instance.
+            db: The async object-database mapper instance.
+        """
+        self.app = app
+        self.db = db
+        self.user_manager = app.user_manager
+
+    async def add_object(self, object):
+        """ Add a new object to the database."""
+        raise NotImplementedError
+
+    async def commit(self):
+        """ Save modified objects in the database session to the database.
+
+        | Session-based ODMs would call something like ``await session.commit()``.
+        | Object-based ODMs would do nothing.
+        """
+        raise NotImplementedError
+
+    async def get_object(self, ObjectClass, id):
+        """ Retrieve object of type ``ObjectClass`` by ``id``.
+
+        | Returns object on success.
+        | Returns None otherwise.
+        """
+        raise NotImplementedError
+
+    async def find_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case sensitive.
+        """
+        raise NotImplementedError
+
+    async def ifind_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case insensitive.
+
+        | If USER_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
+        | If USER_IFIND_MODE is 'normalized' this method queries the normalized shadow fields.
+        """
+        raise NotImplementedError
+
+    async def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` -- case sensitive. Return False otherwise.
+
+        Field names that end in ``__ne`` match objects whose field is NOT equal to the value.
+        """
+        raise NotImplementedError
+
+    async def load_related(self, object, related_name):
+        """ Make sure that the relationship ``related_name`` of ``object`` is loaded,
+        so that it can be accessed without further I/O.
+
+        This default implementation does nothing, for ODMs that store related values in the object.
+        """
+        pass
+
+    # Shared with the synchronous DbAdapters
+    normalize_value = staticmethod(DbAdapterInterface.normalize_value)
+    normalize_kwargs = DbAdapterInterface.normalize_kwargs
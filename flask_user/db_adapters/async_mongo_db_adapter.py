@@ -0,0 +1,131 @@
+"""This module implements the AsyncDbAdapter interface for Motor.
+"""
+
+# Author: Ling Thio <ling.thio@gmail.com>
+# Copyright (c) 2013 Ling Thio
+
+from __future__ import print_function
+
+import re
+
+# Non-system imports are moved into the methods to make them an optional requirement
+
+from flask_user.db_adapters.async_db_adapter_interface import AsyncDbAdapterInterface
+
+
+class AsyncMongoDbAdapter(AsyncDbAdapterInterface):
+    """ Implements the AsyncDbAdapter interface to find, add and commit
+    database objects using Motor's ``AsyncIOMotorDatabase``.
+
+    Motor returns plain documents. They are converted to ``ObjectClass`` instances with
+    ``ObjectClass._from_son()`` for MongoEngine Documents, and with ``ObjectClass(**document)`` otherwise.
+    The collection name is taken from MongoEngine's ``_get_collection_name()``, from a
+    ``__collection__`` class attribute, or from the lowercase class name, in that order.
+    """
+
+    def __init__(self, app, db):
+        """Args:
+            app(Flask): The Flask appliation instance.
+            db(AsyncIOMotorDatabase): The Motor database.
+
+        | Example:
+        |     db = AsyncIOMotorClient('mongodb://localhost:27017')['my_database']
+        |     user_manager.async_db_adapter = AsyncMongoDbAdapter(app, db)
+        """
+        # This no-op method is defined to show it in Sphinx docs in order 'bysource'
+        super(AsyncMongoDbAdapter, self).__init__(app, db)
+
+    async def add_object(self, object):
+        """ Insert a new object into its collection, and set its ``id``."""
+        if hasattr(object, 'to_mongo'):
+            document = object.to_mongo().to_dict()
+        else:
+            document = dict((name, value) for name, value in vars(object).items() if not name.startswith('_'))
+            id = document.pop('id', None)
+            if id is not None:
+                document['_id'] = id
+        result = await self._get_collection(type(object)).insert_one(document)
+        object.id = result.inserted_id
+
+    async def commit(self):
+        """ Does nothing: Motor writes each object when it is added."""
+        pass
+
+    async def get_object(self, ObjectClass, id):
+        """ Retrieve object of type ``ObjectClass`` by ``id``.
+
+        | Returns object on success.
+        | Returns None otherwise.
+        """
+        return await self.find_first_object(ObjectClass, id=id)
+
+    async def find_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case sensitive.
+        """
+        document = await self._get_collection(ObjectClass).find_one(self._get_filter(kwargs))
+        return self._to_object(ObjectClass, document)
+
+    async def ifind_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case insensitive.
+
+        ``ifind_first_object(User, email='myname@example.com')`` translates to
+        ``find_one({'email': {'$regex': '^myname@example\\.com$', '$options': 'i'}})``.
+        """
+        # Call regular find() if USER_IFIND_MODE is nocase_collation
+        ifind_mode = self.user_manager.USER_IFIND_MODE
+        if ifind_mode=='nocase_collation':
+            return await self.find_first_object(ObjectClass, **kwargs)
+
+        # Query normalized shadow fields if USER_IFIND_MODE is normalized
+        if ifind_mode=='normalized':
+            return await self.find_first_object(ObjectClass, **self.normalize_kwargs(ObjectClass, kwargs))
+
+        filter = dict((field_name, {'$regex': '^' + re.escape(field_value) + '$', '$options': 'i'})
+                      for field_name, field_value in kwargs.items())
+        document = await self._get_collection(ObjectClass).find_one(filter)
+        return self._to_object(ObjectClass, document)
+
+    async def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` -- case sensitive. Return False otherwise.
+
+        Only the ``_id`` of the first matching document is retrieved.
+        """
+        document = await self._get_collection(ObjectClass).find_one(self._get_filter(kwargs), projection={'_id': 1})
+        return document is not None
+
+    def _get_collection(self, ObjectClass):
+        if hasattr(ObjectClass, '_get_collection_name'):
+            collection_name = ObjectClass._get_collection_name()
+        else:
+            collection_name = getattr(ObjectClass, '__collection__', ObjectClass.__name__.lower())
+        return self.db[collection_name]
+
+    def _get_filter(self, kwargs):
+        # Convert 'kwargs' into a MongoDB filter document.
+        # 'id' maps to '_id' and field names that end in '__ne' are negated.
+        from bson import ObjectId
+
+        filter = {}
+        for field_name, field_value in kwargs.items():
+            negate = field_name.endswith('__ne')
+            if negate:
+                field_name = field_name[:-4]
+            if field_name=='id':
+                field_name = '_id'
+                # IDs decrypted from tokens are strings
+                if isinstance(field_value, str) and ObjectId.is_valid(field_value):
+                    field_value = ObjectId(field_value)
+            filter[field_name] = {'$ne': field_value} if negate else field_value
+        return filter
+
+    def _to_object(self, ObjectClass, document):
+        if document is None:
+            return None
+        if hasattr(ObjectClass, '_from_son'):
+            return ObjectClass._from_son(document)
+        document = dict(document)
+        document['id'] = document.pop('_id', None)
+        return ObjectClass(**document)
@@ -0,0 +1,126 @@
+"""This module implements the AsyncDbAdapter interface for SQLAlchemy's asyncio extension.
+"""
+
+# Author: Ling Thio <ling.thio@gmail.com>
+# Copyright (c) 2013 Ling Thio
+
+from __future__ import print_function
+
+# Non-system imports are moved into the methods to make them an optional requirement
+
+from flask_user.db_adapters.async_db_adapter_interface import AsyncDbAdapterInterface
+
+
+class AsyncSQLDbAdapter(AsyncDbAdapterInterface):
+    """ Implements the AsyncDbAdapter interface to find, add and commit
+    database objects using SQLAlchemy 1.4+ ``AsyncSession``.
+    """
+
+    def __init__(self, app, db):
+        """Args:
+            app(Flask): The Flask appliation instance.
+            db(AsyncSession): An ``AsyncSession``, or an ``async_scoped_session``
+                that provides one session per request.
+
+        | Example:
+        |     engine = create_async_engine('postgresql+asyncpg://...')
+        |     db = async_scoped_session(async_sessionmaker(engine), scopefunc=asyncio.current_task)
+        |     user_manager.async_db_adapter = AsyncSQLDbAdapter(app, db)
+        """
+        # This no-op method is defined to show it in Sphinx docs in order 'bysource'
+        super(AsyncSQLDbAdapter, self).__init__(app, db)
+
+    async def add_object(self, object):
+        """ Add a new object to the database session.
+
+        The object is INSERTed when the session is flushed or committed.
+        """
+        self.db.add(object)
+
+    async def commit(self):
+        """Commit the database session."""
+        await self.db.commit()
+
+    async def get_object(self, ObjectClass, id):
+        """ Retrieve object of type ``ObjectClass`` by ``id``.
+
+        | Returns object on success.
+        | Returns None otherwise.
+        """
+        return await self.db.get(ObjectClass, id)
+
+    async def find_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case sensitive.
+        """
+        from sqlalchemy import select
+
+        statement = select(ObjectClass).where(*self._get_filters(ObjectClass, kwargs)).limit(1)
+        result = await self.db.execute(statement)
+        return result.scalars().first()
+
+    async def ifind_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case insensitive.
+
+        ``ifind_first_object(User, email='myname@example.com')`` translates to
+        ``SELECT * FROM users WHERE email ILIKE 'myname@example.com' LIMIT 1``.
+        """
+        from sqlalchemy import select
+
+        # Call regular find() if USER_IFIND_MODE is nocase_collation
+        ifind_mode = self.user_manager.USER_IFIND_MODE
+        if ifind_mode=='nocase_collation':
+            return await self.find_first_object(ObjectClass, **kwargs)
+
+        # Query normalized shadow fields if USER_IFIND_MODE is normalized
+        if ifind_mode=='normalized':
+            return await self.find_first_object(ObjectClass, **self.normalize_kwargs(ObjectClass, kwargs))
+
+        filters = [self._get_field(ObjectClass, field_name).ilike(field_value)  # case INsensitive!!
+                   for field_name, field_value in kwargs.items()]
+        result = await self.db.execute(select(ObjectClass).where(*filters).limit(1))
+        return result.scalars().first()
+
+    async def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` -- case sensitive. Return False otherwise.
+
+        ``exists_object(UserEmail, user_id=1, email_confirmed_at__ne=None)`` translates to
+        ``SELECT EXISTS (SELECT * FROM user_emails WHERE user_id=1 AND email_confirmed_at IS NOT NULL)``.
+        """
+        from sqlalchemy import exists, select
+
+        # Execute an existence probe, which returns no rows
+        statement = select(exists().where(*self._get_filters(ObjectClass, kwargs)))
+        result = await self.db.execute(statement)
+        return bool(result.scalar())
+
+    async def load_related(self, object, related_name):
+        """ Load the relationship ``related_name`` of ``object``.
+
+        AsyncSession does not support lazy loading: accessing an unloaded relationship
+        would raise an error instead of blocking the event loop.
+        """
+        from sqlalchemy import inspect
+
+        if related_name in inspect(object).unloaded:
+            await self.db.refresh(object, attribute_names=[related_name])
+
+    def _get_filters(self, ObjectClass, kwargs):
+        # Convert each name/value pair in 'kwargs' into a case sensitive filter.
+        # Field names that end in '__ne' are negated.
+        filters = []
+        for field_name, field_value in kwargs.items():
+            if field_name.endswith('__ne'):
+                filters.append(self._get_field(ObjectClass, field_name[:-4]) != field_value)
+            else:
+                filters.append(self._get_field(ObjectClass, field_name) == field_value)
+        return filters
+
+    def _get_field(self, ObjectClass, field_name):
+        # Make sure that ObjectClass has a 'field_name' property
+        field = getattr(ObjectClass, field_name, None)
+        if field is None:
+            raise KeyError("AsyncSQLDbAdapter: Class '%s' has no field '%s'." % (ObjectClass, field_name))
+        return field
@@ -6,6 +6,12 @@
 
 from __future__ import print_function
 
+import copy
+import unicodedata
+from collections import OrderedDict
+
+from flask import g, has_app_context
+
 class DbAdapterInterface(object):
     """ Define the DbAdapter interface to manage objects in various databases.
 
@@ -13,6 +19,11 @@ class DbAdapterInterface(object):
     as well as object-based ODMs (``object.save()``).
     """
 
+    #: | True if fields that were not retrieved, because of a ``load_fields=`` projection,
+    #:     are loaded from the database when they are accessed.
+    #: | False if they are left unset. Such partially retrieved objects must not be saved.
+    DEFERS_UNLOADED_FIELDS = False
+
     def __init__(self, app, db):
         """
         Args:
@@ -31,6 +42,29 @@ class DbAdapterInterface(object):
         """
         raise NotImplementedError
 
+    def add_objects(self, ObjectClass, mappings):
+        """ Add new objects of type ``ObjectClass`` in bulk, from a list of dicts of field values.
+
+        | Returns the list of IDs of the new objects, in the order of ``mappings``.
+        | Session-based ODMs save the new objects with the next ``commit()``.
+
+        | This default implementation calls ``add_object()`` for each object.
+        | DbAdapters should override it to add all objects with one bulk write.
+        """
+        objects = [ObjectClass(**mapping) for mapping in mappings]
+        for object in objects:
+            self.add_object(object)
+        return [object.id for object in objects]
+
+    def new_object_id(self, ObjectClass):
+        """ Return a new ID for an object of type ``ObjectClass``, before the object is added.
+
+        | Returns None if the database assigns IDs when objects are added.
+        | Object-based ODMs return an ID, so that the objects of a failed bulk write
+        |     that were written anyway can be found with ``get_object()``.
+        """
+        return None
+
     def commit(self):
         """Save all modified session objects to the database.
 
@@ -39,20 +73,49 @@ class DbAdapterInterface(object):
         """
         raise NotImplementedError
 
+    def rollback(self):
+        """Discard all uncommitted changes to session objects.
+
+        | Session-based ODMs would call something like ``db.session.rollback()``.
+        | Object-based ODMs discard the writes buffered by ``buffer_write()``.
+        """
+        self.pop_buffered_writes()
+
     def delete_object(self, object):
         """ Delete object from database.
         """
         raise NotImplementedError
 
-    def find_objects(self, ObjectClass, **kwargs):
+    def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the specified filters
+        in ``**kwargs`` -- case sensitive. Return False otherwise.
+
+        Field names that end in ``'__ne'`` match objects whose field is NOT equal to the value.
+        For example: ``exists_object(UserEmail, user_id=user.id, email_confirmed_at__ne=None)``.
+
+        | This default implementation filters the objects retrieved by ``find_objects()``.
+        | DbAdapters should override it to probe the database without retrieving objects.
+        """
+        equal_kwargs = dict((k, v) for k, v in kwargs.items() if not k.endswith('__ne'))
+        not_equal_kwargs = dict((k[:-4], v) for k, v in kwargs.items() if k.endswith('__ne'))
+        for object in self.find_objects(ObjectClass, **equal_kwargs):
+            if all(getattr(object, k) != v for k, v in not_equal_kwargs.items()):
+                return True
+        return False
+
+    def find_objects(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve all objects of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
+
+        If ``load_fields`` is specified, only these fields are retrieved (see ``DEFERS_UNLOADED_FIELDS``).
         """
         raise NotImplementedError
 
-    def find_first_object(self, ObjectClass, **kwargs):
+    def find_first_object(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
+
+        If ``load_fields`` is specified, only these fields are retrieved (see ``DEFERS_UNLOADED_FIELDS``).
         """
         raise NotImplementedError
 
@@ -62,17 +125,195 @@ class DbAdapterInterface(object):
 
         | If USER_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
         | If USER_IFIND_MODE is 'ifind' this method performs a case insensitive find.
+        | If USER_IFIND_MODE is 'normalized' this method maps to find_first_object()
+            on the normalized shadow fields. See ``normalize_kwargs()``.
         """
         raise NotImplementedError
 
-    def get_object(self, ObjectClass, id):
+    def find_objects_in_batches(self, ObjectClass, batch_size, since_id=None, related_names=()):
+        """ Retrieve all objects of type ``ObjectClass``, as lists of at most ``batch_size`` objects.
+
+        | If ``since_id`` is specified, only objects with an ID greater than ``since_id`` are retrieved.
+        | Relationships in ``related_names`` may be loaded along with each batch.
+
+        | This default implementation splits the results of ``find_objects()`` into batches.
+        | DbAdapters should override it to retrieve one batch per database query.
+        """
+        batch = []
+        for object in self.find_objects(ObjectClass):
+            if since_id is not None and not object.id > since_id:
+                continue
+            batch.append(object)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def ifind_first_object_by_fields(self, ObjectClass, field_names, field_value):
+        """ Retrieve the first object of type ``ObjectClass``,
+        with one of the fields in ``field_names`` matching ``field_value`` -- case insensitive.
+
+        Fields are matched in the order of ``field_names``: an object matching the first field
+        is preferred over an object matching the second field, and so on.
+
+        | Returns an (object, field_name) tuple on success.
+        | Returns (None, None) otherwise.
+
+        | This default implementation calls ``ifind_first_object()`` for each field in turn.
+        | DbAdapters should override it to match all fields in one database query.
+        """
+        for field_name in field_names:
+            object = self.ifind_first_object(ObjectClass, **{field_name: field_value})
+            if object:
+                return (object, field_name)
+        return (None, None)
+
+    def get_object(self, ObjectClass, id, load_fields=None):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
 
         | Returns object on success.
         | Returns None otherwise.
+
+        If ``load_fields`` is specified, only these fields are retrieved (see ``DEFERS_UNLOADED_FIELDS``).
         """
         raise NotImplementedError
 
+    def get_object_with_related(self, ObjectClass, id, related_name):
+        """ Retrieve object of type ``ObjectClass`` by ``id``,
+        and load the object referenced by its ``related_name`` property along with it.
+
+        | This default implementation calls ``get_object()``, leaving the related object to lazy-load.
+        | DbAdapters should override it to retrieve both objects in one database round-trip.
+        """
+        return self.get_object(ObjectClass, id)
+
+    def ifind_first_object_with_related(self, ObjectClass, related_name, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive,
+        and load the object referenced by its ``related_name`` property along with it.
+
+        | This default implementation calls ``ifind_first_object()``, leaving the related object to lazy-load.
+        | DbAdapters should override it to retrieve both objects in one database round-trip.
+        """
+        return self.ifind_first_object(ObjectClass, **kwargs)
+
+    def ifind_first_object_or_related(self, ObjectClass, field_name, RelatedClass, related_name, related_field_name,
+                                      field_value):
+        """ Retrieve the first object of type ``ObjectClass`` with its ``field_name`` matching ``field_value``,
+        or else the first object of type ``RelatedClass`` with its ``related_field_name`` matching ``field_value``,
+        along with the object of type ``ObjectClass`` referenced by its ``related_name`` property
+        -- case insensitive.
+
+        | Returns an (object, None, field_name) tuple if an object matches.
+        | Returns an (object, related_object, related_field_name) tuple if a related object matches.
+        | Returns (None, None, None) otherwise.
+
+        | This default implementation calls ``ifind_first_object()`` and ``ifind_first_object_with_related()``.
+        | DbAdapters should override it to match both in one database query.
+        """
+        object = self.ifind_first_object(ObjectClass, **{field_name: field_value})
+        if object:
+            return (object, None, field_name)
+        related_object = self.ifind_first_object_with_related(
+            RelatedClass, related_name, **{related_field_name: field_value})
+        if related_object:
+            object = getattr(related_object, related_name)
+            if object:
+                return (object, related_object, related_field_name)
+        return (None, None, None)
+
+    @staticmethod
+    def normalize_value(value):
+        """ Return the lowercase, NFKC-normalized form of ``value``,
+        as stored in normalized shadow fields like ``username_normalized``.
+        """
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')   # Python 2 str
+        return unicodedata.normalize('NFKC', value).lower()
+
+    def select_object_by_fields(self, objects, field_names, field_value):
+        """ Select the (object, field_name) tuple to return from ``ifind_first_object_by_fields()``,
+        from ``objects`` that match any of the fields in ``field_names``.
+        """
+        normalized_value = self.normalize_value(field_value)
+        for field_name in field_names:
+            for object in objects:
+                if self.normalize_value(getattr(object, field_name, None)) == normalized_value:
+                    return (object, field_name)
+
+        # The database matched in a way that normalize_value() does not
+        if objects:
+            return (objects[0], field_names[0])
+        return (None, None)
+
+    def normalize_kwargs(self, ObjectClass, kwargs):
+        """ Convert ``field=value`` filters into ``field_normalized=normalize_value(value)`` filters.
+
+        With USER_IFIND_MODE='normalized', case insensitive finds query these shadow fields
+        with exact equality, so that they can use a regular database index.
+        """
+        return dict((field_name+'_normalized', self.normalize_value(field_value))
+                    for field_name, field_value in kwargs.items())
+
+    def attach_object(self, object):
+        """ Return ``object``, attached to this DbAdapter's database session,
+        so that changes to it are saved by ``commit()``.
+
+        Used for objects retrieved from a read replica.
+        Object-based ODMs have no database session: this default implementation returns ``object``.
+        """
+        return object
+
+    def get_object_values(self, object):
+        """ Return a dict of the persistent field values of ``object``,
+        from which ``type(object)(**values)`` creates a copy of ``object``.
+
+        Used to copy objects from one database to another.
+        This default implementation returns the public attributes of ``object``.
+        """
+        return dict((name, value) for name, value in vars(object).items() if not name.startswith('_'))
+
+    def get_changed_field_names(self, object):
+        """ Return the names of the fields of ``object`` that changed since it was loaded,
+        or all its field names if ``object`` has not been added to the database yet.
+
+        | Returns None if changes are not tracked.
+        | This default implementation returns None.
+        """
+        return None
+
+    def buffer_write(self, operation, object):
+        """ Buffer a write of ``object`` until ``commit()``, if USER_BATCH_OBJECT_WRITES is True.
+
+        Object-based ODMs call this method from ``add_object()``, ``save_object()`` and
+        ``delete_object()``, with ``operation`` 'add', 'save' or 'delete'.
+        Writes are buffered per request, in ``flask.g``. Repeated writes are buffered once.
+
+        | Returns True if the write was buffered.
+        | Returns False if the object must be written immediately.
+        """
+        if not self.user_manager.USER_BATCH_OBJECT_WRITES or not has_app_context():
+            return False
+        # Buffered writes are keyed by operation and object identity: objects may not be hashable
+        buffered_writes = g.get('_flask_user_buffered_writes')
+        if buffered_writes is None:
+            buffered_writes = g._flask_user_buffered_writes = OrderedDict()
+        buffered_writes.setdefault((operation, id(object)), (operation, object))
+        return True
+
+    def pop_buffered_writes(self):
+        """ Return the list of (operation, object) tuples buffered by ``buffer_write()``,
+        in the order in which they were buffered, and empty the buffer.
+        """
+        if not has_app_context():
+            return []
+        buffered_writes = g.get('_flask_user_buffered_writes') or {}
+        g._flask_user_buffered_writes = None
+        return list(buffered_writes.values())
+
     def save_object(self, object):
         """ Save object to database.
 
@@ -81,12 +322,28 @@ class DbAdapterInterface(object):
         """
         raise NotImplementedError
 
+    def snapshot_object(self, object):
+        """ Return a copy of ``object`` that can be kept in a process-wide cache,
+        independently of the current request and database session.
+        """
+        return copy.deepcopy(object)
+
+    def restore_object(self, snapshot):
+        """ Return an object, created from a snapshot made by ``snapshot_object()``,
+        that can be used like an object retrieved with ``get_object()``.
+        """
+        return copy.deepcopy(snapshot)
+
 
     # Database management methods
     # ---------------------------
 
-    def create_all_tables(self):
-        """Create database tables for all known database data-models."""
+    def create_all_tables(self, UserClass=None, UserEmailClass=None):
+        """Create database tables for all known database data-models.
+
+        ``UserClass`` and ``UserEmailClass`` are the data-models of the calling DBManager,
+        for DbAdapters that create indexes for Flask-User's lookups.
+        """
         raise NotImplementedError
 
     def drop_all_tables(self):
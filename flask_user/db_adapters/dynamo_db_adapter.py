@@ -6,6 +6,7 @@
 
 from __future__ import print_function
 import pdb
+from collections import OrderedDict
 
 # Non-system imports are moved into the methods to make them an optional requirement
 
@@ -31,27 +32,79 @@ class DynamoDbAdapter(DbAdapterInterface):
         super(DynamoDbAdapter, self).__init__(app, db)
 
     def add_object(self, object):
-        """Add object to db session. Only for session-centric object-database mappers."""
+        """Add object to db session. Only for session-centric object-database mappers.
+
+        With USER_BATCH_OBJECT_WRITES, the object is saved by ``commit()``.
+        """
         if object.id is None:
             object.get_id()
+        if self.buffer_write('add', object):
+            return
         self.db.engine.save(object)
 
-    def get_object(self, ObjectClass, id):
+    def add_objects(self, ObjectClass, mappings):
+        """ Add new objects of type ``ObjectClass`` in bulk, from a list of dicts of field values,
+        with DynamoDB batch writes.
+
+        Returns the list of IDs of the new objects, in the order of ``mappings``.
+        """
+        objects = [ObjectClass(**mapping) for mapping in mappings]
+        for object in objects:
+            if object.id is None:
+                object.get_id()
+        self.db.engine.save(objects)
+        return [object.id for object in objects]
+
+    def new_object_id(self, ObjectClass):
+        """ Return a new ID for an object of type ``ObjectClass``, from the ``get_id()`` of a new object."""
+        return ObjectClass().get_id()
+
+    def get_object(self, ObjectClass, id, load_fields=None):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
 
         | Returns object on success.
         | Returns None otherwise.
+
+        If ``load_fields`` is specified, only these fields are retrieved, with a ProjectionExpression.
         """
         print('dynamo.get(%s, %s)' % (ObjectClass, str(id)))
-        resp = self.db.engine.get(ObjectClass, [id])
+        resp = self.db.engine.get(ObjectClass, [id], attributes=list(load_fields) if load_fields else None)
         if resp:
             return resp[0]
         else:
             return None
 
-    def find_objects(self, ObjectClass, **kwargs):
+    def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` -- case sensitive. Return False otherwise.
+        """
+
+        query = self.db.engine.query(ObjectClass)
+        for field_name, field_value in kwargs.items():
+
+            # Field names that end in '__ne' are negated
+            negate = field_name.endswith('__ne')
+            if negate:
+                field_name = field_name[:-4]
+
+            # Make sure that ObjectClass has a 'field_name' property
+            field = getattr(ObjectClass, field_name, None)
+            if field is None:
+                raise KeyError("DynamoDBAdapter.exists_object(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
+
+            # Add a case sensitive filter to the query
+            query = query.filter(field != field_value if negate else field == field_value)
+
+        # A scan 'limit' applies before the filter: page through the results and stop at the first match instead.
+        for object in query.gen():
+            return True
+        return False
+
+    def find_objects(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve all objects of type ``ObjectClass``,
         matching the filters specified in ``**kwargs`` -- case sensitive.
+
+        If ``load_fields`` is specified, only these fields are retrieved, with a ProjectionExpression.
         """
 
         print('dynamo.find_objects(%s, %s)' % (ObjectClass, str(kwargs)))
@@ -68,14 +121,16 @@ class DynamoDbAdapter(DbAdapterInterface):
             query = query.filter(field == field_value)
 
         # Execute query
-        return query.all(desc=True)
+        return query.all(desc=True, attributes=list(load_fields) if load_fields else None)
 
-    def find_first_object(self, ObjectClass, **kwargs):
+    def find_first_object(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the filters specified in ``**kwargs`` -- case sensitive.
 
         ``find_first_object(User, username='myname')`` translates to
         ``User.query.filter(User.username=='myname').first()``.
+
+        If ``load_fields`` is specified, only these fields are retrieved, with a ProjectionExpression.
         """
 
         print('dynamo.find_first_object(%s, %s)' % (ObjectClass, str(kwargs)))
@@ -91,7 +146,7 @@ class DynamoDbAdapter(DbAdapterInterface):
             query = query.filter(field == field_value)
 
         # Execute query
-        out = query.first(desc=True)#, attributes=['password'])
+        out = query.first(desc=True, attributes=list(load_fields) if load_fields else None)
         return out
 
     def ifind_first_object(self, ObjectClass, **kwargs):
@@ -105,32 +160,67 @@ class DynamoDbAdapter(DbAdapterInterface):
         if self.user_manager.USER_IFIND_MODE=='nocase_collation':
             return self.find_first_object(ObjectClass, **kwargs)
 
+        # Query normalized shadow fields if USER_IFIND_MODE is normalized
+        if self.user_manager.USER_IFIND_MODE=='normalized':
+            return self.find_first_object(ObjectClass, **self.normalize_kwargs(ObjectClass, kwargs))
+
         raise NotImplementedError
 
     def save_object(self, object, **kwargs):
-        """ Save object. Only for non-session centric Object-Database Mappers."""
+        """ Save object. Only for non-session centric Object-Database Mappers.
+
+        With USER_BATCH_OBJECT_WRITES, the object is synced by ``commit()``.
+        """
+        if self.buffer_write('save', object):
+            return
         self.db.engine.sync(object)
 
     def delete_object(self, object):
-        """ Delete object specified by ``object``. """
+        """ Delete object specified by ``object``.
+
+        With USER_BATCH_OBJECT_WRITES, the object is deleted by ``commit()``.
+        """
+        if self.buffer_write('delete', object):
+            return
         #pdb.set_trace()
         self.db.engine.delete_key(object)#, userid='abc123', id='1')
         print('dynamo.delete_object(%s)' % object)
         #self.db.session.delete(object)
 
     def commit(self):
-        """This method does nothing for DynamoDbAdapter.
+        """Write the adds, saves and deletes buffered with USER_BATCH_OBJECT_WRITES.
+
+        New objects are written with one batch save (BatchWriteItem), and deleted objects
+        with one batch delete. DynamoDB has no batch update: saved objects are synced one by one.
+        An object that is added and saved is written once, by the batch save.
         """
-        # pdb.set_trace()
-        print('dynamo.commit()')
-        #self.db.engine.sync()
-        # self.db.session.commit()
+        buffered_writes = self.pop_buffered_writes()
+        if not buffered_writes:
+            return
+
+        # Objects are keyed by identity: id(object) -> object
+        deleted_objects = OrderedDict((id(object), object) for operation, object in buffered_writes
+                                      if operation == 'delete')
+        added_objects, synced_objects = OrderedDict(), OrderedDict()
+        for operation, object in buffered_writes:
+            if operation == 'add' and id(object) not in deleted_objects:
+                added_objects[id(object)] = object
+        for operation, object in buffered_writes:
+            if operation == 'save' and id(object) not in deleted_objects and id(object) not in added_objects:
+                synced_objects[id(object)] = object
+
+        if added_objects:
+            self.db.engine.save(list(added_objects.values()))
+        if synced_objects:
+            self.db.engine.sync(list(synced_objects.values()))
+        if deleted_objects:
+            self.db.engine.delete(list(deleted_objects.values()))
 
 
     # Database management methods
     # ---------------------------
 
-    def create_all_tables(self):
+    def create_all_tables(self, UserClass=None, UserEmailClass=None):
         """This method does nothing for DynamoDbAdapter."""
         self.db.engine.create_schema()
 
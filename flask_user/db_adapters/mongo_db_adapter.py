@@ -6,6 +6,8 @@
 
 from __future__ import print_function
 
+from collections import OrderedDict
+
 # Non-system imports are moved into the methods to make them an optional requirement
 
 from flask_user.db_adapters import DbAdapterInterface
@@ -16,6 +18,10 @@ class MongoDbAdapter(DbAdapterInterface):
     database objects using Flask-MongoEngine.
     """
 
+    #: Case insensitive collation, used by ifind methods when USER_IFIND_MODE is 'ifind'.
+    #: Strength 2 compares base characters and accents, but not case.
+    CASE_INSENSITIVE_COLLATION = dict(locale='en', strength=2)
+
     def __init__(self, app, db):
         """Args:
             app(Flask): The Flask appliation instance.
@@ -34,81 +40,299 @@ class MongoDbAdapter(DbAdapterInterface):
 
         | Session-based ODMs would call something like ``db.session.add(object)``.
         | Object-based ODMs would call something like ``object.save()``.
+
+        With USER_BATCH_OBJECT_WRITES, the object is assigned an ID and inserted by ``commit()``.
         """
+        if self.buffer_write('add', object):
+            # Assign the ID now, so that other objects can reference this object before commit()
+            if object.pk is None:
+                object.pk = self.new_object_id(type(object))
+            return
         object.save()
 
-    def get_object(self, ObjectClass, id):
+    def add_objects(self, ObjectClass, mappings):
+        """ Add new objects of type ``ObjectClass`` in bulk, from a list of dicts of field values,
+        with one ``insert_many`` operation.
+
+        Returns the list of IDs of the new objects, in the order of ``mappings``.
+        """
+        objects = [ObjectClass(**mapping) for mapping in mappings]
+        ObjectClass.objects.insert(objects)
+        return [object.id for object in objects]
+
+    def new_object_id(self, ObjectClass):
+        """ Return a new ObjectId for an object of type ``ObjectClass``,
+        or None if its primary key is not an ObjectId field.
+        """
+        from bson import ObjectId
+        from mongoengine import ObjectIdField
+
+        if not isinstance(ObjectClass._fields.get(ObjectClass._meta.get('id_field')), ObjectIdField):
+            return None
+        return ObjectId()
+
+    def get_object(self, ObjectClass, id, load_fields=None):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
 
         | Returns object on success.
         | Returns None otherwise.
+
+        If ``load_fields`` is specified, only these fields are retrieved, with ``only()``.
         """
         try:
-            object = ObjectClass.objects.get(id=id)
+            object = self._get_queryset(ObjectClass, load_fields).get(id=id)
         except (ObjectClass.DoesNotExist, ObjectClass.MultipleObjectsReturned):
             object = None
         return object
 
-    def find_objects(self, ObjectClass, **kwargs):
+    def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` -- case sensitive. Return False otherwise.
+        """
+
+        # Retrieve only the id of the first object. MongoEngine supports '__ne' natively.
+        return ObjectClass.objects(**kwargs).only('id').first() is not None
+
+    def find_objects(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve all objects of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
+
+        If ``load_fields`` is specified, only these fields are retrieved, with ``only()``.
+        """
+        return self._get_queryset(ObjectClass, load_fields)(**kwargs).all()
+
+    def find_objects_in_batches(self, ObjectClass, batch_size, since_id=None, related_names=()):
+        """ Retrieve all objects of type ``ObjectClass``, as lists of at most ``batch_size`` objects.
+
+        Each batch is retrieved with one query, ordered by id and starting after the
+        last id of the previous batch (or after ``since_id``), so that no skip() scans are needed.
         """
-        return ObjectClass.objects(**kwargs).all()
+        last_id = since_id
+        while True:
+            query = ObjectClass.objects(id__gt=last_id) if last_id is not None else ObjectClass.objects
+            batch = list(query.order_by('id').limit(batch_size))
+            if not batch:
+                break
+            last_id = batch[-1].id
+            yield batch
 
-    def find_first_object(self, ObjectClass, **kwargs):
+    def find_first_object(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
+
+        If ``load_fields`` is specified, only these fields are retrieved, with ``only()``.
         """
 
         # Retrieve first object -- case sensitive
-        return ObjectClass.objects(**kwargs).first()
+        return self._get_queryset(ObjectClass, load_fields)(**kwargs).first()
 
     def ifind_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case insensitive.
 
         | If USER_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
-        | If USER_IFIND_MODE is 'ifind' this method performs a case insensitive find.
+        | If USER_IFIND_MODE is 'ifind' this method performs a case insensitive find,
+            with ``CASE_INSENSITIVE_COLLATION``, which can use the indexes created by ``create_all_tables()``.
         """
         # Call regular find() if USER_IFIND_MODE is nocase_collation
         if self.user_manager.USER_IFIND_MODE=='nocase_collation':
             return self.find_first_object(ObjectClass, **kwargs)
 
-        # Convert ...(email=value) to ...(email__iexact=value)
-        iexact_kwargs = {}
-        for key, value in kwargs.items():
-            iexact_kwargs[key+'__iexact'] = value
+        # Query normalized shadow fields if USER_IFIND_MODE is normalized
+        if self.user_manager.USER_IFIND_MODE=='normalized':
+            return self.find_first_object(ObjectClass, **self.normalize_kwargs(ObjectClass, kwargs))
+
         # Retrieve first object -- case insensitive
-        return ObjectClass.objects(**iexact_kwargs).first()
+        return ObjectClass.objects(**kwargs).collation(self.CASE_INSENSITIVE_COLLATION).first()
+
+    def ifind_first_object_by_fields(self, ObjectClass, field_names, field_value):
+        """ Retrieve the first object of type ``ObjectClass``,
+        with one of the fields in ``field_names`` matching ``field_value`` -- case insensitive.
+
+        All fields are matched with one ``$or`` query.
+        Of the returned objects, an object matching an earlier field is preferred.
+
+        | Returns an (object, field_name) tuple on success.
+        | Returns (None, None) otherwise.
+        """
+        from mongoengine.queryset.visitor import Q
+
+        ifind_mode = self.user_manager.USER_IFIND_MODE
+
+        # Convert each field name into a filter
+        query = None
+        for field_name in field_names:
+            if ifind_mode=='normalized':
+                condition = Q(**{field_name+'_normalized': self.normalize_value(field_value)})
+            else:
+                condition = Q(**{field_name: field_value})
+            query = condition if query is None else query | condition
+
+        # Execute one query. With unique fields, at most one object matches each field.
+        queryset = ObjectClass.objects(query)
+        if ifind_mode=='ifind':
+            queryset = queryset.collation(self.CASE_INSENSITIVE_COLLATION)
+        objects = list(queryset.limit(len(field_names)))
+        return self.select_object_by_fields(objects, field_names, field_value)
+
+    def get_object_with_related(self, ObjectClass, id, related_name):
+        """ Retrieve object of type ``ObjectClass`` by ``id``,
+        and dereference the document referenced by its ``related_name`` field along with it.
+        """
+        objects = ObjectClass.objects(id=id).limit(1).select_related(max_depth=1)
+        return objects[0] if objects else None
+
+    def ifind_first_object_with_related(self, ObjectClass, related_name, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive,
+        and dereference the document referenced by its ``related_name`` field along with it.
+        """
+        ifind_mode = self.user_manager.USER_IFIND_MODE
+
+        # Query normalized shadow fields if USER_IFIND_MODE is normalized
+        if ifind_mode=='normalized':
+            kwargs = self.normalize_kwargs(ObjectClass, kwargs)
+        queryset = ObjectClass.objects(**kwargs)
+
+        # Use a case insensitive collation if USER_IFIND_MODE is ifind
+        if ifind_mode=='ifind':
+            queryset = queryset.collation(self.CASE_INSENSITIVE_COLLATION)
+
+        # Retrieve first object and its references
+        objects = queryset.limit(1).select_related(max_depth=1)
+        return objects[0] if objects else None
 
     def save_object(self, object, **kwargs):
         """ Save object to database.
 
         | Session-based ODMs would do nothing.
         | Object-based ODMs would do something like object.save().
+
+        With USER_BATCH_OBJECT_WRITES, the object is saved by ``commit()``.
         """
+        if self.buffer_write('save', object):
+            return
         object.save()
 
+    def get_object_values(self, object):
+        """ Return a dict of the field values of ``object``, including its ``id``."""
+        return dict((field_name, getattr(object, field_name)) for field_name in object._fields)
+
+    def get_changed_field_names(self, object):
+        """ Return the changed field names of ``object``, or all its field names if it was never saved."""
+        if object._created:
+            return list(object._fields)
+        return list(object._changed_fields)
+
     def delete_object(self, object):
         """ Delete object from database.
+
+        With USER_BATCH_OBJECT_WRITES, the object is deleted by ``commit()``.
         """
+        if self.buffer_write('delete', object):
+            return
         object.delete()
 
     def commit(self):
-        """Save all modified session objects to the database.
+        """Write the adds, saves and deletes buffered with USER_BATCH_OBJECT_WRITES.
 
-        | Session-based ODMs would call something like ``db.session.commit()``.
-        | Object-based ODMs would do nothing.
+        All objects are validated first. Writes are then sent with one ordered ``bulk_write()``
+        per collection: new objects are inserted, and existing objects are updated
+        with their changed fields only. MongoEngine's save and delete signals are not sent.
+        New objects without an ID are assigned an ObjectId.
+
+        .. note::
+
+            | The bulk writes are not atomic: if a bulk write fails, the writes before it,
+                and the writes before the failed write in the same collection, are kept.
+            | For example, a User may be added without its UserEmail. Writes are sent in the order
+                in which their collections were first written to, so add the User first.
         """
-        pass
+        from bson import ObjectId
+        from pymongo import DeleteOne, InsertOne, UpdateOne
+
+        buffered_writes = self.pop_buffered_writes()
+        if not buffered_writes:
+            return
+
+        # Validate all objects before writing any of them
+        for operation, object in buffered_writes:
+            if operation != 'delete':
+                object.validate()
+
+        # Convert writes into requests, grouped per collection, in order.
+        # An object that is added and saved is written once, with its current field values.
+        collection_requests = OrderedDict()     # full_name -> (collection, requests)
+        written_objects = OrderedDict()         # id(object) -> object
+        for operation, object in buffered_writes:
+            collection = object._get_collection()
+            requests = collection_requests.setdefault(collection.full_name, (collection, []))[1]
+            if operation == 'delete':
+                requests.append(DeleteOne({'_id': object.pk}))
+            elif id(object) in written_objects:
+                continue
+            elif object._created:
+                document = object.to_mongo()
+                if document.get('_id') is None:
+                    document['_id'] = ObjectId()
+                    object.pk = document['_id']
+                requests.append(InsertOne(document))
+                written_objects[id(object)] = object
+            else:
+                sets, unsets = object._delta()
+                update = {}
+                if sets:
+                    update['$set'] = sets
+                if unsets:
+                    update['$unset'] = unsets
+                if update:
+                    requests.append(UpdateOne({'_id': object.pk}, update))
+                written_objects[id(object)] = object
+
+        for collection, requests in collection_requests.values():
+            if requests:
+                collection.bulk_write(requests, ordered=True)
 
+        # Written objects are no longer new, and have no unsaved changes
+        for object in written_objects.values():
+            object._created = False
+            object._clear_changed_fields()
+
+
+    def _get_queryset(self, ObjectClass, fields):
+        # Returns ObjectClass.objects, retrieving only the fields in 'fields', if specified
+        queryset = ObjectClass.objects
+        if fields:
+            queryset = queryset.only(*fields)
+        return queryset
 
     # Database management methods
     # ---------------------------
 
-    def create_all_tables(self):
-        """This method does nothing for MongoDbAdapter."""
-        pass
+    def create_all_tables(self, UserClass=None, UserEmailClass=None):
+        """Create the indexes of Flask-User's lookups.
+
+        MongoDB creates collections on first use. This method creates:
+
+        - indexes with ``CASE_INSENSITIVE_COLLATION`` on the ``username`` and ``email`` fields
+          of ``UserClass`` and ``UserEmailClass``, for case insensitive finds,
+        - an index on ``UserEmailClass.user_id``.
+
+        Existing indexes are left unchanged.
+        """
+        for ObjectClass in (UserClass, UserEmailClass):
+            if ObjectClass is None:
+                continue
+            collection = ObjectClass._get_collection()
+            for field_name in ('username', 'email'):
+                field = ObjectClass._fields.get(field_name)
+                if field is not None:
+                    collection.create_index(
+                        [(field.db_field, 1)], name=field.db_field+'_ci',
+                        collation=self.CASE_INSENSITIVE_COLLATION)
+            if ObjectClass is UserEmailClass and 'user_id' in ObjectClass._fields:
+                db_field = ObjectClass._fields['user_id'].db_field
+                collection.create_index([(db_field, 1)], name=db_field)
 
     def drop_all_tables(self):
         """Drop all document collections of the database.
@@ -2,6 +2,9 @@
 
 from __future__ import print_function
 
+import itertools
+from collections import namedtuple, OrderedDict
+
 # Non-system imports are moved into the methods to make them an optional requirement
 
 from flask_user.db_adapters import DbAdapterInterface
@@ -11,6 +14,12 @@ class PynamoDbAdapter(DbAdapterInterface):
     """ This object is used to shield Flask-User from PynamoDB specific functions.
     """
 
+    # Maximum number of items that DynamoDB accepts in one TransactWriteItems call
+    TRANSACT_WRITE_MAX_ITEMS = 100
+
+    # Maximum number of items that DynamoDB returns from one BatchGetItem call
+    BATCH_GET_MAX_ITEMS = 100
+
     def __init__(self, app, db=None):
         """Args:
             app(Flask): The Flask appliation instance.
@@ -21,51 +30,143 @@ class PynamoDbAdapter(DbAdapterInterface):
         |    db = ignored
         |    db_adapter = PynamoDbAdapter(app, db)
         """
-        # This no-op method is defined to show it in Sphinx docs in order 'bysource'
         super(PynamoDbAdapter, self).__init__(app, db)
 
+        # Cache of the key schemas of the table and of the secondary indexes, per ObjectClass
+        self._key_schemas = {}
+        # Filters for which a full-table scan was logged, to log each of them only once
+        self._logged_scans = set()
+
     def add_object(self, object):
         """ Add a new object to the database.
 
         | Session-based ODMs would call something like ``db.session.add(object)``.
         | Object-based ODMs would call something like ``object.save()``.
+
+        With USER_BATCH_OBJECT_WRITES, the object is saved by ``commit()``.
         """
+        if self.buffer_write('add', object):
+            return
         object.save()
 
+    def add_objects(self, ObjectClass, mappings):
+        """ Add new objects of type ``ObjectClass`` in bulk, from a list of dicts of field values,
+        with DynamoDB batch writes.
+
+        Returns the list of IDs of the new objects, in the order of ``mappings``.
+        """
+        objects = [ObjectClass(**mapping) for mapping in mappings]
+        with ObjectClass.batch_write() as batch:
+            for object in objects:
+                batch.save(object)
+        return [object.id for object in objects]
+
+    def new_object_id(self, ObjectClass):
+        """ Return a new ID for an object of type ``ObjectClass``, from the ``id`` default of a new object."""
+        return ObjectClass().id
+
     def commit(self):
-        """Save all modified session objects to the database.
+        """Write the adds, saves and deletes buffered with USER_BATCH_OBJECT_WRITES.
 
-        | Session-based ODMs would call something like ``db.session.commit()``.
-        | Object-based ODMs would do nothing.
+        Each object is written once, with its last operation. Up to ``TRANSACT_WRITE_MAX_ITEMS``
+        objects are written atomically, with one TransactWriteItems call.
+        More objects are written with one BatchWriteItem call per model, which is not atomic.
         """
-        pass
+        buffered_writes = self.pop_buffered_writes()
+        if not buffered_writes:
+            return
+
+        # Keep the last operation of each object, in the order of first occurrence
+        last_writes = OrderedDict()     # id(object) -> (operation, object)
+        for operation, object in buffered_writes:
+            last_writes[id(object)] = (operation, object)
+        last_writes = list(last_writes.values())
+
+        if len(last_writes) <= self.TRANSACT_WRITE_MAX_ITEMS:
+            from pynamodb.connection import Connection
+            from pynamodb.transactions import TransactWrite
+
+            meta = type(last_writes[0][1]).Meta
+            connection = Connection(region=getattr(meta, 'region', None), host=getattr(meta, 'host', None))
+            with TransactWrite(connection=connection) as transaction:
+                for operation, object in last_writes:
+                    if operation == 'delete':
+                        transaction.delete(object)
+                    else:
+                        transaction.save(object)
+            return
+
+        for ObjectClass in set(type(object) for operation, object in last_writes):
+            with ObjectClass.batch_write() as batch:
+                for operation, object in last_writes:
+                    if type(object) is not ObjectClass:
+                        continue
+                    if operation == 'delete':
+                        batch.delete(object)
+                    else:
+                        batch.save(object)
 
     def delete_object(self, object):
         """ Delete object from database.
+
+        With USER_BATCH_OBJECT_WRITES, the object is deleted by ``commit()``.
         """
+        if self.buffer_write('delete', object):
+            return
         object.delete()
 
-    def find_objects(self, ObjectClass, **kwargs):
+    def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` -- case sensitive. Return False otherwise.
+
+        Queries the table or a secondary index if one of them is keyed on a filtered field.
+        Scans the whole table otherwise.
+        """
+        # A scan 'limit' applies before the filter: stop at the first matching object instead.
+        for object in self._query_or_scan(ObjectClass, kwargs):
+            return True
+        return False
+
+    def find_objects(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve all objects of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
+
+        Queries the table or a secondary index if one of them is keyed on a filtered field.
+        Scans the whole table otherwise.
+
+        If ``load_fields`` is specified, only these attributes are retrieved, with ``attributes_to_get``.
         """
-        filter = None
-        for k, v in kwargs.items():
-            cond = ObjectClass.getattr(k) == v
-            filter = cond if filter is None else filter & cond
+        return self._query_or_scan(ObjectClass, kwargs, fields=load_fields)
 
-        return ObjectClass.scan(filter)
+    def find_objects_in_batches(self, ObjectClass, batch_size, since_id=None, related_names=()):
+        """ Retrieve all objects of type ``ObjectClass``, as lists of at most ``batch_size`` objects.
 
-    def find_first_object(self, ObjectClass, **kwargs):
+        Objects are scanned one page of ``batch_size`` items at a time.
+        DynamoDB scans are unordered: ``since_id`` filters on IDs greater than ``since_id``.
+        """
+        filter = ObjectClass.id > since_id if since_id is not None else None
+        batch = []
+        for object in ObjectClass.scan(filter, page_size=batch_size):
+            batch.append(object)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def find_first_object(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
-        """
-        filter = None
-        for k, v in kwargs.items():
-            cond = getattr(ObjectClass, k) == v
-            filter = cond if filter is None else filter & cond
 
-        return list(ObjectClass.scan(filter, limit=1))[0]
+        Queries the table or a secondary index if one of them is keyed on a filtered field.
+        Scans the whole table otherwise.
+
+        If ``load_fields`` is specified, only these attributes are retrieved, with ``attributes_to_get``.
+        """
+        # A scan 'limit' applies before the filter: stop at the first matching object instead.
+        for object in self._query_or_scan(ObjectClass, kwargs, fields=load_fields):
+            return object
+        return None
 
     def ifind_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
@@ -73,26 +174,38 @@ class PynamoDbAdapter(DbAdapterInterface):
 
         | If USER_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
         | If USER_IFIND_MODE is 'ifind' this method performs a case insensitive find.
+
+        DynamoDB has no case insensitive comparisons. If ObjectClass has an index keyed on
+        a lowercase shadow field, like ``email_normalized``, that index is queried.
+        Otherwise the whole table is scanned and values are compared in Python.
         """
         from pynamodb.attributes import UnicodeAttribute
 
         if self.user_manager.USER_IFIND_MODE == 'nocase_collation':
             return self.find_first_object(ObjectClass, **kwargs)
 
-        # The below is horrendously slow on a large user database, but DynamoDB
-        # has no support for case insensitive search, so we have to scan.
-        # We try and be a little smart and use any non-unicode filters in the scan, thought.
+        if self.user_manager.USER_IFIND_MODE == 'normalized':
+            return self.find_first_object(ObjectClass, **self.normalize_kwargs(ObjectClass, kwargs))
 
+        # Compare unicode fields case insensitively, and all other fields in the query or scan filter
         tfilters = {k: v.lower() for k, v in kwargs.items() if type(getattr(ObjectClass, k)) == UnicodeAttribute}
-
-        ntfilter = None
-        for k in [k for k in kwargs if k not in tfilters]:
-            cond = getattr(ObjectClass, k) == kwargs[k]
-            ntfilter = cond if ntfilter is None else ntfilter & cond
-
-        for o in ObjectClass.scan(ntfilter):
+        filters = {k: v for k, v in kwargs.items() if k not in tfilters}
+
+        # Use an index on a lowercase shadow field, if one exists.
+        # The shadow field narrows the candidates. Python comparisons decide.
+        key_fields = set()
+        for key_schema in self._get_key_schemas(ObjectClass):
+            key_fields.update(key_schema.key_names)
+        for k in tfilters:
+            normalized_field_name = k + '_normalized'
+            if normalized_field_name in key_fields:
+                filters[normalized_field_name] = self.normalize_value(kwargs[k])
+                break
+
+        for o in self._query_or_scan(ObjectClass, filters, case_insensitive_fields=list(tfilters)):
             for k in tfilters:
-                if getattr(o, k, None).lower() != kwargs[k]:
+                value = getattr(o, k, None)
+                if value is None or value.lower() != tfilters[k]:
                     break
             else:
                 # all match
@@ -100,25 +213,161 @@ class PynamoDbAdapter(DbAdapterInterface):
 
         return None
 
-    def get_object(self, ObjectClass, id):
+    def get_object(self, ObjectClass, id, load_fields=None):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
 
         | Returns object on success.
         | Returns None otherwise.
+
+        If ``load_fields`` is specified, only these attributes are retrieved, with ``attributes_to_get``.
         """
         try:
-            return ObjectClass.get(id)
+            return ObjectClass.get(id, attributes_to_get=load_fields)
         except ObjectClass.DoesNotExist:
             return None
 
+    def get_object_values(self, object):
+        """ Return a dict of the attribute values of ``object``."""
+        return dict(object.attribute_values)
+
     def save_object(self, object):
         """ Save object to database.
 
         | Session-based ODMs would do nothing.
         | Object-based ODMs would do something like object.save().
+
+        With USER_BATCH_OBJECT_WRITES, the object is saved by ``commit()``.
         """
+        if self.buffer_write('save', object):
+            return
         object.save()
 
+    # Query routing
+    # -------------
+
+    def _query_or_scan(self, ObjectClass, kwargs, case_insensitive_fields=(), fields=None):
+        # Query the table, or a secondary index, whose hash key is one of the filtered fields.
+        # Filters on other fields become the query's filter condition.
+        # Scan the whole table only if no key schema applies.
+        key_schema = self._select_key_schema(ObjectClass, kwargs, fields)
+        if key_schema is not None:
+            hash_key_name, range_key_name = key_schema.hash_key_name, key_schema.range_key_name
+            range_key_condition = None
+            if range_key_name and kwargs.get(range_key_name) is not None:
+                range_key_condition = getattr(ObjectClass, range_key_name) == kwargs[range_key_name]
+            filter = self._get_filter_condition(
+                ObjectClass, kwargs, exclude=(hash_key_name, range_key_name if range_key_condition is not None else None))
+
+            query = (key_schema.index or ObjectClass).query
+            if key_schema.projects(fields):
+                return query(kwargs[hash_key_name], range_key_condition=range_key_condition, filter_condition=filter,
+                             attributes_to_get=fields)
+            # Indexes that project only some attributes return partial objects: reload them
+            objects = query(kwargs[hash_key_name], range_key_condition=range_key_condition, filter_condition=filter)
+            return self._reload_objects(ObjectClass, objects, fields)
+
+        # No table or index key matches the filters: scan the whole table
+        scanned_fields = tuple(sorted(kwargs)) + tuple(sorted(case_insensitive_fields))
+        if (ObjectClass, scanned_fields) not in self._logged_scans:
+            self._logged_scans.add((ObjectClass, scanned_fields))
+            self.app.logger.warning(
+                "PynamoDbAdapter: no table or secondary index of '%s' is keyed on any of %s. "
+                "Scanning the whole table." % (ObjectClass.__name__, list(scanned_fields)))
+        return ObjectClass.scan(self._get_filter_condition(ObjectClass, kwargs), attributes_to_get=fields)
+
+    def _get_filter_condition(self, ObjectClass, kwargs, exclude=()):
+        filter = None
+        for k, v in kwargs.items():
+            if k in exclude:
+                continue
+            # Field names that end in '__ne' are negated
+            if k.endswith('__ne'):
+                attr = getattr(ObjectClass, k[:-4])
+                cond = attr.exists() if v is None else attr != v
+            else:
+                attr = getattr(ObjectClass, k)
+                cond = attr.does_not_exist() if v is None else attr == v
+            filter = cond if filter is None else filter & cond
+        return filter
+
+    def _select_key_schema(self, ObjectClass, kwargs, fields=None):
+        # Returns the key schema to query for the filters in kwargs, or None if no hash key is filtered.
+        # Key schemas whose range key is filtered too are preferred, like a local secondary index
+        # that shares the hash key of the table, then key schemas that project all requested fields.
+        # The table takes precedence over indexes that are just as good.
+        selected_key_schema = selected_rank = None
+        for key_schema in self._get_key_schemas(ObjectClass):
+            if kwargs.get(key_schema.hash_key_name) is None:
+                continue
+            range_key_name = key_schema.range_key_name
+            rank = (bool(range_key_name and kwargs.get(range_key_name) is not None), key_schema.projects(fields))
+            if selected_rank is None or rank > selected_rank:
+                selected_key_schema, selected_rank = key_schema, rank
+        return selected_key_schema
+
+    def _get_key_schemas(self, ObjectClass):
+        # Returns the list of key schemas of the table, first, and of its secondary indexes.
+        key_schemas = self._key_schemas.get(ObjectClass)
+        if key_schemas is None:
+            from pynamodb.indexes import AllProjection, Index
+
+            hash_key_name, range_key_name = self._get_key_names(ObjectClass.get_attributes())
+            key_schemas = [_KeySchema(None, hash_key_name, range_key_name, None)]
+
+            table_key_names = set(name for name in (hash_key_name, range_key_name) if name)
+            for name in dir(ObjectClass):
+                index = getattr(ObjectClass, name, None)
+                if not isinstance(index, Index):
+                    continue
+                index_hash_key_name, index_range_key_name = self._get_key_names(index.Meta.attributes)
+
+                # Indexes project the table keys, the index keys and, optionally, other attributes
+                projection = getattr(index.Meta, 'projection', None)
+                projected_names = None
+                if not isinstance(projection, AllProjection):
+                    projected_names = frozenset(table_key_names | set(index.Meta.attributes) |
+                                                set(getattr(projection, 'non_key_attributes', None) or ()))
+                key_schemas.append(_KeySchema(index, index_hash_key_name, index_range_key_name, projected_names))
+
+            self._key_schemas[ObjectClass] = key_schemas
+        return key_schemas
+
+    def _get_key_names(self, attributes):
+        # Returns the (hash_key_name, range_key_name) of a dict of attributes
+        hash_key_name = range_key_name = None
+        for name, attribute in attributes.items():
+            if attribute.is_hash_key:
+                hash_key_name = name
+            elif attribute.is_range_key:
+                range_key_name = name
+        return hash_key_name, range_key_name
+
+    def _reload_objects(self, ObjectClass, objects, fields=None):
+        # Reload partial objects from the table with one BatchGetItem per chunk of objects, in order.
+        # Chunks grow from 1 to BATCH_GET_MAX_ITEMS objects, so that find_first_object() reloads one object.
+        hash_key_name, range_key_name = self._get_key_names(ObjectClass.get_attributes())
+
+        def get_key(object):
+            hash_key_value = getattr(object, hash_key_name)
+            return (hash_key_value, getattr(object, range_key_name)) if range_key_name else hash_key_value
+
+        # Key attributes are needed to put reloaded objects back in order
+        if fields is not None:
+            fields = list(fields) + [name for name in (hash_key_name, range_key_name) if name and name not in fields]
+
+        chunk_size = 1
+        objects = iter(objects)
+        while True:
+            keys = [get_key(object) for object in itertools.islice(objects, chunk_size)]
+            if not keys:
+                return
+            reloaded_objects = dict((get_key(object), object)
+                                    for object in ObjectClass.batch_get(keys, attributes_to_get=fields))
+            for key in keys:
+                if key in reloaded_objects:
+                    yield reloaded_objects[key]
+            chunk_size = min(chunk_size * 2, self.BATCH_GET_MAX_ITEMS)
+
     # Database management methods
     # ---------------------------
 
@@ -131,7 +380,7 @@ class PynamoDbAdapter(DbAdapterInterface):
                 klasses.append(klass)
         return klasses
 
-    def create_all_tables(self):
+    def create_all_tables(self, UserClass=None, UserEmailClass=None):
         """Create database tables for all known database data-models."""
         for klass in self.__get_classes():
             if not klass.exists():
@@ -145,3 +394,18 @@ class PynamoDbAdapter(DbAdapterInterface):
         for klass in self.__get_classes():
             if klass.exists():
                 klass.delete_table()
+
+
+class _KeySchema(namedtuple('_KeySchema', 'index hash_key_name range_key_name projected_names')):
+    # The key schema of a table (index None) or of a secondary index.
+    # projected_names is None if all attributes are projected.
+
+    @property
+    def key_names(self):
+        return [name for name in (self.hash_key_name, self.range_key_name) if name]
+
+    def projects(self, fields):
+        # Returns True if the query results hold all of 'fields' (all attributes if fields is None)
+        if self.projected_names is None:
+            return True
+        return fields is not None and all(field in self.projected_names for field in fields)
@@ -0,0 +1,637 @@
+"""This module implements a DbAdapter that distributes users across multiple databases.
+"""
+
+# Author: Ling Thio <ling.thio@gmail.com>
+# Copyright (c) 2013 Ling Thio
+
+from __future__ import print_function
+
+import hashlib
+import random
+from collections import OrderedDict
+
+from flask import g, has_app_context
+
+# Non-system imports are moved into the methods to make them an optional requirement
+
+from flask_user import ConfigError, DuplicateValueError
+from flask_user.db_adapters import DbAdapterInterface
+
+
+class ShardedDbAdapter(DbAdapterInterface):
+    """ Implements the DbAdapter interface on top of N DbAdapters, one per shard database.
+
+    Each object is stored on the shard that a stable hash of its ``id`` maps to.
+    Objects with a ``user_id`` (like UserEmail objects) are assigned an ``id`` that maps
+    to the shard of their user, so that lookups by ``id`` or by ``user_id`` touch one shard.
+
+    Lookups by ``username`` or ``email`` touch the one shard that the ``lookup_index`` maps
+    the normalized value to. Other lookups (like Role lookups by name) query all shards, in order.
+
+    Shards are selected with rendezvous hashing: adding a shard moves only
+    the users that map to the new shard. See ``rebalance()``. Until then, lookups by ID
+    that miss on the shard of the ID fall back to the other shards, in rendezvous order.
+
+    With Flask-SQLAlchemy, each shard stores the Roles of its users: DBManager finds
+    or adds Roles on the shard of the user.
+
+    Lookup index entries are written after the shards are committed,
+    for the usernames and email addresses that changed. Values that another shard holds
+    are not remapped: ``commit()`` raises DuplicateValueError instead.
+
+    .. note::
+
+        | Writes are committed per shard: a ``commit()`` is not atomic across shards.
+        | USER_BATCH_OBJECT_WRITES is not supported.
+    """
+
+    # Fields that are mapped to shards by the lookup index
+    LOOKUP_FIELDS = ('username', 'email')
+
+    def __init__(self, app, db_adapters, lookup_index=None, id_generator=None, fallback_lookups=True):
+        """Args:
+            app(Flask): The Flask appliation instance.
+            db_adapters: A list of DbAdapters, or a dict of DbAdapters keyed by shard name.
+                The shards of a list are named '0', '1', and so on.
+                Shard names are hashed along with object IDs: shards must keep their names.
+            lookup_index: An index from normalized usernames and email addresses to shard names,
+                like ``SQLShardLookupIndex``. Without it, lookups by username or email query all shards.
+            id_generator: A function that returns a new unique object ID.
+                The default returns random 63-bit integers, which require 64-bit ID columns.
+            fallback_lookups: If True, lookups by ID that miss on the shard of the ID query
+                the other shards, so that users are found on their old shard until ``rebalance()``
+                moved them. Set it to False once all users are rebalanced, so that lookups of
+                deleted IDs query only one shard.
+
+        | Example:
+        |     class CustomUserManager(UserManager):
+        |         def customize(self, app):
+        |             self.db_manager.db_adapter = ShardedDbAdapter(app,
+        |                 [SQLDbAdapter(app, shard_db) for shard_db in shard_dbs],
+        |                 lookup_index=SQLShardLookupIndex(lookup_engine))
+        """
+        super(ShardedDbAdapter, self).__init__(app, None)
+        if isinstance(db_adapters, dict):
+            self.db_adapters = OrderedDict((str(shard_name), db_adapter)
+                                           for shard_name, db_adapter in db_adapters.items())
+        else:
+            self.db_adapters = OrderedDict((str(index), db_adapter)
+                                           for index, db_adapter in enumerate(db_adapters))
+        if not self.db_adapters:
+            raise ConfigError('ShardedDbAdapter requires at least one DbAdapter.')
+        if self.user_manager.USER_BATCH_OBJECT_WRITES:
+            raise ConfigError('USER_BATCH_OBJECT_WRITES is not supported with ShardedDbAdapter.')
+        self.lookup_index = lookup_index
+        self.id_generator = id_generator or _generate_random_id
+        self.fallback_lookups = fallback_lookups
+
+    @property
+    def DEFERS_UNLOADED_FIELDS(self):
+        return all(db_adapter.DEFERS_UNLOADED_FIELDS for db_adapter in self.db_adapters.values())
+
+    def get_shard_name(self, id):
+        """ Return the name of the shard that stores the object with ``id``.
+
+        IDs are hashed as strings, so that IDs decrypted from tokens map to the same shard.
+        """
+        key = ':' + str(id)
+        return max(self.db_adapters, key=lambda shard_name: hashlib.sha1(
+            (shard_name + key).encode('utf-8')).digest())
+
+    def get_db_adapter(self, object_or_id):
+        """ Return the DbAdapter of the shard that stores ``object_or_id``: an object, or an object ID.
+
+        Objects that were found on another shard than the shard of their ID, before ``rebalance()``
+        moved them, are stored on the shard where they were found.
+        """
+        return self.db_adapters[self._get_object_shard_name(object_or_id)]
+
+    def add_object(self, object):
+        """ Add a new object to the shard of its ``id``.
+
+        Objects without an ``id`` are assigned one, on the shard of their user, if they have one.
+        """
+        if getattr(object, 'id', None) is None:
+            object.id = self._generate_id(self._get_user_id(object))
+        shard_name = self.get_shard_name(object.id)
+        self.db_adapters[shard_name].add_object(object)
+        self._queue_lookup_index_update(type(object), object, shard_name, self.LOOKUP_FIELDS)
+
+    def add_objects(self, ObjectClass, mappings):
+        """ Add new objects of type ``ObjectClass`` in bulk, with one bulk write per shard.
+
+        Returns the list of IDs of the new objects, in the order of ``mappings``.
+        """
+        ids = []
+        shard_mappings = OrderedDict()
+        for mapping in mappings:
+            mapping = dict(mapping)
+            if mapping.get('id') is None:
+                mapping['id'] = self._generate_id(mapping.get('user_id'))
+            ids.append(mapping['id'])
+            shard_mappings.setdefault(self.get_shard_name(mapping['id']), []).append(mapping)
+
+        for shard_name, mappings in shard_mappings.items():
+            self.db_adapters[shard_name].add_objects(ObjectClass, mappings)
+            for mapping in mappings:
+                self._queue_lookup_index_update(ObjectClass, mapping, shard_name, self.LOOKUP_FIELDS)
+        return ids
+
+    def new_object_id(self, ObjectClass):
+        """ Return a new ID for an object of type ``ObjectClass``, from the ID generator."""
+        return self._generate_id()
+
+    def add_associations(self, ObjectClass, relationship_name, id_pairs):
+        """ Associate objects through a many-to-many relationship in bulk,
+        on the shard of each (object_id, related_object_id) tuple's ``object_id``.
+        """
+        shard_id_pairs = OrderedDict()
+        for id_pair in id_pairs:
+            shard_id_pairs.setdefault(self.get_shard_name(id_pair[0]), []).append(id_pair)
+        for shard_name, id_pairs in shard_id_pairs.items():
+            self.db_adapters[shard_name].add_associations(ObjectClass, relationship_name, id_pairs)
+
+    def commit(self):
+        """ Commit each shard, in order, and then write the queued lookup index entries.
+
+        Raises DuplicateValueError if a new username or email address was committed on another shard.
+        The object with the duplicate value stays committed, but is not found by that value.
+        """
+        for db_adapter in self.db_adapters.values():
+            db_adapter.commit()
+        duplicate_values = []
+        lookup_index_updates = self._pop_lookup_index_updates()
+        for (field_name, normalized_value), (ObjectClass, shard_name, is_changed) in lookup_index_updates.items():
+            if not self._claim_lookup_value(ObjectClass, field_name, normalized_value, shard_name, is_changed):
+                duplicate_values.append('%s %r' % (field_name, normalized_value))
+        if duplicate_values:
+            raise DuplicateValueError('Values exist on another shard: ' + ', '.join(duplicate_values))
+
+    def rollback(self):
+        """ Roll back each shard, and discard the queued lookup index entries."""
+        for db_adapter in self.db_adapters.values():
+            db_adapter.rollback()
+        self._pop_lookup_index_updates()
+
+    def delete_object(self, object):
+        """ Delete object from its shard.
+
+        Lookup index entries of deleted objects are left in place: they map to a shard
+        where the value no longer exists, until another object takes the value.
+        """
+        self.get_db_adapter(object).delete_object(object)
+
+    def save_object(self, object):
+        """ Save object to its shard. Changed usernames and email addresses are indexed by ``commit()``."""
+        shard_name = self._get_object_shard_name(object)
+        db_adapter = self.db_adapters[shard_name]
+        changed_field_names = db_adapter.get_changed_field_names(object)
+        db_adapter.save_object(object)
+        self._queue_lookup_index_update(type(object), object, shard_name, changed_field_names)
+
+    def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` on any of the shards that they map to. Return False otherwise.
+        """
+        return any(self.db_adapters[shard_name].exists_object(ObjectClass, **kwargs)
+                   for shard_name in self._route(kwargs))
+
+    def find_objects(self, ObjectClass, load_fields=None, **kwargs):
+        """ Retrieve all objects of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case sensitive,
+        from the shards that the filters map to.
+        """
+        objects = []
+        for shard_name in self._route(kwargs):
+            objects.extend(self._set_object_shard_name(object, shard_name) for object in
+                           self.db_adapters[shard_name].find_objects(ObjectClass, load_fields=load_fields, **kwargs))
+        return objects
+
+    def find_first_object(self, ObjectClass, load_fields=None, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case sensitive,
+        from the shards that the filters map to.
+        """
+        for shard_name in self._route(kwargs):
+            object = self.db_adapters[shard_name].find_first_object(ObjectClass, load_fields=load_fields, **kwargs)
+            if object is not None:
+                return self._set_object_shard_name(object, shard_name)
+        return None
+
+    def ifind_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive,
+        from the shards that the filters map to.
+        """
+        for shard_name in self._route(kwargs):
+            object = self.db_adapters[shard_name].ifind_first_object(ObjectClass, **kwargs)
+            if object is not None:
+                return self._set_object_shard_name(object, shard_name)
+        return None
+
+    def find_objects_in_batches(self, ObjectClass, batch_size, since_id=None, related_names=()):
+        """ Retrieve all objects of type ``ObjectClass``, as lists of at most ``batch_size`` objects,
+        from each shard in turn.
+
+        Objects are ordered per shard: ``since_id`` filters objects, but does not resume an
+        earlier iteration, as IDs are not ordered across shards.
+        """
+        for db_adapter in self.db_adapters.values():
+            for batch in db_adapter.find_objects_in_batches(
+                    ObjectClass, batch_size, since_id=since_id, related_names=related_names):
+                yield batch
+
+    def ifind_first_object_by_fields(self, ObjectClass, field_names, field_value):
+        """ Retrieve the first object of type ``ObjectClass``,
+        with one of the fields in ``field_names`` matching ``field_value`` -- case insensitive,
+        from the shards that the lookup index maps ``field_value`` to.
+
+        | Returns an (object, field_name) tuple on success.
+        | Returns (None, None) otherwise.
+        """
+        shard_names = []
+        for field_name in field_names:
+            for shard_name in self._route({field_name: field_value}):
+                if shard_name not in shard_names:
+                    shard_names.append(shard_name)
+
+        objects = []
+        for shard_name in shard_names:
+            object, matched_field_name = self.db_adapters[shard_name].ifind_first_object_by_fields(
+                ObjectClass, field_names, field_value)
+            if object is not None:
+                objects.append(self._set_object_shard_name(object, shard_name))
+        return self.select_object_by_fields(objects, field_names, field_value)
+
+    def get_object(self, ObjectClass, id, load_fields=None):
+        """ Retrieve object of type ``ObjectClass`` by ``id``, from the shard of ``id``,
+        or, with ``fallback_lookups``, from the first other shard that has it.
+
+        | Returns object on success.
+        | Returns None otherwise.
+        """
+        for shard_name in self._get_lookup_shard_names(id):
+            object = self.db_adapters[shard_name].get_object(ObjectClass, id, load_fields=load_fields)
+            if object is not None:
+                return self._set_object_shard_name(object, shard_name)
+        return None
+
+    def get_object_with_related(self, ObjectClass, id, related_name):
+        """ Retrieve object of type ``ObjectClass`` by ``id``, from the shard of ``id``,
+        or, with ``fallback_lookups``, from the first other shard that has it,
+        along with the object referenced by its ``related_name`` property.
+        """
+        for shard_name in self._get_lookup_shard_names(id):
+            object = self.db_adapters[shard_name].get_object_with_related(ObjectClass, id, related_name)
+            if object is not None:
+                return self._set_object_shard_name(object, shard_name)
+        return None
+
+    def ifind_first_object_with_related(self, ObjectClass, related_name, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive,
+        from the shards that the filters map to,
+        along with the object referenced by its ``related_name`` property.
+        """
+        for shard_name in self._route(kwargs):
+            object = self.db_adapters[shard_name].ifind_first_object_with_related(ObjectClass, related_name, **kwargs)
+            if object is not None:
+                return self._set_object_shard_name(object, shard_name)
+        return None
+
+    def attach_object(self, object):
+        """ Return ``object``, attached to the database session of its shard."""
+        if object is None:
+            return object
+        shard_name = self._get_object_shard_name(object)
+        return self._set_object_shard_name(self.db_adapters[shard_name].attach_object(object), shard_name)
+
+    def get_changed_field_names(self, object):
+        """ Return the changed field names of ``object``, from the DbAdapter of its shard."""
+        return self.get_db_adapter(object).get_changed_field_names(object)
+
+    def get_object_values(self, object):
+        """ Return a dict of the persistent field values of ``object``, from the DbAdapter of its shard."""
+        return self.get_db_adapter(object).get_object_values(object)
+
+    def snapshot_object(self, object):
+        """ Return the shard name of ``object``, and a snapshot made by the DbAdapter of its shard."""
+        shard_name = self._get_object_shard_name(object)
+        return (shard_name, self.db_adapters[shard_name].snapshot_object(object))
+
+    def restore_object(self, snapshot):
+        """ Return an object, restored by the DbAdapter of the shard of the snapshot."""
+        shard_name, shard_snapshot = snapshot
+        return self._set_object_shard_name(self.db_adapters[shard_name].restore_object(shard_snapshot), shard_name)
+
+
+    # Shard maintenance methods
+    # -------------------------
+
+    def rebalance(self, batch_size=1000):
+        """ Move users, along with their UserEmails, to the shard that their ID maps to.
+
+        Run this after adding shards. Each shard is scanned in batches of ``batch_size`` users.
+        The moved users of each batch are copied, and committed, to their new shards first,
+        and are then deleted, and committed, from their old shard, so that an interrupted
+        rebalance can be run again without losing users.
+
+        Moved UserEmails are assigned a new ID, on the new shard of their user:
+        email confirmation tokens that were sent to moved users are no longer valid.
+
+        Returns the number of moved users.
+        """
+        db_manager = self.user_manager.db_manager
+        UserClass, UserEmailClass = db_manager.UserClass, db_manager.UserEmailClass
+
+        num_moved = 0
+        for shard_name, db_adapter in self.db_adapters.items():
+            for users in db_adapter.find_objects_in_batches(UserClass, batch_size):
+                moves = [(user, self.get_shard_name(user.id)) for user in users]
+                moves = [(user, new_shard_name) for user, new_shard_name in moves if new_shard_name != shard_name]
+                if not moves:
+                    continue
+
+                # Copy users and their UserEmails to their new shards
+                moved_objects = []
+                new_shard_names = set()
+                for user, new_shard_name in moves:
+                    new_db_adapter = self.db_adapters[new_shard_name]
+                    user_emails = db_adapter.find_objects(UserEmailClass, user_id=user.id) if UserEmailClass else []
+                    if new_db_adapter.get_object(UserClass, user.id) is None:
+                        new_user = UserClass(**db_adapter.get_object_values(user))
+                        # For SQL: associate the user with the Roles of its new shard
+                        if db_manager.RoleClass and db_manager._is_sql_db_adapter():
+                            new_user.roles = [db_manager._get_or_add_role(new_db_adapter, role.name)
+                                              for role in user.roles]
+                        new_db_adapter.add_object(new_user)
+                        for user_email in user_emails:
+                            user_email_values = db_adapter.get_object_values(user_email)
+                            user_email_values['id'] = self._generate_id(user.id)
+                            new_db_adapter.add_object(UserEmailClass(**user_email_values))
+                    moved_objects.append((user, user_emails, new_shard_name))
+                    new_shard_names.add(new_shard_name)
+                for new_shard_name in new_shard_names:
+                    self.db_adapters[new_shard_name].commit()
+
+                # Point the lookup index to the new shards, and delete the old copies
+                for user, user_emails, new_shard_name in moved_objects:
+                    for object in [user] + list(user_emails):
+                        self._update_lookup_index(object, new_shard_name)
+                        db_adapter.delete_object(object)
+                db_adapter.commit()
+                num_moved += len(moved_objects)
+        return num_moved
+
+    def rebuild_lookup_index(self, batch_size=1000):
+        """ Map the usernames and email addresses of all existing User and UserEmail objects
+        to their shard, in the lookup index.
+
+        Run this once after adding a lookup index to existing shards.
+        Objects are retrieved in batches of ``batch_size`` objects.
+
+        Returns the number of indexed objects.
+        """
+        db_manager = self.user_manager.db_manager
+        num_indexed = 0
+        for ObjectClass in (db_manager.UserClass, db_manager.UserEmailClass):
+            if not ObjectClass:
+                continue
+            for shard_name, db_adapter in self.db_adapters.items():
+                for objects in db_adapter.find_objects_in_batches(ObjectClass, batch_size):
+                    for object in objects:
+                        self._update_lookup_index(object, shard_name)
+                    num_indexed += len(objects)
+        return num_indexed
+
+
+    def _route(self, kwargs):
+        # Returns the names of the shards that may hold objects matching 'kwargs'
+        for field_name in ('id', 'user_id'):
+            if kwargs.get(field_name) is not None:
+                return [self.get_shard_name(kwargs[field_name])]
+        if self.lookup_index is not None:
+            for field_name in self.LOOKUP_FIELDS:
+                field_value = kwargs.get(field_name, kwargs.get(field_name+'_normalized'))
+                if field_value is not None:
+                    # Values that are not in the index do not exist
+                    shard_name = self.lookup_index.get_shard_name(field_name, self.normalize_value(field_value))
+                    return [shard_name] if shard_name in self.db_adapters else []
+        return list(self.db_adapters)
+
+    def _get_lookup_shard_names(self, id):
+        # Returns the names of the shards to look up 'id' in: the shard of 'id' first,
+        # and with 'fallback_lookups', the other shards in rendezvous order
+        if not self.fallback_lookups:
+            return [self.get_shard_name(id)]
+        key = ':' + str(id)
+        return sorted(self.db_adapters, reverse=True, key=lambda shard_name: hashlib.sha1(
+            (shard_name + key).encode('utf-8')).digest())
+
+    def _get_object_shard_name(self, object_or_id):
+        # Returns the name of the shard where an object was found, or else the shard of its ID
+        shard_name = getattr(object_or_id, '_flask_user_shard_name', None)
+        if shard_name in self.db_adapters:
+            return shard_name
+        return self.get_shard_name(getattr(object_or_id, 'id', object_or_id))
+
+    def _set_object_shard_name(self, object, shard_name):
+        # Tags 'object' with the shard where it was found, if that is not the shard of its ID
+        if object is not None and shard_name != self.get_shard_name(object.id):
+            object._flask_user_shard_name = shard_name
+        return object
+
+    def _get_user_id(self, object):
+        # Returns the ID of the user that 'object' belongs to, if any
+        user_id = getattr(object, 'user_id', None)
+        if user_id is None:
+            user = getattr(object, 'user', None)
+            user_id = getattr(user, 'id', None)
+        return user_id
+
+    def _generate_id(self, user_id=None):
+        # Returns a new ID. With a 'user_id', the new ID maps to the shard of that user.
+        shard_name = self.get_shard_name(user_id) if user_id is not None else None
+        while True:
+            id = self.id_generator()
+            if shard_name is None or self.get_shard_name(id) == shard_name:
+                return id
+
+    def _get_lookup_values(self, object, field_names=None):
+        # Returns (field_name, normalized_value) tuples of the lookup fields of 'object',
+        # or of a dict of field values, that are in 'field_names', if specified
+        lookup_values = []
+        for field_name in self.LOOKUP_FIELDS:
+            if field_names is not None and field_name not in field_names:
+                continue
+            if isinstance(object, dict):
+                field_value = object.get(field_name)
+            else:
+                field_value = getattr(object, field_name, None)
+            if field_value:
+                lookup_values.append((field_name, self.normalize_value(field_value)))
+        return lookup_values
+
+    def _update_lookup_index(self, object, shard_name):
+        # Map the normalized usernames and email addresses of 'object', or of a dict of field values, to 'shard_name'
+        if self.lookup_index is None:
+            return
+        for field_name, normalized_value in self._get_lookup_values(object):
+            if self.lookup_index.get_shard_name(field_name, normalized_value) != shard_name:
+                self.lookup_index.set_shard_name(field_name, normalized_value, shard_name)
+
+    def _queue_lookup_index_update(self, ObjectClass, object, shard_name, changed_field_names):
+        # Queue the lookup index entries of the 'changed_field_names' of 'object', or of a dict of field values,
+        # until 'commit()'. If 'changed_field_names' is None, all entries are compared with the lookup index.
+        if self.lookup_index is None:
+            return
+        is_changed = changed_field_names is not None
+        lookup_values = self._get_lookup_values(object, changed_field_names)
+        if not has_app_context():
+            for field_name, normalized_value in lookup_values:
+                if not self._claim_lookup_value(ObjectClass, field_name, normalized_value, shard_name, is_changed):
+                    raise DuplicateValueError('Value exists on another shard: %s %r' % (field_name, normalized_value))
+            return
+        lookup_index_updates = g.get('_flask_user_lookup_index_updates')
+        if lookup_index_updates is None:
+            lookup_index_updates = g._flask_user_lookup_index_updates = OrderedDict()
+        for lookup_value in lookup_values:
+            lookup_index_updates.pop(lookup_value, None)
+            lookup_index_updates[lookup_value] = (ObjectClass, shard_name, is_changed)
+
+    def _claim_lookup_value(self, ObjectClass, field_name, normalized_value, shard_name, is_changed):
+        # Map 'normalized_value' to 'shard_name' in the lookup index, unless another shard holds the value.
+        # Entries of shards that no longer hold the value, after a delete, a change or a failed commit, are taken over.
+        # Values are claimed after they are committed, so that of two concurrent claims, one sees the other's value.
+        # Returns False if another shard holds the value.
+        lookup_index = self.lookup_index
+        mapped_shard_name = None if is_changed else lookup_index.get_shard_name(field_name, normalized_value)
+        while mapped_shard_name != shard_name:
+            if mapped_shard_name is None:
+                mapped_shard_name = lookup_index.add_shard_name(field_name, normalized_value, shard_name)
+                continue
+            if self._holds_value(mapped_shard_name, ObjectClass, field_name, normalized_value):
+                return False
+            if lookup_index.replace_shard_name(field_name, normalized_value, mapped_shard_name, shard_name):
+                return True
+            mapped_shard_name = lookup_index.get_shard_name(field_name, normalized_value)
+        return True
+
+    def _holds_value(self, shard_name, ObjectClass, field_name, normalized_value):
+        # Returns True if shard 'shard_name' holds an object with the normalized value of 'field_name'
+        db_adapter = self.db_adapters.get(shard_name)
+        if db_adapter is None:
+            return False
+        object = db_adapter.ifind_first_object(ObjectClass, **{field_name: normalized_value})
+        return object is not None and self.normalize_value(getattr(object, field_name)) == normalized_value
+
+    def _pop_lookup_index_updates(self):
+        # Returns the lookup index entries queued by '_queue_lookup_index_update()', and empties the queue
+        if not has_app_context():
+            return {}
+        lookup_index_updates = g.get('_flask_user_lookup_index_updates') or {}
+        g._flask_user_lookup_index_updates = None
+        return lookup_index_updates
+
+
+    # Database management methods
+    # ---------------------------
+
+    def create_all_tables(self, UserClass=None, UserEmailClass=None):
+        """Create database tables on all shards, and the lookup index table, if needed."""
+        for db_adapter in self.db_adapters.values():
+            db_adapter.create_all_tables(UserClass=UserClass, UserEmailClass=UserEmailClass)
+        if hasattr(self.lookup_index, 'create_table'):
+            self.lookup_index.create_table()
+
+    def drop_all_tables(self):
+        """Drop all tables on all shards.
+
+        .. warning:: ALL DATA WILL BE LOST. Use only for automated testing.
+        """
+        for db_adapter in self.db_adapters.values():
+            db_adapter.drop_all_tables()
+
+
+class SQLShardLookupIndex(object):
+    """ Maps normalized usernames and email addresses to shard names, in one SQL table
+    that all application servers share, using SQLAlchemy Core.
+
+    Any object with the ``get_shard_name()``, ``set_shard_name()``, ``add_shard_name()``
+    and ``replace_shard_name()`` methods can be used as the ``lookup_index`` of a ShardedDbAdapter,
+    to use a different store.
+    """
+
+    def __init__(self, engine, table_name='flask_user_shard_lookup'):
+        """Args:
+            engine: The SQLAlchemy Engine of the lookup index database.
+            table_name(str): The name of the lookup index table.
+        """
+        from sqlalchemy import Column, MetaData, String, Table
+
+        self.engine = engine
+        self.table = Table(
+            table_name, MetaData(),
+            Column('field_name', String(50), primary_key=True),
+            Column('value', String(255), primary_key=True),
+            Column('shard_name', String(50), nullable=False))
+
+    def create_table(self):
+        """Create the lookup index table, if it does not exist."""
+        self.table.create(self.engine, checkfirst=True)
+
+    def get_shard_name(self, field_name, value):
+        """ Return the name of the shard that ``value`` of ``field_name`` maps to, or None."""
+        table = self.table
+        with self.engine.connect() as connection:
+            row = connection.execute(table.select().where(
+                (table.c.field_name == field_name) & (table.c.value == value))).first()
+        return row.shard_name if row is not None else None
+
+    def add_shard_name(self, field_name, value, shard_name):
+        """ Map ``value`` of ``field_name`` to ``shard_name``, if ``value`` is not mapped yet.
+
+        Returns the name of the shard that ``value`` maps to: ``shard_name``, or the shard it was mapped to.
+        """
+        from sqlalchemy.exc import IntegrityError
+
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(self.table.insert().values(field_name=field_name, value=value, shard_name=shard_name))
+            return shard_name
+        except IntegrityError:
+            return self.get_shard_name(field_name, value)
+
+    def replace_shard_name(self, field_name, value, old_shard_name, shard_name):
+        """ Map ``value`` of ``field_name`` to ``shard_name``, if it maps to ``old_shard_name``.
+
+        Returns True if ``value`` was mapped to ``shard_name``.
+        """
+        table = self.table
+        condition = (table.c.field_name == field_name) & (table.c.value == value) & \
+            (table.c.shard_name == old_shard_name)
+        with self.engine.begin() as connection:
+            return connection.execute(table.update().where(condition).values(shard_name=shard_name)).rowcount > 0
+
+    def set_shard_name(self, field_name, value, shard_name):
+        """ Map ``value`` of ``field_name`` to ``shard_name``."""
+        from sqlalchemy.exc import IntegrityError
+
+        table = self.table
+        condition = (table.c.field_name == field_name) & (table.c.value == value)
+        with self.engine.begin() as connection:
+            if connection.execute(table.update().where(condition).values(shard_name=shard_name)).rowcount:
+                return
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(table.insert().values(field_name=field_name, value=value, shard_name=shard_name))
+        except IntegrityError:
+            # Another process inserted the value first
+            with self.engine.begin() as connection:
+                connection.execute(table.update().where(condition).values(shard_name=shard_name))
+
+
+_system_random = random.SystemRandom()
+
+def _generate_random_id():
+    return _system_random.randint(1, 2**63 - 1)
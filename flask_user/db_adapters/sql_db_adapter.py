@@ -6,6 +6,8 @@
 
 from __future__ import print_function
 
+import collections
+
 # Non-system imports are moved into the methods to make them an optional requirement
 
 from flask_user.db_adapters import DbAdapterInterface
@@ -18,6 +20,9 @@ class SQLDbAdapter(DbAdapterInterface):
 
     # Almost all methods are defined in the DbAdapter base class.
 
+    # Columns that were not retrieved, because of a ``load_fields=`` projection, are loaded on access
+    DEFERS_UNLOADED_FIELDS = True
+
     def __init__(self, app, db):
         """Args:
             app(Flask): The Flask appliation instance.
@@ -39,21 +44,169 @@ class SQLDbAdapter(DbAdapterInterface):
         """
         self.db.session.add(object)
 
-    def get_object(self, ObjectClass, id):
+    # SQLite versions before 3.32 accept at most 999 parameters per statement
+    SQLITE_MAX_VARIABLE_NUMBER = 999
+
+    def add_objects(self, ObjectClass, mappings):
+        """ Add new objects of type ``ObjectClass`` in bulk, from a list of dicts of field values.
+
+        Returns the list of IDs of the new objects, in the order of ``mappings``.
+
+        | Mappings with IDs are inserted with one executemany INSERT.
+        | Otherwise, the database assigns the IDs, with multi-row INSERTs. The IDs are matched
+        |     to the mappings by a unique column that each mapping has a distinct value of:
+        |     with ``INSERT ... RETURNING`` on PostgreSQL, and with a SELECT on other databases.
+        | Mappings without such a unique column are inserted with an INSERT per object.
+        """
+        from sqlalchemy import inspect
+
+        mapper = inspect(ObjectClass)
+        primary_key_column = mapper.primary_key[0]
+        primary_key_name = mapper.get_property_by_column(primary_key_column).key
+        mappings = [dict(mapping) for mapping in mappings]
+        if not mappings:
+            return []
+
+        dialect = self.db.session.get_bind(mapper).dialect
+        if all(mapping.get(primary_key_name) is not None for mapping in mappings):
+            ids = None
+        elif getattr(dialect, 'use_insertmanyvalues', False):
+            # SQLAlchemy 2.0 batches INSERTs with RETURNING by itself
+            self.db.session.bulk_insert_mappings(ObjectClass, mappings, return_defaults=True)
+            return [mapping[primary_key_name] for mapping in mappings]
+        else:
+            ids = [None] * len(mappings)
+
+        # Map attribute names to column names
+        column_keys = dict((attr.key, attr.columns[0].key) for attr in mapper.column_attrs)
+        rows = [dict((column_keys.get(key, key), value) for key, value in mapping.items()
+                     if not (key == primary_key_name and value is None))
+                for mapping in mappings]
+        table = mapper.local_table
+
+        if ids is None:
+            self.db.session.execute(table.insert(), rows)
+            return [mapping[primary_key_name] for mapping in mappings]
+
+        # A multi-row INSERT requires rows with the same columns
+        unique_columns = self._get_unique_columns(table)
+        row_groups = collections.OrderedDict()
+        for index, row in enumerate(rows):
+            row_groups.setdefault(tuple(sorted(row.keys())), []).append(index)
+        for keys, indexes in row_groups.items():
+            chunk_size = len(indexes)
+            if dialect.name == 'sqlite':
+                chunk_size = max(1, self.SQLITE_MAX_VARIABLE_NUMBER // max(1, len(keys)))
+            for start in range(0, len(indexes), chunk_size):
+                chunk = indexes[start:start + chunk_size]
+                chunk_rows = [rows[index] for index in chunk]
+                for index, id in zip(chunk, self._insert_rows(dialect, table, primary_key_column,
+                                                               unique_columns, chunk_rows)):
+                    ids[index] = id
+        return ids
+
+    def _insert_rows(self, dialect, table, primary_key_column, unique_columns, rows):
+        # Inserts 'rows', which have the same columns, and returns their IDs, in the order of 'rows'
+        values = None
+        for column in unique_columns:
+            values = [row.get(column.key) for row in rows]
+            if None not in values and len(set(values)) == len(values):
+                break
+            values = None
+
+        # Without a unique column to match the IDs by, each row is inserted with its own INSERT
+        if values is None:
+            return [self.db.session.execute(table.insert().values(row)).inserted_primary_key[0] for row in rows]
+
+        # Match the IDs to the rows by their unique column value:
+        # the order of the rows of a multi-row INSERT is not guaranteed
+        statement = table.insert().values(rows)
+        if dialect.name == 'postgresql':
+            result = self.db.session.execute(statement.returning(primary_key_column, column))
+        else:
+            self.db.session.execute(statement)
+            result = self.db.session.execute(
+                table.select().with_only_columns([primary_key_column, column]).where(column.in_(values)))
+        ids_by_value = dict((value, id) for id, value in result)
+        return [ids_by_value[value] for value in values]
+
+    def _get_unique_columns(self, table):
+        # Returns the columns of 'table' with a single-column unique constraint or unique index
+        from sqlalchemy import UniqueConstraint
+
+        unique_column_sets = [constraint.columns for constraint in table.constraints
+                              if isinstance(constraint, UniqueConstraint)]
+        unique_column_sets.extend(index.columns for index in table.indexes if index.unique)
+        unique_column_keys = set(column.key for column in table.columns if column.unique)
+        unique_column_keys.update(list(columns)[0].key for columns in unique_column_sets if len(columns) == 1)
+        return [column for column in table.columns if column.key in unique_column_keys]
+
+    def add_associations(self, ObjectClass, relationship_name, id_pairs):
+        """ Associate objects through the many-to-many relationship ``relationship_name``
+        of ``ObjectClass`` in bulk, from a list of (object_id, related_object_id) tuples.
+
+        ``add_associations(User, 'roles', [(1, 2)])`` inserts a ``user_roles`` row with user_id=1 and role_id=2.
+        """
+        from sqlalchemy import inspect
+
+        if not id_pairs:
+            return
+
+        relationship = inspect(ObjectClass).relationships[relationship_name]
+        (object_key, object_id_column), = relationship.synchronize_pairs
+        (related_object_key, related_object_id_column), = relationship.secondary_synchronize_pairs
+        self.db.session.execute(
+            relationship.secondary.insert(),
+            [{object_id_column.name: object_id, related_object_id_column.name: related_object_id}
+             for object_id, related_object_id in id_pairs])
+
+    def get_object(self, ObjectClass, id, load_fields=None):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
 
         | Returns object on success.
         | Returns None otherwise.
+
+        If ``load_fields`` is specified, only these columns are loaded. Other columns are loaded on access.
         """
-        return ObjectClass.query.get(id)
+        return self._get_query(ObjectClass, load_fields).get(id)
+
+    def exists_object(self, ObjectClass, **kwargs):
+        """ Return True if an object of type ``ObjectClass`` matches the filters
+        specified in ``**kwargs`` -- case sensitive. Return False otherwise.
+
+        ``exists_object(UserEmail, user_id=1, email_confirmed_at__ne=None)`` translates to
+        ``SELECT EXISTS (SELECT * FROM user_emails WHERE user_id=1 AND email_confirmed_at IS NOT NULL)``.
+        """
+
+        # Convert each name/value pair in '**kwargs' into a filter
+        query = self.db.session.query(ObjectClass)
+        for field_name, field_value in kwargs.items():
+
+            # Field names that end in '__ne' are negated
+            negate = field_name.endswith('__ne')
+            if negate:
+                field_name = field_name[:-4]
+
+            # Make sure that ObjectClass has a 'field_name' property
+            field = getattr(ObjectClass, field_name, None)
+            if field is None:
+                raise KeyError("BaseAlchemyAdapter.exists_object(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
+
+            # Add a case sensitive filter to the query
+            query = query.filter(field!=field_value if negate else field==field_value)
 
-    def find_objects(self, ObjectClass, **kwargs):
+        # Execute an existence probe, which returns no rows
+        return self.db.session.query(query.exists()).scalar()
+
+    def find_objects(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve all objects of type ``ObjectClass``,
         matching the filters specified in ``**kwargs`` -- case sensitive.
+
+        If ``load_fields`` is specified, only these columns are loaded. Other columns are loaded on access.
         """
 
         # Convert each name/value pair in '**kwargs' into a filter
-        query = ObjectClass.query
+        query = self._get_query(ObjectClass, load_fields)
         for field_name, field_value in kwargs.items():
 
             # Make sure that ObjectClass has a 'field_name' property
@@ -68,13 +221,15 @@ class SQLDbAdapter(DbAdapterInterface):
         return query.all()
 
 
-    def find_first_object(self, ObjectClass, **kwargs):
+    def find_first_object(self, ObjectClass, load_fields=None, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
+
+        If ``load_fields`` is specified, only these columns are loaded. Other columns are loaded on access.
         """
 
         # Convert each name/value pair in 'kwargs' into a filter
-        query = ObjectClass.query
+        query = self._get_query(ObjectClass, load_fields)
         for field_name, field_value in kwargs.items():
 
             # Make sure that ObjectClass has a 'field_name' property
@@ -101,7 +256,7 @@ class SQLDbAdapter(DbAdapterInterface):
             return self.find_first_object(ObjectClass, **kwargs)
 
         # Convert each name/value pair in 'kwargs' into a filter
-        query = ObjectClass.query
+        query = self.db.session.query(ObjectClass)
         for field_name, field_value in kwargs.items():
 
             # Make sure that ObjectClass has a 'field_name' property
@@ -121,10 +276,17 @@ class SQLDbAdapter(DbAdapterInterface):
 
         ``ifind_first_object(User, email='myname@example.com')`` translates to
         ``User.query.filter(User.email.ilike('myname@example.com')).first()``.
+
+        If USER_IFIND_MODE is 'normalized', it translates to
+        ``User.query.filter(User.email_normalized=='myname@example.com').first()``.
         """
 
+        # Query normalized shadow fields if USER_IFIND_MODE is normalized
+        if self.user_manager.USER_IFIND_MODE=='normalized':
+            return self.find_first_object(ObjectClass, **self.normalize_kwargs(ObjectClass, kwargs))
+
         # Convert each name/value pair in 'kwargs' into a filter
-        query = ObjectClass.query
+        query = self.db.session.query(ObjectClass)
         for field_name, field_value in kwargs.items():
 
             # Make sure that ObjectClass has a 'field_name' property
@@ -138,6 +300,152 @@ class SQLDbAdapter(DbAdapterInterface):
         # Execute query
         return query.first()
 
+    def find_objects_in_batches(self, ObjectClass, batch_size, since_id=None, related_names=()):
+        """ Retrieve all objects of type ``ObjectClass``, as lists of at most ``batch_size`` objects.
+
+        Each batch is retrieved with one query, ordered by primary key and starting after the
+        last primary key of the previous batch (or after ``since_id``), so that no OFFSET scans are needed.
+        Relationships in ``related_names`` are loaded with one extra query per batch.
+        """
+        from sqlalchemy import inspect
+        from sqlalchemy.orm import selectinload
+
+        primary_key = inspect(ObjectClass).primary_key[0]
+        last_id = since_id
+        while True:
+            query = self.db.session.query(ObjectClass)
+            for related_name in related_names:
+                query = query.options(selectinload(getattr(ObjectClass, related_name)))
+            if last_id is not None:
+                query = query.filter(primary_key > last_id)
+            batch = query.order_by(primary_key).limit(batch_size).all()
+            if not batch:
+                break
+            last_id = getattr(batch[-1], primary_key.key)
+            yield batch
+
+    def ifind_first_object_by_fields(self, ObjectClass, field_names, field_value):
+        """ Retrieve the first object of type ``ObjectClass``,
+        with one of the fields in ``field_names`` matching ``field_value`` -- case insensitive.
+
+        ``ifind_first_object_by_fields(User, ['username', 'email'], 'Name')`` translates to
+        ``User.query.filter(or_(User.username.ilike('Name'), User.email.ilike('Name'))).limit(2).all()``.
+        Of the returned objects, an object matching an earlier field is preferred.
+
+        | Returns an (object, field_name) tuple on success.
+        | Returns (None, None) otherwise.
+        """
+        from sqlalchemy import or_
+
+        ifind_mode = self.user_manager.USER_IFIND_MODE
+
+        # Convert each field name into a filter
+        conditions = []
+        for field_name in field_names:
+            if ifind_mode=='normalized':
+                query_field_name, query_field_value = field_name+'_normalized', self.normalize_value(field_value)
+            else:
+                query_field_name, query_field_value = field_name, field_value
+
+            # Make sure that ObjectClass has a 'field_name' property
+            field = getattr(ObjectClass, query_field_name, None)
+            if field is None:
+                raise KeyError("BaseAlchemyAdapter.ifind_first_object_by_fields(): Class '%s' has no field '%s'." % (ObjectClass, query_field_name))
+
+            # Add a case insensitive filter
+            if ifind_mode=='ifind':
+                conditions.append(field.ilike(query_field_value))
+            else:
+                conditions.append(field==query_field_value)
+
+        # Execute one query. With unique fields, at most one object matches each field.
+        objects = self.db.session.query(ObjectClass).filter(or_(*conditions)).limit(len(field_names)).all()
+        return self.select_object_by_fields(objects, field_names, field_value)
+
+    def ifind_first_object_or_related(self, ObjectClass, field_name, RelatedClass, related_name, related_field_name,
+                                      field_value):
+        """ Retrieve the first object of type ``ObjectClass`` with its ``field_name`` matching ``field_value``,
+        or else the first object of type ``RelatedClass`` with its ``related_field_name`` matching ``field_value``,
+        along with the object of type ``ObjectClass`` referenced by its ``related_name`` relationship
+        -- case insensitive, in one query.
+
+        ``ifind_first_object_or_related(User, 'username', UserEmail, 'user', 'email', 'Name')`` translates to
+        ``db.session.query(User, UserEmail).outerjoin(UserEmail, and_(UserEmail.user_id==User.id,
+        UserEmail.email.ilike('Name'))).filter(or_(User.username.ilike('Name'), UserEmail.id!=None)).limit(2).all()``.
+
+        | Returns an (object, None, field_name) tuple if an object matches.
+        | Returns an (object, related_object, related_field_name) tuple if a related object matches.
+        | Returns (None, None, None) otherwise.
+        """
+        from sqlalchemy import and_, inspect, or_
+
+        def get_condition(ObjectClass, field_name):
+            # Returns a case insensitive filter of the 'field_name' of ObjectClass
+            if self.user_manager.USER_IFIND_MODE=='normalized':
+                return getattr(ObjectClass, field_name+'_normalized')==self.normalize_value(field_value)
+            field = getattr(ObjectClass, field_name)
+            return field.ilike(field_value) if self.user_manager.USER_IFIND_MODE=='ifind' else field==field_value
+
+        # Join the related objects that match, on the columns of the 'related_name' relationship
+        relationship = inspect(RelatedClass).relationships[related_name]
+        join_conditions = [local_column==remote_column for local_column, remote_column in relationship.local_remote_pairs]
+        related_primary_key = inspect(RelatedClass).primary_key[0]
+        rows = self.db.session.query(ObjectClass, RelatedClass) \
+            .outerjoin(RelatedClass, and_(get_condition(RelatedClass, related_field_name), *join_conditions)) \
+            .filter(or_(get_condition(ObjectClass, field_name), related_primary_key!=None)) \
+            .limit(2).all()
+
+        # An object matching 'field_name' is preferred. With unique fields, at most one object matches each field.
+        normalized_value = self.normalize_value(field_value)
+        for object, related_object in rows:
+            if self.normalize_value(getattr(object, field_name)) == normalized_value:
+                return (object, None, field_name)
+        for object, related_object in rows:
+            if related_object is not None:
+                return (object, related_object, related_field_name)
+        return (None, None, None)
+
+    def get_object_with_related(self, ObjectClass, id, related_name):
+        """ Retrieve object of type ``ObjectClass`` by ``id``,
+        joined with the object referenced by its ``related_name`` relationship.
+
+        ``get_object_with_related(UserEmail, 1, 'user')`` translates to
+        ``UserEmail.query.options(joinedload(UserEmail.user)).get(1)``.
+        """
+        from sqlalchemy.orm import joinedload
+
+        return self.db.session.query(ObjectClass).options(joinedload(getattr(ObjectClass, related_name))).get(id)
+
+    def ifind_first_object_with_related(self, ObjectClass, related_name, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case insensitive,
+        joined with the object referenced by its ``related_name`` relationship.
+
+        ``ifind_first_object_with_related(UserEmail, 'user', email='myname@example.com')`` translates to
+        ``UserEmail.query.options(joinedload(UserEmail.user)).filter(UserEmail.email.ilike('myname@example.com')).first()``.
+        """
+        from sqlalchemy.orm import joinedload
+
+        # Query normalized shadow fields if USER_IFIND_MODE is normalized
+        normalized = self.user_manager.USER_IFIND_MODE=='normalized'
+        if normalized:
+            kwargs = self.normalize_kwargs(ObjectClass, kwargs)
+
+        # Convert each name/value pair in 'kwargs' into a filter
+        query = self.db.session.query(ObjectClass).options(joinedload(getattr(ObjectClass, related_name)))
+        for field_name, field_value in kwargs.items():
+
+            # Make sure that ObjectClass has a 'field_name' property
+            field = getattr(ObjectClass, field_name, None)
+            if field is None:
+                raise KeyError("BaseAlchemyAdapter.ifind_first_object_with_related(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
+
+            # Add a case insensitive filter to the query
+            query = query.filter(field==field_value if normalized else field.ilike(field_value))
+
+        # Execute query
+        return query.first()
+
     def save_object(self, object):
         """ Save object to database.
 
@@ -159,11 +467,86 @@ class SQLDbAdapter(DbAdapterInterface):
         """
         self.db.session.commit()
 
+    def attach_object(self, object):
+        """ Return ``object``, merged into the database session without querying the database.
+
+        Objects that are already in the session are returned as is.
+        """
+        if object is None or object in self.db.session:
+            return object
+        return self.db.session.merge(object, load=False)
+
+    def get_object_values(self, object):
+        """ Return a dict of the column values of ``object``. Relationships are not included."""
+        from sqlalchemy import inspect
+
+        return dict((attr.key, getattr(object, attr.key)) for attr in inspect(type(object)).column_attrs)
+
+    def get_changed_field_names(self, object):
+        """ Return the column attribute names of ``object`` that changed since the last flush,
+        or all of them if ``object`` is transient or pending.
+        """
+        from sqlalchemy import inspect
+
+        state = inspect(object)
+        column_attrs = state.mapper.column_attrs
+        if state.transient or state.pending:
+            return [attr.key for attr in column_attrs]
+        return [attr.key for attr in column_attrs if state.attrs[attr.key].history.has_changes()]
+
+    def rollback(self):
+        """Discard all uncommitted changes to session objects."""
+        self.db.session.rollback()
+
+    def snapshot_object(self, object):
+        """ Return the class and the loaded column values of ``object``.
+
+        Relationships, and columns that were not loaded, are not included.
+        They are lazy-loaded from the restored object.
+        """
+        from sqlalchemy import inspect
+
+        ObjectClass = type(object)
+        column_attrs = inspect(ObjectClass).column_attrs
+        loaded_values = inspect(object).dict
+        return (ObjectClass, dict((attr.key, loaded_values[attr.key]) for attr in column_attrs
+                                  if attr.key in loaded_values))
+
+    def restore_object(self, snapshot):
+        """ Return a persistent object, created from a snapshot made by ``snapshot_object()``.
+
+        The object is merged into the current session without querying the database.
+        """
+        from sqlalchemy import inspect
+        from sqlalchemy.orm import make_transient_to_detached
+
+        ObjectClass, values = snapshot
+        object = inspect(ObjectClass).class_manager.new_instance()  # Skips __init__()
+        for key, value in values.items():
+            setattr(object, key, value)
+        make_transient_to_detached(object)
+        object = self.db.session.merge(object, load=False)
+
+        # Columns that were not in the snapshot are loaded on access
+        unloaded_keys = [attr.key for attr in inspect(ObjectClass).column_attrs if attr.key not in values]
+        if unloaded_keys:
+            self.db.session.expire(object, unloaded_keys)
+        return object
+
+
+    def _get_query(self, ObjectClass, fields):
+        # Returns a query of ObjectClass, loading only the columns in 'fields', if specified
+        query = self.db.session.query(ObjectClass)
+        if fields:
+            from sqlalchemy.orm import load_only
+            # SQLAlchemy 2.0 requires attributes, not attribute names
+            query = query.options(load_only(*[getattr(ObjectClass, field_name) for field_name in fields]))
+        return query
 
     # Database management methods
     # ---------------------------
 
-    def create_all_tables(self):
+    def create_all_tables(self, UserClass=None, UserEmailClass=None):
         """Create database tables for all known database data-models."""
         self.db.create_all()
 
@@ -4,13 +4,36 @@
 # Author: Ling Thio <ling.thio@gmail.com>
 # Copyright (c) 2013 Ling Thio
 
-from .db_adapters import PynamoDbAdapter, DynamoDbAdapter, MongoDbAdapter, SQLDbAdapter
+import time
+
+from flask import g, has_app_context, has_request_context, request, session
+
+from . import signals
+from .db_adapters import PynamoDbAdapter, DynamoDbAdapter, MongoDbAdapter, SQLDbAdapter, ShardedDbAdapter
+from .lru_cache import LRUCache
 from flask_user import current_user, ConfigError
 
 class DBManager(object):
     """Manage DB objects."""
 
-    def __init__(self, app, db, UserClass, UserEmailClass=None, UserInvitationClass=None, RoleClass=None):
+    # Fields that may have a normalized shadow field, like ``username_normalized``,
+    # for case insensitive finds with USER_IFIND_MODE='normalized'.
+    NORMALIZED_FIELDS = ('username', 'email')
+
+    # Default User properties of iter_users(), if the User class has them
+    EXPORT_FIELDS = ('id', 'username', 'email', 'email_confirmed_at', 'active', 'first_name', 'last_name')
+
+    # User properties that Flask-User reads for every request, if the User class has them,
+    # including the username and email that flask_user_layout.html renders.
+    # get_user_by_id() retrieves only these, where the DbAdapter loads other fields on access.
+    SESSION_USER_FIELDS = ('id', 'password', 'session_version', 'active', 'email_confirmed_at',
+                           'username', 'email')
+
+    # Flask session key of the time until which the user session reads from the primary database
+    READ_PRIMARY_SESSION_KEY = '_flask_user_read_primary_until'
+
+    def __init__(self, app, db, UserClass, UserEmailClass=None, UserInvitationClass=None, RoleClass=None,
+                 read_replica_db=None):
         """Initialize the appropriate DbAdapter, based on the ``db`` parameter type.
 
         Args:
@@ -20,6 +43,8 @@ class DBManager(object):
             UserEmailClass: Optional UserEmail class for multiple-emails-per-user feature.
             UserInvitationClass: Optional UserInvitation class for user-invitation feature.
             RoleClass: For testing purposes only.
+            read_replica_db: Optional SQLAlchemy read replica: a ``scoped_session`` bound to the replica,
+                or an object with such a ``session`` attribute.
         """
         self.app = app
         self.db = db
@@ -77,18 +102,52 @@ class DBManager(object):
                 'No Flask-SQLAlchemy, Flask-MongoEngine or Flask-Flywheel installed and no Pynamo Model in use.'\
                 ' You must install one of these Flask extensions.')
 
+        # Setup the optional read replica DbAdapter
+        self.read_db_adapter = None
+        if read_replica_db is not None:
+            if not isinstance(self.db_adapter, SQLDbAdapter):
+                raise ConfigError('UserManager(read_replica_db=...) is only supported with Flask-SQLAlchemy.')
+            if not hasattr(read_replica_db, 'session'):
+                read_replica_db = _SessionDb(read_replica_db)
+            self.read_db_adapter = SQLDbAdapter(app, read_replica_db)
+
+            # Release the replica session at the end of each request
+            @app.teardown_appcontext
+            def remove_read_replica_session(exception=None):
+                if hasattr(read_replica_db.session, 'remove'):
+                    read_replica_db.session.remove()
+
+        # Setup the optional process-wide user cache.
+        # Any object with LRUCache's get(), set(), delete() and clear() methods can be
+        # assigned to ``user_cache``, to use a different cache backend.
+        self.user_cache = None
+        if self.user_manager.USER_USER_CACHE_SIZE:
+            self.user_cache = LRUCache(self.user_manager.USER_USER_CACHE_SIZE, self.user_manager.USER_USER_CACHE_TTL)
+
+        # Remove cached users when Flask-User changes them. The signals are sent after the changes are committed.
+        def invalidate_cached_user(sender, user, **extra):
+            if self.user_cache is not None:
+                self.user_cache.delete(str(user.id))
+
+        try:
+            for signal in (signals.user_changed_password, signals.user_changed_username,
+                           signals.user_confirmed_email, signals.user_registered, signals.user_reset_password):
+                signal.connect(invalidate_cached_user, app, weak=False)
+        except RuntimeError:
+            # Blinker is not installed. Cached users are still invalidated by save_object().
+            pass
+
 
     def add_user_role(self, user, role_name):
         """Associate a role name with a user."""
+        self._record_write()
+        self._invalidate_cached_user(user)
 
         # For SQL: user.roles is list of pointers to Role objects
-        if isinstance(self.db_adapter, SQLDbAdapter):
+        if self._is_sql_db_adapter():
             # user.roles is a list of Role IDs
-            # Get or add role
-            role = self.db_adapter.find_first_object(self.RoleClass, name=role_name)
-            if not role:
-                role = self.RoleClass(name=role_name)
-                self.db_adapter.add_object(role)
+            # Get or add role, on the shard of the user
+            role = self._get_or_add_role(self._get_user_db_adapter(user), role_name)
             user.roles.append(role)
 
         # For others: user.roles is a list of role names
@@ -101,11 +160,85 @@ class DBManager(object):
         user = self.UserClass(**kwargs)
         if hasattr(user, 'active'):
             user.active = True
+        self._update_normalized_fields(user)
+        self._record_write()
         self.db_adapter.add_object(user)
         return user
 
+    def add_users(self, user_records):
+        """Add User objects in bulk, with their primary UserEmail objects and their roles.
+
+        Args:
+            user_records(list): A list of dicts with User properties.
+                A ``'roles'`` item holds a list of role names.
+                With a UserEmailClass, the ``'email'`` and ``'email_confirmed_at'`` items
+                are stored in a primary UserEmail object.
+        Returns:
+            The list of new User IDs, in the order of ``user_records``.
+
+        Users, UserEmails and role associations are each added with one bulk write.
+        The caller is responsible for calling ``commit()``.
+        """
+        is_sql = self._is_sql_db_adapter()
+        user_mappings = []
+        user_email_mappings = []
+        user_role_names = []
+        for user_record in user_records:
+            user_mapping = dict(user_record)
+            role_names = user_mapping.pop('roles', [])
+
+            # Move email properties to the primary UserEmail
+            if self.UserEmailClass:
+                user_email_mapping = dict((key, user_mapping.pop(key))
+                                          for key in ('email', 'email_confirmed_at') if key in user_mapping)
+                user_email_mappings.append(user_email_mapping)
+
+            # For SQL: roles are associated once the users have IDs
+            # For others: user.roles is a list of role names
+            if is_sql:
+                user_role_names.append(role_names)
+            elif role_names:
+                user_mapping['roles'] = list(role_names)
+
+            if hasattr(self.UserClass, 'active'):
+                user_mapping.setdefault('active', True)
+            self._update_normalized_mapping(self.UserClass, user_mapping)
+            user_mappings.append(user_mapping)
+
+        self._record_write()
+        user_ids = self.db_adapter.add_objects(self.UserClass, user_mappings)
+
+        # Add the primary UserEmails
+        if self.UserEmailClass:
+            primary_user_email_mappings = []
+            for user_id, user_email_mapping in zip(user_ids, user_email_mappings):
+                if user_email_mapping.get('email'):
+                    user_email_mapping.update(user_id=user_id, is_primary=True)
+                    self._update_normalized_mapping(self.UserEmailClass, user_email_mapping)
+                    primary_user_email_mappings.append(user_email_mapping)
+            self.db_adapter.add_objects(self.UserEmailClass, primary_user_email_mappings)
+
+        # For SQL: get or add roles, on the shard of each user, and associate them with the users
+        if is_sql and any(user_role_names):
+            role_ids = {}
+            id_pairs = []
+            for user_id, role_names in zip(user_ids, user_role_names):
+                db_adapter = self._get_user_db_adapter(user_id)
+                for role_name in role_names:
+                    key = (id(db_adapter), role_name)
+                    if key not in role_ids:
+                        role = db_adapter.find_first_object(self.RoleClass, name=role_name)
+                        role_ids[key] = role.id if role else \
+                            db_adapter.add_objects(self.RoleClass, [dict(name=role_name)])[0]
+                    id_pairs.append((user_id, role_ids[key]))
+            self.db_adapter.add_associations(self.UserClass, 'roles', id_pairs)
+
+        return user_ids
+
     def add_user_email(self, user, **kwargs):
         """Add a UserEmail object, with properties specified in ``**kwargs``."""
+        self._record_write()
+
         # If User and UserEmail are separate classes
         if self.UserEmailClass:
             user_email = self.UserEmailClass(user=user, **kwargs)
@@ -117,74 +250,184 @@ class DBManager(object):
                 setattr(user, key, value)
             user_email = user
 
+        self._update_normalized_fields(user_email)
         return user_email
 
     def add_user_invitation(self, **kwargs):
         """Add a UserInvitation object, with properties specified in ``**kwargs``."""
+        self._record_write()
         user_invitation = self.UserInvitationClass(**kwargs)
         self.db_adapter.add_object(user_invitation)
         return user_invitation
 
+    def backfill_normalized_fields(self, batch_size=1000):
+        """Set the normalized shadow fields, like ``username_normalized`` and ``email_normalized``,
+        of all existing User and UserEmail objects.
+
+        Run this once after adding normalized shadow fields to the data-models,
+        and before setting USER_IFIND_MODE='normalized'.
+        Objects are retrieved, saved and committed in batches of ``batch_size`` objects.
+
+        Returns the number of updated objects.
+        """
+        num_updated = 0
+        for ObjectClass in (self.UserClass, self.UserEmailClass):
+            if not ObjectClass or not self._get_normalized_fields(ObjectClass):
+                continue
+            for objects in self.db_adapter.find_objects_in_batches(ObjectClass, batch_size):
+                for object in objects:
+                    if self._update_normalized_fields(object):
+                        self.db_adapter.save_object(object)
+                        num_updated += 1
+                self.db_adapter.commit()
+        self._record_write()
+        return num_updated
+
+    def bump_session_version(self, user):
+        """Increment ``user.session_version`` to invalidate all user session tokens of this user.
+
+        Does nothing if the User data-model has no ``session_version`` field,
+        in which case user session tokens are invalidated by password changes only.
+        The caller is responsible for saving the User object.
+        """
+        if hasattr(user, 'session_version'):
+            user.session_version = (user.session_version or 0) + 1
+
     def commit(self):
-        """Commit session-based objects to the database."""
+        """Commit session-based objects to the database,
+        and then remove the saved and deleted User objects from the user cache."""
+        self._record_write()
         self.db_adapter.commit()
+        for id in self._pop_invalidated_user_ids():
+            if self.user_cache is not None:
+                self.user_cache.delete(id)
+
+    def rollback(self):
+        """Discard uncommitted changes to session-based objects."""
+        self._clear_identity_map()
+        self._pop_invalidated_user_ids()
+        self.db_adapter.rollback()
 
     def delete_object(self, object):
         """Delete and object."""
+        self._record_write()
+        self._invalidate_cached_user(object)
         self.db_adapter.delete_object(object)
 
     def find_user_by_username(self, username):
         """Find a User object by username."""
-        return self.db_adapter.ifind_first_object(self.UserClass, username=username)
+        return self._memoize(('username', username),
+            lambda: self._attach(self._get_read_adapter().ifind_first_object(self.UserClass, username=username)))
+
+    def find_user_by_username_or_email(self, username_or_email):
+        """Find a User object by username, or else by email address.
+
+        | Returns a (user, user_email, matched_field_name) tuple,
+            where matched_field_name is 'username' or 'email'.
+        | Returns (None, None, None) if no user matches.
+
+        Username and email are matched in one database query, where the DbAdapter supports it.
+        """
+        return self._memoize(('username_or_email', username_or_email),
+            lambda: self._find_user_by_username_or_email(username_or_email))
+
+    def _find_user_by_username_or_email(self, username_or_email):
+        # Emails are stored in a separate UserEmail class: a username match is preferred
+        if self.UserEmailClass:
+            user, user_email, matched_field_name = self._get_read_adapter().ifind_first_object_or_related(
+                self.UserClass, 'username', self.UserEmailClass, 'user', 'email', username_or_email)
+            return (self._attach(user), self._attach(user_email), matched_field_name)
+
+        user, matched_field_name = self._get_read_adapter().ifind_first_object_by_fields(
+            self.UserClass, ['username', 'email'], username_or_email)
+        user = self._attach(user)
+        if not user:
+            return (None, None, None)
+        return (user, user if matched_field_name=='email' else None, matched_field_name)
 
     def find_user_emails(self, user):
         """Find all the UserEmail object belonging to a user."""
-        user_emails = self.db_adapter.find_objects(self.UserEmailClass, user_id=user.id)
-        return user_emails
+        user_emails = self._get_read_adapter().find_objects(self.UserEmailClass, user_id=user.id)
+        return [self._attach(user_email) for user_email in user_emails]
 
     def get_primary_user_email_object(self, user):
         """Retrieve the email from User object or the primary UserEmail object (if multiple emails
         per user are enabled)."""
         if self.UserEmailClass:
-            user_email = self.db_adapter.find_first_object(
+            user_email = self._get_read_adapter().find_first_object(
                 self.UserEmailClass,
                 user_id=user.id,
                 is_primary=True)
-            return user_email
+            return self._attach(user_email)
         else:
             return user
 
     def get_user_and_user_email_by_id(self, user_or_user_email_id):
         """Retrieve the User and UserEmail object by ID."""
         if self.UserEmailClass:
-            user_email = self.db_adapter.get_object(self.UserEmailClass, user_or_user_email_id)
+            # Retrieve the UserEmail and its User in one database round-trip, where supported
+            user_email = self._attach(self._get_read_adapter().get_object_with_related(
+                self.UserEmailClass, user_or_user_email_id, 'user'))
             user = user_email.user if user_email else None
         else:
-            user = self.db_adapter.get_object(self.UserClass, user_or_user_email_id)
+            user = self._attach(self._get_read_adapter().get_object(self.UserClass, user_or_user_email_id))
             user_email = user
         return (user, user_email)
 
     def get_user_and_user_email_by_email(self, email):
         """Retrieve the User and UserEmail object by email address."""
+        return self._memoize(('email', email), lambda: self._get_user_and_user_email_by_email(email))
+
+    def _get_user_and_user_email_by_email(self, email):
         if self.UserEmailClass:
-            user_email = self.db_adapter.ifind_first_object(self.UserEmailClass, email=email)
+            # Retrieve the UserEmail and its User in one database round-trip, where supported
+            user_email = self._attach(self._get_read_adapter().ifind_first_object_with_related(
+                self.UserEmailClass, 'user', email=email))
             user = user_email.user if user_email else None
         else:
-            user = self.db_adapter.ifind_first_object(self.UserClass, email=email)
+            user = self._attach(self._get_read_adapter().ifind_first_object(self.UserClass, email=email))
             user_email = user
         return (user, user_email)
 
-    def get_user_by_id(self, id):
-        """Retrieve a User object by ID."""
-        return self.db_adapter.get_object(self.UserClass, id=id)
+    def get_user_by_id(self, id, read_primary=False):
+        """Retrieve a User object by ID.
+
+        With USER_USER_CACHE_SIZE, User objects are restored from a snapshot in the user cache.
+        With ``read_primary``, the User is read from the primary database, not from the read replica.
+        User session tokens are verified this way: a password change or ``logout_user_everywhere()``
+        must end other user sessions without waiting for the replica to catch up.
+        With a read replica, ``read_primary`` lookups bypass the user cache, which may hold users read from the replica.
+        """
+        return self._memoize(('id', id, read_primary), lambda: self._get_user_by_id(id, read_primary))
+
+    def _get_user_by_id(self, id, read_primary=False):
+        # Retrieve only the session user fields, if other fields are loaded on access
+        fields = None
+        if self.db_adapter.DEFERS_UNLOADED_FIELDS:
+            fields = [field_name for field_name in self.SESSION_USER_FIELDS if hasattr(self.UserClass, field_name)]
+        db_adapter = self.db_adapter if read_primary else self._get_read_adapter()
+
+        # Users with uncommitted changes are neither read from nor written to the user cache
+        if self.user_cache is None or str(id) in self._get_invalidated_user_ids():
+            return self._attach(db_adapter.get_object(self.UserClass, id=id, load_fields=fields))
+
+        if not (read_primary and self.read_db_adapter is not None):
+            snapshot = self.user_cache.get(str(id))
+            if snapshot is not None:
+                return self.db_adapter.restore_object(snapshot)
+
+        user = self._attach(db_adapter.get_object(self.UserClass, id=id, load_fields=fields))
+        if user is not None:
+            self.user_cache.set(str(id), self.db_adapter.snapshot_object(user))
+        return user
 
     def get_user_email_by_id(self, id):
         """Retrieve a UserEmail object by ID."""
-        return self.db_adapter.get_object(self.UserEmailClass, id)
+        return self._attach(self._get_read_adapter().get_object(self.UserEmailClass, id))
 
     def get_user_invitation_by_id(self, id):
         """Retrieve a UserInvitation object by ID."""
-        return self.db_adapter.get_object(self.UserInvitationClass, id=id)
+        return self._attach(self._get_read_adapter().get_object(self.UserInvitationClass, id=id))
 
     def get_user_roles(self, user):
         """Retrieve a list of user role names.
@@ -195,7 +438,7 @@ class DBManager(object):
         """
 
         # For SQL: user.roles is list of pointers to Role objects
-        if isinstance(self.db_adapter, SQLDbAdapter):
+        if self._is_sql_db_adapter():
             # user.roles is a list of Role IDs
             user_roles = [role.name for role in user.roles]
 
@@ -207,12 +450,85 @@ class DBManager(object):
 
         return user_roles
 
+    def get_user_role_set(self, user):
+        """Retrieve a frozenset of user role names, cached for the duration of the request."""
+        # The cached set is keyed by the identity of the user and of its list of roles,
+        # and holds on to both, so that their ids can not be reused during the request.
+        # Assigning a new list to user.roles, or calling add_user_role(), invalidates the set.
+        roles = user.roles
+        cached_user, cached_roles, role_set = self._memoize(
+            ('roles', id(user), id(roles)),
+            lambda: (user, roles, frozenset(self.get_user_roles(user))))
+        return role_set
+
+    def get_user_export_fields(self, fields=None):
+        """Return the list of fields of the dicts produced by ``iter_users(fields=fields)``."""
+        if fields is not None:
+            return list(fields)
+        fields = [field_name for field_name in self.EXPORT_FIELDS if hasattr(self.UserClass, field_name)]
+        if self.UserEmailClass:
+            fields.append('emails')
+        if hasattr(self.UserClass, 'roles'):
+            fields.append('roles')
+        return fields
+
+    def iter_users(self, batch_size=1000, fields=None, since_id=None):
+        """Iterate over all users, as dicts of User properties.
+
+        Args:
+            batch_size(int): The number of users retrieved per database query.
+            fields(list): The User properties to include. Defaults to the ``EXPORT_FIELDS`` of the User class,
+                plus ``'emails'`` and ``'roles'``. See ``get_user_export_fields()``.
+                ``'roles'`` holds a list of role names. ``'emails'`` holds a list of dicts with the
+                ``'email'``, ``'email_confirmed_at'`` and ``'is_primary'`` properties of UserEmail objects.
+            since_id: Only include users with an ID greater than ``since_id``,
+                to resume an export or to synchronize new users.
+
+        Users are retrieved in batches, ordered by ID where the database supports it,
+        and are not kept in memory, so that memory use does not grow with the number of users.
+        """
+        fields = self.get_user_export_fields(fields)
+
+        # Load roles and emails along with each batch, where supported
+        related_names = []
+        if 'roles' in fields and self._is_sql_db_adapter():
+            related_names.append('roles')
+        load_user_emails = 'emails' in fields and hasattr(self.UserClass, 'user_emails')
+        if load_user_emails and self._is_sql_db_adapter():
+            related_names.append('user_emails')
+
+        for users in self._get_read_adapter().find_objects_in_batches(
+                self.UserClass, batch_size, since_id=since_id, related_names=related_names):
+            for user in users:
+                user_dict = {}
+                for field_name in fields:
+                    if field_name == 'roles':
+                        user_dict['roles'] = list(self.get_user_roles(user))
+                    elif field_name == 'emails':
+                        user_emails = user.user_emails if load_user_emails else self.find_user_emails(user)
+                        user_dict['emails'] = [
+                            dict(email=user_email.email,
+                                 email_confirmed_at=user_email.email_confirmed_at,
+                                 is_primary=user_email.is_primary)
+                            for user_email in user_emails]
+                    else:
+                        user_dict[field_name] = getattr(user, field_name)
+                yield user_dict
+
     def save_object(self, object):
         """Save an object to the database."""
+        self._record_write()
+        self._invalidate_cached_user(object)
+        self._update_normalized_fields(object)
         self.db_adapter.save_object(object)
 
     def save_user_and_user_email(self, user, user_email):
         """Save the User and UserEmail object."""
+        self._record_write()
+        self._invalidate_cached_user(user)
+        self._update_normalized_fields(user)
+        if self.UserEmailClass:
+            self._update_normalized_fields(user_email)
         if self.UserEmailClass:
             self.db_adapter.save_object(user_email)
         self.db_adapter.save_object(user)
@@ -223,16 +539,12 @@ class DBManager(object):
         if not self.user_manager.USER_ENABLE_EMAIL: return True
         if not self.user_manager.USER_ENABLE_CONFIRM_EMAIL: return True
 
-        db_adapter = self.db_adapter
+        db_adapter = self._get_read_adapter()
 
-        # Handle multiple emails per user: Find at least one confirmed email
+        # Handle multiple emails per user: Probe for at least one confirmed email
         if self.UserEmailClass:
-            has_confirmed_email = False
-            user_emails = db_adapter.find_objects(self.UserEmailClass, user_id=user.id)
-            for user_email in user_emails:
-                if user_email.email_confirmed_at:
-                    has_confirmed_email = True
-                    break
+            has_confirmed_email = db_adapter.exists_object(
+                self.UserEmailClass, user_id=user.id, email_confirmed_at__ne=None)
 
         # Handle single email per user
         else:
@@ -257,6 +569,132 @@ class DBManager(object):
         return self.find_user_by_username(new_username) == None
 
 
+    # Request-scoped identity map
+    # ---------------------------
+    # User lookups are memoized in ``flask.g`` for the duration of a request,
+    # so that forms and views that look up the same user do not repeat the same queries.
+    # Methods that add, save or delete objects clear the identity map.
+
+    def _memoize(self, key, lookup):
+        # Return the memoized result of lookup() for key. Outside of a request, call lookup().
+        if not has_request_context():
+            return lookup()
+        # flask.g may outlive a request when an app context was pushed explicitly:
+        # the identity map is tagged with the request that it belongs to.
+        current_request = request._get_current_object()
+        identity_map_request, identity_map = getattr(g, '_flask_user_identity_map', None) or (None, None)
+        if identity_map_request is not current_request:
+            identity_map = {}
+            g._flask_user_identity_map = (current_request, identity_map)
+        if key not in identity_map:
+            identity_map[key] = lookup()
+        return identity_map[key]
+
+    def _clear_identity_map(self):
+        if has_request_context():
+            g._flask_user_identity_map = None
+
+    def _record_write(self):
+        # Called before adding, saving or deleting objects.
+        # Clears the identity map and, with a read replica, reads from the primary database
+        # for the rest of the request, and for USER_READ_REPLICA_LAG seconds in this user session.
+        self._clear_identity_map()
+        if self.read_db_adapter is not None and has_app_context():
+            g._flask_user_read_primary = True
+            if has_request_context():
+                session[self.READ_PRIMARY_SESSION_KEY] = time.time() + self.user_manager.USER_READ_REPLICA_LAG
+
+
+    # Read replica routing
+    # --------------------
+    # Read-only lookups go to the read replica, unless the request or the user session
+    # recently wrote to the primary database, so that users always read their own writes.
+
+    def _get_read_adapter(self):
+        # Returns the DbAdapter for read-only lookups
+        if self.read_db_adapter is None or not has_app_context() or g.get('_flask_user_read_primary'):
+            return self.db_adapter
+        if has_request_context() and session.get(self.READ_PRIMARY_SESSION_KEY, 0) > time.time():
+            return self.db_adapter
+        return self.read_db_adapter
+
+    def _attach(self, object):
+        # Attach an object read from the read replica to the primary database session,
+        # so that changes to it are saved by commit()
+        if self.read_db_adapter is None:
+            return object
+        return self.db_adapter.attach_object(object)
+
+
+    def _get_user_db_adapter(self, user_or_id):
+        # Returns the DbAdapter of the shard of a user, or of a user ID, if sharded, or else the DbAdapter
+        if isinstance(self.db_adapter, ShardedDbAdapter):
+            return self.db_adapter.get_db_adapter(user_or_id)
+        return self.db_adapter
+
+    def _get_or_add_role(self, db_adapter, role_name):
+        # Returns the Role named 'role_name' of 'db_adapter', after adding it if it does not exist
+        role = db_adapter.find_first_object(self.RoleClass, name=role_name)
+        if not role:
+            role = self.RoleClass(name=role_name)
+            db_adapter.add_object(role)
+        return role
+
+    def _is_sql_db_adapter(self):
+        # Returns True if objects are SQLAlchemy objects, on one database or on SQL shards
+        db_adapter = self.db_adapter
+        if isinstance(db_adapter, ShardedDbAdapter):
+            db_adapter = next(iter(db_adapter.db_adapters.values()))
+        return isinstance(db_adapter, SQLDbAdapter)
+
+    def _get_normalized_fields(self, ObjectClass):
+        # Return the fields of ObjectClass that have a normalized shadow field
+        return [field_name for field_name in self.NORMALIZED_FIELDS
+                if hasattr(ObjectClass, field_name) and hasattr(ObjectClass, field_name+'_normalized')]
+
+    def _update_normalized_fields(self, object):
+        # Keep normalized shadow fields in sync with their fields. Returns True if any field changed.
+        changed = False
+        for field_name in self._get_normalized_fields(type(object)):
+            normalized_value = self.db_adapter.normalize_value(getattr(object, field_name))
+            if getattr(object, field_name+'_normalized') != normalized_value:
+                setattr(object, field_name+'_normalized', normalized_value)
+                changed = True
+        return changed
+
+    def _update_normalized_mapping(self, ObjectClass, mapping):
+        # Set the normalized shadow fields in a dict of field values
+        for field_name in self._get_normalized_fields(ObjectClass):
+            if field_name in mapping:
+                mapping[field_name+'_normalized'] = self.db_adapter.normalize_value(mapping[field_name])
+
+    def _invalidate_cached_user(self, object):
+        # Remove a User object from the user cache after the next commit(),
+        # so that concurrent requests can not cache the state before the commit again
+        if self.user_cache is None or not isinstance(object, self.UserClass):
+            return
+        if not has_app_context():
+            self.user_cache.delete(str(object.id))
+            return
+        invalidated_user_ids = g.get('_flask_user_invalidated_user_ids')
+        if invalidated_user_ids is None:
+            invalidated_user_ids = g._flask_user_invalidated_user_ids = set()
+        invalidated_user_ids.add(str(object.id))
+
+    def _get_invalidated_user_ids(self):
+        # Returns the IDs of the users to remove from the user cache after the next commit()
+        if not has_app_context():
+            return set()
+        return g.get('_flask_user_invalidated_user_ids') or set()
+
+    def _pop_invalidated_user_ids(self):
+        # Returns the IDs of the users to remove from the user cache after the next commit(), and empties the set
+        invalidated_user_ids = self._get_invalidated_user_ids()
+        if has_app_context():
+            g._flask_user_invalidated_user_ids = None
+        return invalidated_user_ids
+
+
     # def delete_role_name(self, role_name):
     #     if isinstance(self.db_adapter, SQLDbAdapter):
     #         role = self.db_adapter.find_first_object(self.user_manager.db_manager.RoleClass, name=role_name)
@@ -269,7 +707,7 @@ class DBManager(object):
 
     def create_all_tables(self):
         """Create database tables for all known database data-models."""
-        return self.db_adapter.create_all_tables()
+        return self.db_adapter.create_all_tables(UserClass=self.UserClass, UserEmailClass=self.UserEmailClass)
 
     def drop_all_tables(self):
         """Drop all tables.
@@ -278,3 +716,8 @@ class DBManager(object):
         """
         return self.db_adapter.drop_all_tables()
 
+
+class _SessionDb(object):
+    # Presents a scoped_session as a Flask-SQLAlchemy-like object with a ``session`` attribute
+    def __init__(self, session):
+        self.session = session
@@ -5,26 +5,135 @@ such as @login_required, @roles_accepted and @roles_required and @confirmed_emai
 # Author: Ling Thio <ling.thio@gmail.com>
 # Copyright (c) 2013 Ling Thio
 
+import hashlib
 from functools import wraps
-from flask import current_app, g
+from flask import current_app, g, request, session
 from flask_login import current_user
 
+from .user_mixin import compile_role_requirements, match_role_requirements
+
+# Flask session key of the signed auth claims
+AUTH_CLAIMS_SESSION_KEY = '_flask_user_auth_claims'
+
+# Bit flags of the signed auth claims
+AUTH_CLAIMS_HAS_CONFIRMED_EMAIL = 1
+AUTH_CLAIMS_HAS_ROLES = 2
+
+
 def _is_logged_in_with_confirmed_email(user_manager):
     """| Returns True if user is logged in and has a confirmed email address.
     | Returns False otherwise.
     """
-    # User must be logged in
-    if user_manager.call_or_get(current_user.is_authenticated):
-        # Is unconfirmed email allowed for this view by @allow_unconfirmed_email?
-        unconfirmed_email_allowed = \
-            getattr(g, '_flask_user_allow_unconfirmed_email', False)
-        
-        # unconfirmed_email_allowed must be True or
-        # User must have at least one confirmed email address
-        if unconfirmed_email_allowed or user_manager.db_manager.user_has_confirmed_email(current_user):
-            return True
+    # Is unconfirmed email allowed for this view by @allow_unconfirmed_email?
+    unconfirmed_email_allowed = \
+        getattr(g, '_flask_user_allow_unconfirmed_email', False)
+
+    # User must be logged in.
+    # The user is loaded even with auth claims, so that changed session versions
+    # and revoked user session tokens take effect immediately.
+    if not user_manager.call_or_get(current_user.is_authenticated):
+        return False
+
+    # Views that allow unconfirmed email addresses do not probe for a confirmed email
+    if unconfirmed_email_allowed:
+        return True
+
+    # Use signed auth claims, if available, to avoid probing the database for a confirmed email
+    auth_claims = _get_auth_claims(user_manager)
+    if auth_claims:
+        has_confirmed_email = auth_claims[0]
+    else:
+        has_confirmed_email = user_manager.db_manager.user_has_confirmed_email(current_user)
+
+        # Issue signed auth claims for subsequent requests
+        if user_manager.USER_ENABLE_AUTH_CLAIMS:
+            _set_auth_claims(user_manager, has_confirmed_email)
+
+    # User must have at least one confirmed email address
+    return has_confirmed_email
 
-    return False
+
+def _has_roles(user_manager, compiled_requirements):
+    """| Returns True if the current user meets the requirements compiled by ``compile_role_requirements()``.
+    | Returns False otherwise.
+    """
+    # Use signed auth claims, if they hold role names, to avoid loading roles from the database
+    auth_claims = _get_auth_claims(user_manager)
+    role_names = auth_claims[1] if auth_claims else None
+    if role_names is None:
+        role_names = user_manager.db_manager.get_user_role_set(current_user._get_current_object())
+
+        # Add the role names to the auth claims
+        if auth_claims:
+            _set_auth_claims(user_manager, auth_claims[0], role_names)
+
+    return match_role_requirements(role_names, compiled_requirements)
+
+
+def _get_auth_claims(user_manager):
+    """| Returns a (has_confirmed_email, frozenset_of_role_names) tuple from the signed auth claims
+        stored in the Flask session. frozenset_of_role_names is None if the claims hold no role names.
+    | Returns None if auth claims are disabled, missing, expired,
+        or were issued for a different user session.
+    """
+    if not user_manager.USER_ENABLE_AUTH_CLAIMS:
+        return None
+
+    # Cache verified claims for the duration of the request.
+    # flask.g may outlive a request when an app context was pushed explicitly:
+    # the claims are tagged with the request that they belong to.
+    current_request = request._get_current_object()
+    claims_request, auth_claims = g.get('_flask_user_auth_claims') or (None, None)
+    if claims_request is current_request:
+        return auth_claims
+    g._flask_user_auth_claims = (current_request, None)
+
+    # Claims are bound to the Flask-Login user session token
+    user_session_hash = _get_user_session_hash()
+    claims_token = session.get(AUTH_CLAIMS_SESSION_KEY)
+    if not user_session_hash or not claims_token:
+        return None
+
+    # Verify signature and expiration
+    data_items = user_manager.token_manager.verify_token(claims_token, user_manager.USER_AUTH_CLAIMS_EXPIRATION)
+    if not data_items or len(data_items) < 2 or data_items[0] != user_session_hash:
+        return None
+
+    flags = data_items[1]
+    role_names = frozenset(data_items[2:]) if flags & AUTH_CLAIMS_HAS_ROLES else None
+    auth_claims = (bool(flags & AUTH_CLAIMS_HAS_CONFIRMED_EMAIL), role_names)
+    g._flask_user_auth_claims = (current_request, auth_claims)
+    return auth_claims
+
+
+def _set_auth_claims(user_manager, has_confirmed_email, role_names=None):
+    """Store signed auth claims -- a user session hash, the has_confirmed_email flag
+    and, if specified, the user's role names -- in the Flask session."""
+    user_session_hash = _get_user_session_hash()
+    if not user_session_hash:
+        return
+
+    flags = AUTH_CLAIMS_HAS_CONFIRMED_EMAIL if has_confirmed_email else 0
+    if role_names is not None:
+        flags |= AUTH_CLAIMS_HAS_ROLES
+    try:
+        claims_token = user_manager.token_manager.generate_token(
+            user_session_hash, flags, *(role_names or ()))
+    except ValueError:
+        # Role names that can not be encoded with the 'text' USER_TOKEN_CODEC: keep using the database
+        return
+    session[AUTH_CLAIMS_SESSION_KEY] = claims_token
+    g._flask_user_auth_claims = (request._get_current_object(),
+                                 (has_confirmed_email, frozenset(role_names) if role_names is not None else None))
+
+
+def _get_user_session_hash():
+    # Returns a short hash of the Flask-Login user session token,
+    # or None if no user is logged in. (Flask-Login 0.5+ uses '_user_id', older versions use 'user_id')
+    user_token = session.get('_user_id') or session.get('user_id')
+    if not user_token:
+        return None
+    return hashlib.sha256(user_token.encode()).hexdigest()[:16]
 
 
 def login_required(view_function):
@@ -79,6 +188,10 @@ def roles_accepted(*role_names):
     # convert the list to a list containing that list.
     # Because roles_required(a, b) requires A AND B
     # while roles_required([a, b]) requires A OR B
+    # NB: roles_required compiles role_names:     ('A', 'B') --> ('A', 'B')
+    # But: roles_accepted must compile (role_names,): ('A', 'B') --> (('A', 'B'),)
+    compiled_requirements = compile_role_requirements(role_names)
+
     def wrapper(view_function):
 
         @wraps(view_function)    # Tells debuggers that is is a function wrapper
@@ -92,9 +205,7 @@ def roles_accepted(*role_names):
                 return user_manager.unauthenticated_view()
 
             # User must have the required roles
-            # NB: roles_required would call has_roles(*role_names): ('A', 'B') --> ('A', 'B')
-            # But: roles_accepted must call has_roles(role_names):  ('A', 'B') --< (('A', 'B'),)
-            if not current_user.has_roles(role_names):
+            if not _has_roles(user_manager, compiled_requirements):
                 # Redirect to the unauthorized page
                 return user_manager.unauthorized_view()
 
@@ -122,6 +233,9 @@ def roles_required(*role_names):
     | Calls unauthorized_view() when the user does not have the required roles.
     | Calls the decorated view otherwise.
     """
+    # Compile the role requirements once, when the view is decorated
+    compiled_requirements = compile_role_requirements(*role_names)
+
     def wrapper(view_function):
 
         @wraps(view_function)    # Tells debuggers that is is a function wrapper
@@ -135,7 +249,7 @@ def roles_required(*role_names):
                 return user_manager.unauthenticated_view()
 
             # User must have the required roles
-            if not current_user.has_roles(*role_names):
+            if not _has_roles(user_manager, compiled_requirements):
                 # Redirect to the unauthorized page
                 return user_manager.unauthorized_view()
 
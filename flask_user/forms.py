@@ -185,14 +185,15 @@ class LoginForm(FlaskForm):
         # Find user by username and/or email
         user = None
         user_email = None
-        if user_manager.USER_ENABLE_USERNAME:
+        if user_manager.USER_ENABLE_USERNAME and user_manager.USER_ENABLE_EMAIL:
+            # Find user by username or by email address (username field)
+            user, user_email, matched_field_name = \
+                user_manager.db_manager.find_user_by_username_or_email(self.username.data)
+
+        elif user_manager.USER_ENABLE_USERNAME:
             # Find user by username
             user = user_manager.db_manager.find_user_by_username(self.username.data)
 
-            # Find user by email address (username field)
-            if not user and user_manager.USER_ENABLE_EMAIL:
-                user, user_email = user_manager.db_manager.get_user_and_user_email_by_email(self.username.data)
-
         else:
             # Find user by email address (email field)
             user, user_email = user_manager.db_manager.get_user_and_user_email_by_email(self.email.data)
@@ -0,0 +1,83 @@
+"""This module implements a small, thread-safe LRU cache with a time-to-live for Flask-User.
+"""
+
+# Author: Ling Thio <ling.thio@gmail.com>
+# Copyright (c) 2013 Ling Thio
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A size-bounded Least-Recently-Used cache whose entries expire after ``ttl`` seconds.
+
+    The cache is process-wide: it is shared by all threads of a worker process,
+    but it is not shared across worker processes.
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        Args:
+            max_size(int): The maximum number of entries. The least recently used entry
+                is discarded when a new entry would exceed this number.
+            ttl(int): Time-to-live of an entry, in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """| Returns the value stored under ``key``.
+        | Returns ``default`` if ``key`` is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.time():
+                    # Mark as most recently used
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+
+                # Discard expired entry
+                del self._entries[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Store ``value`` under ``key`` for ``ttl`` seconds (defaults to the cache's ``ttl``)."""
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, value)
+
+            # Discard least recently used entries
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove ``key`` from the cache, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """Remove all entries for which ``predicate(key, value)`` returns True."""
+        with self._lock:
+            keys = [key for key, (expires_at, value) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -11,6 +11,16 @@ from flask import current_app
 from passlib.context import CryptContext
 
 
+# Worker processes of hash_passwords() keep one CryptContext per configuration string
+_worker_crypt_contexts = {}
+
+def _hash_password_in_worker(crypt_context_config, password):
+    crypt_context = _worker_crypt_contexts.get(crypt_context_config)
+    if crypt_context is None:
+        crypt_context = _worker_crypt_contexts[crypt_context_config] = CryptContext.from_string(crypt_context_config)
+    return crypt_context.hash(password)
+
+
 class PasswordManager(object):
     """Hash and verify user passwords using passlib """
 
@@ -51,6 +61,35 @@ class PasswordManager(object):
 
         return password_hash
 
+    def hash_passwords(self, passwords, executor=None):
+        """Hash a list of plaintext ``passwords``.
+
+        Args:
+            passwords(list): Plaintext passwords.
+            executor: Optional ``concurrent.futures`` executor, typically a ``ProcessPoolExecutor``,
+                to hash passwords in parallel. Password hashes are CPU-bound by design.
+        Returns:
+            A list with a hashed password for each password, in the same order.
+            Passwords that fail to hash have the exception instance in their place,
+            so that one bad password does not fail the whole list.
+        """
+        results = []
+        if executor is None:
+            for password in passwords:
+                try:
+                    results.append(self.password_crypt_context.hash(password))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        # Worker processes rebuild the CryptContext from its configuration string
+        crypt_context_config = self.password_crypt_context.to_string()
+        futures = [executor.submit(_hash_password_in_worker, crypt_context_config, password) for password in passwords]
+        for future in futures:
+            error = future.exception()
+            results.append(error if error is not None else future.result())
+        return results
+
 
     def verify_password(self, password, password_hash):
         """Verify plaintext ``password`` against ``hashed password``.
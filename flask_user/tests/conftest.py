@@ -1,9 +1,13 @@
 import os
+import sys
 import pytest
 
 from flask_user.tests.tst_app import app as the_app, init_app
 from flask_user.tests.tst_utils import TstClient
 
+# async/await requires Python 3.5+
+collect_ignore = ['test_async_support.py'] if sys.version_info < (3, 5) else []
+
 @pytest.fixture(scope='session')
 def app(request):
     test_config = dict(
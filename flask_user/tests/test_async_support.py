@@ -0,0 +1,182 @@
+import asyncio
+
+import pytest
+from flask import current_app, g, session
+from flask_login import current_user
+
+from flask_user import async_support
+from flask_user.async_support import get_user_by_token_async, login_required_async, \
+    roles_accepted_async, roles_required_async, user_has_confirmed_email_async
+from flask_user.db_adapters.async_db_adapter_interface import AsyncDbAdapterInterface
+from flask_user.db_adapters.async_mongo_db_adapter import AsyncMongoDbAdapter
+from flask_user.db_adapters.async_sql_db_adapter import AsyncSQLDbAdapter
+
+from .utils import utils_prepare_user
+
+
+class SyncAsyncDbAdapter(AsyncDbAdapterInterface):
+    """Runs the synchronous DbAdapter of the test app, so that no async driver is needed."""
+
+    async def get_object(self, ObjectClass, id):
+        return self.user_manager.db_manager.db_adapter.get_object(ObjectClass, id)
+
+    async def exists_object(self, ObjectClass, **kwargs):
+        return self.user_manager.db_manager.db_adapter.exists_object(ObjectClass, **kwargs)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_support(app):
+    um = current_app.user_manager
+    user = utils_prepare_user(app)
+    um.async_db_adapter = SyncAsyncDbAdapter(app, app.db)
+
+    @login_required_async
+    async def login_required_view():
+        return 'view'
+
+    @roles_accepted_async('A', 'B')
+    def roles_accepted_view():      # Sync views can be decorated too
+        return 'view'
+
+    @roles_required_async('A', 'B')
+    async def roles_required_view():
+        return 'view'
+
+    try:
+        user_token = user.get_id()
+        assert run(get_user_by_token_async(user_token)) is user
+        assert run(get_user_by_token_async('invalid-token')) is None
+
+        with current_app.test_request_context():
+            assert run(login_required_view()) != 'view'
+
+        with current_app.test_request_context():
+            session['_user_id'] = session['user_id'] = user_token
+            user.roles = []
+            # current_user is the user loaded by the AsyncDbAdapter, without synchronous I/O
+            um.db_manager.get_user_by_id = None
+            try:
+                assert run(login_required_view()) == 'view'
+                assert current_user._get_current_object() is user
+            finally:
+                del um.db_manager.get_user_by_id
+            assert run(roles_accepted_view()) != 'view'
+
+        with current_app.test_request_context():
+            session['_user_id'] = session['user_id'] = user_token
+            user.roles = [um.db_manager.RoleClass(name='A')]
+            assert run(roles_accepted_view()) == 'view'
+            assert run(roles_required_view()) != 'view'
+
+        # Views that allow unconfirmed email addresses do not probe for a confirmed email
+        with current_app.test_request_context():
+            session['_user_id'] = session['user_id'] = user_token
+            g._flask_user_allow_unconfirmed_email = True
+            async_support.user_has_confirmed_email_async = None
+            try:
+                assert run(login_required_view()) == 'view'
+            finally:
+                async_support.user_has_confirmed_email_async = user_has_confirmed_email_async
+    finally:
+        user.roles = []
+        um.async_db_adapter = None
+
+
+class StubAsyncSession(object):
+    """Records the calls of AsyncSQLDbAdapter to an SQLAlchemy AsyncSession."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.calls = []
+
+    def add(self, object):
+        self.calls.append(('add', object))
+
+    async def commit(self):
+        self.calls.append(('commit',))
+
+    async def get(self, ObjectClass, id):
+        self.calls.append(('get', ObjectClass, id))
+        return self.objects.get(id)
+
+    async def refresh(self, object, attribute_names):
+        self.calls.append(('refresh', object, attribute_names))
+
+
+def test_async_sql_db_adapter(app):
+    um = current_app.user_manager
+    User = um.db_manager.UserClass
+    user = User(id=1, username='async')
+    async_session = StubAsyncSession({1: user})
+    async_db_adapter = AsyncSQLDbAdapter(app, async_session)
+
+    run(async_db_adapter.add_object(user))
+    run(async_db_adapter.commit())
+    assert run(async_db_adapter.get_object(User, 1)) is user
+    assert run(async_db_adapter.get_object(User, 2)) is None
+    assert async_session.calls[:3] == [('add', user), ('commit',), ('get', User, 1)]
+
+    # Unloaded relationships are loaded with refresh(), loaded relationships are not
+    run(async_db_adapter.load_related(user, 'roles'))
+    assert async_session.calls[-1] == ('refresh', user, ['roles'])
+    user.roles = []
+    del async_session.calls[:]
+    run(async_db_adapter.load_related(user, 'roles'))
+    assert async_session.calls == []
+
+    with pytest.raises(KeyError):
+        async_db_adapter._get_field(User, 'unknown')
+
+
+class StubMotorCollection(object):
+    """Records the filters of AsyncMongoDbAdapter queries to a Motor collection."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.calls = []
+
+    async def find_one(self, filter, projection=None):
+        self.calls.append(('find_one', filter, projection))
+        for document in self.documents:
+            if all(document.get(name)==value for name, value in filter.items() if not isinstance(value, dict)):
+                return document
+        return None
+
+    async def insert_one(self, document):
+        self.calls.append(('insert_one', document))
+        self.documents.append(dict(document, _id='new-id'))
+        return type('InsertOneResult', (object,), dict(inserted_id='new-id'))
+
+
+class AsyncMongoUser(object):
+    __collection__ = 'async_users'
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_async_mongo_db_adapter(app):
+    ObjectId = pytest.importorskip('bson').ObjectId
+    user_id = ObjectId()
+    collection = StubMotorCollection([dict(_id=user_id, username='async')])
+    async_db_adapter = AsyncMongoDbAdapter(app, {'async_users': collection})
+
+    # IDs decrypted from tokens are strings
+    user = run(async_db_adapter.get_object(AsyncMongoUser, str(user_id)))
+    assert (user.id, user.username) == (user_id, 'async')
+    assert collection.calls[-1] == ('find_one', {'_id': user_id}, None)
+
+    assert run(async_db_adapter.exists_object(AsyncMongoUser, _id=user_id, email_confirmed_at__ne=None))
+    assert collection.calls[-1] == ('find_one', {'_id': user_id, 'email_confirmed_at': {'$ne': None}}, {'_id': 1})
+
+    new_user = AsyncMongoUser(id=None, username='new')
+    run(async_db_adapter.add_object(new_user))
+    assert collection.calls[-1] == ('insert_one', {'username': 'new'})
+    assert new_user.id == 'new-id'
@@ -0,0 +1,260 @@
+from flask_user.lru_cache import LRUCache
+
+from .utils import utils_prepare_user
+
+
+def test_identity_map(app):
+    db_manager = app.user_manager.db_manager
+    db_adapter = db_manager.db_adapter
+    user = utils_prepare_user(app)
+
+    # Count lookups that reach the DbAdapter
+    lookups = []
+    def ifind_first_object(ObjectClass, **kwargs):
+        lookups.append(kwargs)
+        return original_ifind_first_object(ObjectClass, **kwargs)
+    original_ifind_first_object = db_adapter.ifind_first_object
+    db_adapter.ifind_first_object = ifind_first_object
+    try:
+        with app.test_request_context():
+            # Repeated lookups are memoized for the duration of the request
+            assert db_manager.find_user_by_username('testuser').id == user.id
+            assert db_manager.find_user_by_username('testuser').id == user.id
+            assert db_manager.get_user_and_user_email_by_email('testuser@example.com')[0].id == user.id
+            assert db_manager.get_user_and_user_email_by_email('testuser@example.com')[0].id == user.id
+            assert len(lookups) == 2
+
+            # Saving objects clears the identity map
+            db_manager.save_object(user)
+            db_manager.find_user_by_username('testuser')
+            assert len(lookups) == 3
+
+        # Lookups are not memoized across requests
+        with app.test_request_context():
+            db_manager.find_user_by_username('testuser')
+            assert len(lookups) == 4
+    finally:
+        db_adapter.ifind_first_object = original_ifind_first_object
+
+
+def test_user_cache(app, db):
+    db_manager = app.user_manager.db_manager
+    user = utils_prepare_user(app)
+    user_id = user.id
+
+    db_manager.user_cache = LRUCache(10, 60)
+    try:
+        # The first lookup caches a snapshot of the user
+        assert db_manager.get_user_by_id(user_id).id == user_id
+        assert (db_manager.user_cache.hits, db_manager.user_cache.misses) == (0, 1)
+
+        # Cached users are restored into the session, without querying the database
+        db.session.expunge_all()
+        cached_user = db_manager.get_user_by_id(user_id)
+        assert (db_manager.user_cache.hits, db_manager.user_cache.misses) == (1, 1)
+        assert cached_user.id == user_id
+        assert cached_user.username == 'testuser'
+        assert cached_user in db.session
+
+        # Saving a user removes it from the cache once the change is committed.
+        # Until then, the user is looked up without the cache.
+        db_manager.save_object(cached_user)
+        assert len(db_manager.user_cache) == 1
+        db_manager._clear_identity_map()
+        assert db_manager.get_user_by_id(user_id) is cached_user
+        assert (db_manager.user_cache.hits, db_manager.user_cache.misses) == (1, 1)
+        db_manager.commit()
+        assert len(db_manager.user_cache) == 0
+
+        # A rollback keeps the cached user
+        db_manager.get_user_by_id(user_id)
+        db_manager.save_object(cached_user)
+        db_manager.rollback()
+        db_manager.commit()
+        assert len(db_manager.user_cache) == 1
+
+        # With a read replica, users are read from the primary database to verify user session tokens
+        db_manager.read_db_adapter = db_manager.db_adapter
+        try:
+            db_manager._clear_identity_map()
+            db_manager.get_user_by_id(user_id, read_primary=True)
+            assert (db_manager.user_cache.hits, db_manager.user_cache.misses) == (1, 2)
+        finally:
+            db_manager.read_db_adapter = None
+    finally:
+        db_manager.user_cache = None
+
+
+def test_exists_object(app):
+    db_adapter = app.user_manager.db_manager.db_adapter
+    User = app.user_manager.db_manager.UserClass
+    user = utils_prepare_user(app)
+
+    assert db_adapter.exists_object(User, id=user.id)
+    assert db_adapter.exists_object(User, id=user.id, email_confirmed_at__ne=None)
+    assert not db_adapter.exists_object(User, id=user.id, email_confirmed_at=None)
+    assert not db_adapter.exists_object(User, username='no-such-user')
+
+
+def test_joined_lookups(app, db):
+    from sqlalchemy import inspect
+
+    db_adapter = app.user_manager.db_manager.db_adapter
+    UserEmail = app.UserEmailClass
+    user = utils_prepare_user(app)
+    user_id = user.id
+    user_email = UserEmail(user=user, email='joined@example.com')
+    db_adapter.add_object(user_email)
+    db_adapter.commit()
+    user_email_id = user_email.id
+
+    try:
+        # The related User is loaded along with the UserEmail
+        db.session.expunge_all()
+        user_email = db_adapter.ifind_first_object_with_related(UserEmail, 'user', email='JOINED@example.com')
+        assert 'user' not in inspect(user_email).unloaded
+        assert user_email.user.id == user_id
+
+        db.session.expunge_all()
+        user_email = db_adapter.get_object_with_related(UserEmail, user_email_id, 'user')
+        assert 'user' not in inspect(user_email).unloaded
+        assert user_email.user.id == user_id
+    finally:
+        db_adapter.delete_object(user_email)
+        db_adapter.commit()
+
+
+def test_normalized_ifind_mode(app):
+    um = app.user_manager
+    db_manager = um.db_manager
+    user = utils_prepare_user(app)
+    user_id = user.id
+
+    # Fill the normalized shadow columns of existing users
+    user.username_normalized = None
+    db_manager.db_adapter.commit()
+    assert db_manager.backfill_normalized_fields(batch_size=1) >= 1
+    assert db_manager.backfill_normalized_fields(batch_size=1) == 0
+
+    um.USER_IFIND_MODE = 'normalized'
+    try:
+        assert db_manager.db_adapter.ifind_first_object(db_manager.UserClass, username='TestUser').id == user_id
+        assert db_manager.db_adapter.ifind_first_object(db_manager.UserClass, email='TESTUSER@example.com').id == user_id
+
+        # Normalized shadow columns are updated on save
+        user = db_manager.get_user_by_id(user_id)
+        user.username = u'Test\uff35ser2'   # Fullwidth 'U' normalizes to 'u'
+        db_manager.save_object(user)
+        db_manager.commit()
+        assert user.username_normalized == 'testuser2'
+        assert db_manager.db_adapter.ifind_first_object(db_manager.UserClass, username='testuser2').id == user_id
+    finally:
+        um.USER_IFIND_MODE = 'ifind'
+        user.username = 'testuser'
+        db_manager.save_object(user)
+        db_manager.commit()
+
+
+def test_find_user_by_username_or_email(app):
+    db_manager = app.user_manager.db_manager
+    user = utils_prepare_user(app)
+
+    found_user, user_email, matched_field_name = db_manager.find_user_by_username_or_email('TestUser')
+    assert (found_user.id, user_email, matched_field_name) == (user.id, None, 'username')
+
+    found_user, user_email, matched_field_name = db_manager.find_user_by_username_or_email('testuser@EXAMPLE.com')
+    assert (found_user.id, user_email.id, matched_field_name) == (user.id, user.id, 'email')
+
+    assert db_manager.find_user_by_username_or_email('nobody') == (None, None, None)
+
+
+def test_find_user_by_username_or_email_with_user_emails(app, db):
+    from sqlalchemy import event
+
+    db_manager = app.user_manager.db_manager
+    UserEmail = app.UserEmailClass
+    user = utils_prepare_user(app)
+    user_id = user.id
+    user_email = UserEmail(user=user, email='other@example.com')
+    db_manager.db_adapter.add_object(user_email)
+    db_manager.commit()
+
+    # Count database queries
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    db_manager.UserEmailClass = UserEmail
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        db.session.expunge_all()
+        found_user, found_user_email, matched_field_name = db_manager.find_user_by_username_or_email('TestUser')
+        assert (found_user.id, found_user_email, matched_field_name) == (user_id, None, 'username')
+        assert len(statements) == 1
+
+        # The User and its matching UserEmail are retrieved in one query
+        db.session.expunge_all()
+        db_manager._clear_identity_map()
+        found_user, found_user_email, matched_field_name = db_manager.find_user_by_username_or_email('OTHER@example.com')
+        assert (found_user.id, found_user_email.email, matched_field_name) == (user_id, 'other@example.com', 'email')
+        assert found_user_email.user is found_user
+        assert len(statements) == 2
+
+        db_manager._clear_identity_map()
+        assert db_manager.find_user_by_username_or_email('nobody') == (None, None, None)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        db_manager.UserEmailClass = None
+        db_manager.db_adapter.delete_object(db_manager.db_adapter.find_first_object(UserEmail, email='other@example.com'))
+        db_manager.commit()
+
+
+def test_field_projection(app, db):
+    from sqlalchemy import inspect
+
+    db_manager = app.user_manager.db_manager
+    db_adapter = db_manager.db_adapter
+    User = db_manager.UserClass
+    user = utils_prepare_user(app)
+    user_id = user.id
+
+    # Only the specified columns are loaded. Other columns are loaded on access.
+    db.session.expunge_all()
+    user = db_adapter.get_object(User, user_id, load_fields=['id', 'password'])
+    assert 'first_name' not in inspect(user).dict
+    assert user.first_name == 'Firstname'
+
+    db.session.expunge_all()
+    user = db_adapter.find_first_object(User, load_fields=['id'], username='testuser')
+    assert user.id == user_id and 'username' not in inspect(user).dict
+    assert [user.id for user in db_adapter.find_objects(User, load_fields=['id'], username='testuser')] == [user_id]
+
+    # The session user is loaded with the session user fields only
+    db.session.expunge_all()
+    with app.test_request_context():
+        user = db_manager.get_user_by_id(user_id)
+        assert 'email_confirmed_at' in inspect(user).dict
+        assert 'last_name' not in inspect(user).dict
+        # The layout template renders current_user.username or current_user.email, without another query
+        assert 'username' in inspect(user).dict and 'email' in inspect(user).dict
+
+
+def test_buffered_writes(app):
+    um = app.user_manager
+    db_adapter = um.db_manager.db_adapter
+    user, user_email = object(), object()
+
+    # Writes are not buffered by default
+    assert not db_adapter.buffer_write('save', user)
+
+    um.USER_BATCH_OBJECT_WRITES = True
+    try:
+        # Writes are buffered in order, and repeated writes are buffered once
+        assert db_adapter.buffer_write('add', user)
+        assert db_adapter.buffer_write('add', user_email)
+        assert db_adapter.buffer_write('add', user)
+        assert db_adapter.buffer_write('save', user)
+        assert db_adapter.pop_buffered_writes() == [('add', user), ('add', user_email), ('save', user)]
+        assert db_adapter.pop_buffered_writes() == []
+    finally:
+        um.USER_BATCH_OBJECT_WRITES = False
@@ -0,0 +1,141 @@
+from .utils import utils_prepare_user
+
+
+def test_import_users(app):
+    from concurrent.futures import ThreadPoolExecutor
+
+    um = app.user_manager
+    db_manager = um.db_manager
+    User = db_manager.UserClass
+    utils_prepare_user(app)
+
+    user_records = [
+        dict(username='imported1', email='imported1@example.com', password='Password1', roles=['importer']),
+        dict(username='testuser', email='duplicate@example.com', password='Password1'),  # Duplicate username
+        dict(username='imported2', password='Password1', unknown='value'),
+        dict(username='imported3', email='imported3@example.com', roles=['importer', 'other']),
+    ]
+    try:
+        results = list(um.import_users(user_records, batch_size=3))
+        assert [record_index for record_index, error in results] == [0, 1, 2, 3]
+        assert results[0][1] is None
+        assert results[1][1]
+        assert results[2][1] == "Unknown User property 'unknown'."
+        assert results[3][1] is None
+
+        # Imported users have hashed passwords and roles
+        user1 = User.query.filter(User.username=='imported1').first()
+        assert um.verify_password('Password1', user1.password)
+        assert user1.active
+        assert db_manager.get_user_roles(user1) == ['importer']
+        user3 = User.query.filter(User.username=='imported3').first()
+        assert sorted(db_manager.get_user_roles(user3)) == ['importer', 'other']
+
+        # Passwords can be hashed in parallel
+        with ThreadPoolExecutor(2) as executor:
+            password_hashes = um.password_manager.hash_passwords(['Password1', None], executor)
+        assert um.verify_password('Password1', password_hashes[0])
+        assert isinstance(password_hashes[1], Exception)
+
+        # Passwords are hashed by worker processes
+        results = list(um.import_users([dict(username='imported4', password='Password1'),
+                                        dict(username='imported5', password=None)], workers=2))
+        assert results[0] == (0, None)
+        assert results[1][1].startswith('Password could not be hashed')
+        user4 = User.query.filter(User.username=='imported4').first()
+        assert um.verify_password('Password1', user4.password)
+
+        # Users that a failed batch wrote anyway are not retried
+        new_ids = iter(range(user4.id + 100, user4.id + 110))
+        add_users = db_manager.add_users
+        def add_users_partially(user_records):
+            if len(user_records) > 1:
+                add_users(user_records[:1])
+                db_manager.commit()
+                raise Exception('Batch write failed.')
+            return add_users(user_records)
+        db_manager.db_adapter.new_object_id = lambda ObjectClass: next(new_ids)
+        db_manager.add_users = add_users_partially
+        try:
+            results = list(um.import_users([dict(username='imported6'), dict(username='imported7')]))
+        finally:
+            del db_manager.db_adapter.new_object_id
+            del db_manager.add_users
+        assert results == [(0, None), (1, None)]
+        assert User.query.filter(User.username=='imported6').count() == 1
+        assert User.query.filter(User.username=='imported7').first().id == user4.id + 101
+    finally:
+        for user in User.query.filter(User.username.in_(
+                ['imported1', 'imported3', 'imported4', 'imported6', 'imported7'])).all():
+            db_manager.delete_object(user)
+        db_manager.commit()
+
+
+def test_add_objects(app):
+    db_manager = app.user_manager.db_manager
+    User = db_manager.UserClass
+
+    # The database assigns IDs, with multi-row INSERTs, to mappings with and without optional columns
+    mappings = [dict(username='bulk%d' % i, password='', active=(i % 2 == 0)) for i in range(5)]
+    mappings[2].update(first_name='Bulk')
+    try:
+        ids = db_manager.db_adapter.add_objects(User, mappings)
+        db_manager.commit()
+        for id, mapping in zip(ids, mappings):
+            user = db_manager.get_user_by_id(id)
+            assert user.username == mapping['username']
+            assert user.active == mapping['active']
+        assert db_manager.get_user_by_id(ids[2]).first_name == 'Bulk'
+
+        # Mappings without a distinct unique column value are inserted one by one
+        mappings = [dict(password='', first_name='Bulk%d' % i, username='bulk%d' % (i + 10) if i else None)
+                    for i in range(3)]
+        ids = db_manager.db_adapter.add_objects(User, mappings)
+        db_manager.commit()
+        assert [db_manager.get_user_by_id(id).first_name for id in ids] == ['Bulk0', 'Bulk1', 'Bulk2']
+        db_manager.delete_object(db_manager.get_user_by_id(ids[0]))
+        db_manager.commit()
+
+        # Mappings with IDs keep their IDs
+        assert db_manager.db_adapter.add_objects(User, [dict(id=ids[-1] + 10, username='bulk5', password='')]) \
+            == [ids[-1] + 10]
+        db_manager.commit()
+        assert db_manager.get_user_by_id(ids[-1] + 10).username == 'bulk5'
+    finally:
+        for user in User.query.filter(User.username.like('bulk%')).all():
+            db_manager.delete_object(user)
+        db_manager.commit()
+
+
+def test_export_users(app):
+    import csv
+    import io
+    import json
+
+    um = app.user_manager
+    user = utils_prepare_user(app)
+
+    # Users are retrieved in batches, starting after since_id
+    user_dicts = list(um.db_manager.iter_users(batch_size=1, since_id=user.id - 1))
+    assert user_dicts[0]['id'] == user.id
+    assert user_dicts[0]['username'] == 'testuser'
+    assert 'password' not in user_dicts[0]
+    for user_dict in um.db_manager.iter_users(fields=['id'], since_id=user.id):
+        assert list(user_dict.keys()) == ['id'] and user_dict['id'] > user.id
+
+    # CSV export
+    file = io.StringIO()
+    num_users = um.export_users_csv(file, batch_size=2, fields=['id', 'username', 'email_confirmed_at', 'roles'])
+    rows = list(csv.reader(io.StringIO(file.getvalue())))
+    assert rows[0] == ['id', 'username', 'email_confirmed_at', 'roles']
+    assert len(rows) == num_users + 1
+    assert [str(user.id), 'testuser', user.email_confirmed_at.isoformat(), ''] in rows
+
+    # JSON-lines export
+    file = io.StringIO()
+    num_users = um.export_users_jsonl(file, batch_size=2)
+    lines = file.getvalue().splitlines()
+    assert len(lines) == num_users
+    user_dict = [json.loads(line) for line in lines if json.loads(line)['id'] == user.id][0]
+    assert user_dict['email'] == 'testuser@example.com'
+    assert user_dict['roles'] == []
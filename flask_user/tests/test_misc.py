@@ -10,4 +10,4 @@ def test_misc(app):
     um.token_manager.generate_token(1.1)
 
     # Hash password with old API
-    um.password_manager.verify_password('password', user)
\ No newline at end of file
+    um.password_manager.verify_password('password', user)
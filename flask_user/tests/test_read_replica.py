@@ -0,0 +1,68 @@
+from .utils import utils_prepare_user
+
+
+def test_read_replica(app, db):
+    from flask import g, session
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    from flask_user.db_adapters import SQLDbAdapter
+    from flask_user.db_manager import _SessionDb
+
+    db_manager = app.user_manager.db_manager
+    user = utils_prepare_user(app)
+    user_id = user.id
+
+    # The in-memory test database stands in for its own read replica
+    replica_session = scoped_session(sessionmaker(bind=db.engine))
+    db_manager.read_db_adapter = SQLDbAdapter(app, _SessionDb(replica_session))
+    replica_reads = []
+    def get_object(ObjectClass, id, load_fields=None):
+        object = SQLDbAdapter.get_object(db_manager.read_db_adapter, ObjectClass, id, load_fields)
+        replica_reads.append(object)
+        return object
+    db_manager.read_db_adapter.get_object = get_object
+    try:
+        db.session.expunge_all()
+        with app.test_request_context():
+            # Reads go to the replica. Objects are attached to the primary session.
+            user = db_manager.get_user_by_id(user_id)
+            assert [object.id for object in replica_reads] == [user_id]
+            assert replica_reads[0] not in db.session
+            assert user in db.session
+
+            # After a write, this request and this user session read from the primary
+            db_manager.save_object(user)
+            assert db_manager._get_read_adapter() is db_manager.db_adapter
+            g.pop('_flask_user_read_primary')
+            assert session[db_manager.READ_PRIMARY_SESSION_KEY] > 0
+            assert db_manager._get_read_adapter() is db_manager.db_adapter
+
+        # User session tokens are verified against the primary database, without replica lag
+        del replica_reads[:]
+        with app.test_request_context():
+            assert db_manager.UserClass.get_user_by_token(user.get_id()).id == user_id
+            assert replica_reads == []
+    finally:
+        g.pop('_flask_user_read_primary', None)
+        db_manager.read_db_adapter = None
+        replica_session.remove()
+
+
+def test_read_replica_db(app, db):
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    from flask_user.db_manager import DBManager, _SessionDb
+
+    User = app.user_manager.db_manager.UserClass
+    utils_prepare_user(app)
+    replica_session = scoped_session(sessionmaker(bind=db.engine))
+
+    # A scoped_session is wrapped in an object with a session attribute
+    db_manager = DBManager(app, db, User, read_replica_db=replica_session)
+    assert isinstance(db_manager.read_db_adapter.db, _SessionDb)
+    assert db_manager.read_db_adapter.db.session is replica_session
+    assert db_manager.db_adapter.db is db
+
+    # The replica session is removed at the end of each app context
+    with app.app_context():
+        assert db_manager.read_db_adapter.find_first_object(User, username='testuser') is not None
+        assert replica_session.registry.has()
+    assert not replica_session.registry.has()
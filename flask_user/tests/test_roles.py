@@ -127,3 +127,118 @@ def test_decorators(app, request):
 
         logout_user()
 
+
+
+def test_auth_claims(app, db):
+    um = current_app.user_manager
+    db_manager = um.db_manager
+    User = db_manager.UserClass
+    user = User.query.filter(User.username=='user007').first()
+    agent_role = [role for role in user.roles if role.name=='agent'][0]
+    email_confirmed_at = user.email_confirmed_at
+    client = app.test_client()
+
+    um.USER_ENABLE_AUTH_CLAIMS = True
+    user.email_confirmed_at = datetime.datetime.utcnow()
+    db.session.commit()
+    try:
+        with current_app.test_request_context():
+            user_token = user.get_id()
+        with client.session_transaction() as session:
+            session['_user_id'] = session['user_id'] = user_token
+
+        # @login_required issues auth claims without role names
+        assert client.get('/user/profile').status_code == 200
+        user.roles.remove(agent_role)
+        db.session.commit()
+        response = client.get('/special')
+        assert response.status_code == 302 and '/user/sign-in' not in response.headers['Location']
+
+        # @roles_required authorizes from the role names in the auth claims
+        user.roles.append(agent_role)
+        db.session.commit()
+        response = client.get('/special')
+        assert response.status_code == 302 and '/user/sign-in' not in response.headers['Location']
+
+        # Auth claims are issued for the user session, which can still be invalidated
+        with client.session_transaction() as session:
+            session.pop('_flask_user_auth_claims')
+        assert client.get('/special').status_code == 200
+        um.logout_user_everywhere(user)
+        response = client.get('/special')
+        assert response.status_code == 302 and '/user/sign-in' in response.headers['Location']
+    finally:
+        um.USER_ENABLE_AUTH_CLAIMS = False
+        if agent_role not in user.roles:
+            user.roles.append(agent_role)
+        user.email_confirmed_at = email_confirmed_at
+        db.session.commit()
+
+
+def test_role_set_is_cached_per_request(app):
+
+    @roles_accepted('A', 'B')
+    @roles_required('A')
+    def stacked_view():
+        return 'view'
+
+    um =  current_app.user_manager
+    db_manager = um.db_manager
+    user = db_manager.UserClass(id=1, password='abcdefgh', email_confirmed_at=datetime.datetime.utcnow())
+    user.roles = [db_manager.RoleClass(id=1, name='A')]
+
+    # Count role name retrievals
+    calls = []
+    def get_user_roles(user):
+        calls.append(user)
+        return original_get_user_roles(user)
+    original_get_user_roles = db_manager.get_user_roles
+    db_manager.get_user_roles = get_user_roles
+    try:
+        with current_app.test_request_context():
+            login_user(user)
+            assert stacked_view() == 'view'
+            assert user.has_roles('A', ('B', 'A'))
+            assert len(calls) == 1
+
+            # Assigning new roles invalidates the cached role set
+            user.roles = []
+            assert stacked_view() != 'view'
+            assert len(calls) == 2
+            logout_user()
+    finally:
+        db_manager.get_user_roles = original_get_user_roles
+
+
+def test_allow_unconfirmed_email_does_not_probe(app):
+
+    @allow_unconfirmed_email
+    @login_required
+    def login_required_without():
+        return 'view'
+
+    @login_required
+    def login_required_view():
+        return 'view'
+
+    um =  current_app.user_manager
+    db_manager = um.db_manager
+    user = db_manager.UserClass(id=1, password='abcdefgh', email_confirmed_at=None)
+
+    # Count confirmed email probes
+    calls = []
+    def user_has_confirmed_email(user):
+        calls.append(user)
+        return original_user_has_confirmed_email(user)
+    original_user_has_confirmed_email = db_manager.user_has_confirmed_email
+    db_manager.user_has_confirmed_email = user_has_confirmed_email
+    try:
+        with current_app.test_request_context():
+            login_user(user)
+            assert login_required_without() == 'view'
+            assert calls == []
+            assert login_required_view() != 'view'
+            assert calls == [user]
+            logout_user()
+    finally:
+        db_manager.user_has_confirmed_email = original_user_has_confirmed_email
@@ -0,0 +1,144 @@
+import pytest
+
+
+def test_sharded_db_adapter(app, db):
+    import functools
+    import itertools
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from flask_user import DuplicateValueError
+    from flask_user.db_adapters import SQLDbAdapter, ShardedDbAdapter, SQLShardLookupIndex
+    from flask_user.db_manager import _SessionDb
+
+    db_manager = app.user_manager.db_manager
+    User = db_manager.UserClass
+    Role = db_manager.RoleClass
+
+    def create_memory_engine():
+        return create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+
+    # Three in-memory shard databases, and a lookup index database
+    shard_sessions = []
+    for shard_index in range(3):
+        engine = create_memory_engine()
+        db.Model.metadata.create_all(engine)
+        shard_sessions.append(scoped_session(sessionmaker(bind=engine)))
+    shard_db_adapters = [SQLDbAdapter(app, _SessionDb(shard_session)) for shard_session in shard_sessions]
+    lookup_index = SQLShardLookupIndex(create_memory_engine())
+    lookup_index.create_table()
+    id_generator = functools.partial(next, itertools.count(1000))
+
+    original_db_adapter = db_manager.db_adapter
+    db_manager.db_adapter = ShardedDbAdapter(app, shard_db_adapters[:2], lookup_index, id_generator)
+    try:
+        usernames = ['sharded%d' % index for index in range(12)]
+        user_ids = db_manager.add_users(
+            [dict(username=username, email=username+'@example.com', roles=['admin'] if index % 2 else [])
+             for index, username in enumerate(usernames)])
+
+        # The lookup index is written after the shards are committed
+        assert lookup_index.get_shard_name('username', usernames[0]) is None
+        db_manager.commit()
+
+        # Users and their UserEmails are stored on the shard of the user ID.
+        # Lookups by username and email are routed to one shard.
+        sharded_db_adapter = db_manager.db_adapter
+        assert set(sharded_db_adapter.get_shard_name(user_id) for user_id in user_ids) == {'0', '1'}
+        for user_id, username in zip(user_ids, usernames):
+            shard_name = sharded_db_adapter.get_shard_name(user_id)
+            assert lookup_index.get_shard_name('username', username) == shard_name
+            assert db_manager.find_user_by_username(username.upper()).id == user_id
+            assert db_manager.get_user_and_user_email_by_email(username+'@example.com')[0].id == user_id
+            assert db_manager.get_user_by_id(str(user_id)).id == user_id
+        assert db_manager.find_user_by_username('no-such-user') is None
+
+        # Each shard stores the Roles of its users
+        for shard_session in shard_sessions[:2]:
+            assert [role.name for role in shard_session.query(Role)] == ['admin']
+        for user_id in user_ids:
+            user = db_manager.get_user_by_id(user_id)
+            db_manager.add_user_role(user, 'agent')
+            db_manager.save_object(user)
+        db_manager.commit()
+        for index, user_id in enumerate(user_ids):
+            user = db_manager.get_user_by_id(user_id)
+            assert sorted(role.name for role in user.roles) == (['admin', 'agent'] if index % 2 else ['agent'])
+
+        # The lookup index is updated for changed usernames only
+        add_shard_name_calls = []
+        add_shard_name = lookup_index.add_shard_name
+        lookup_index.add_shard_name = lambda *args: add_shard_name_calls.append(args) or add_shard_name(*args)
+        try:
+            user = db_manager.get_user_by_id(user_ids[0])
+            user.first_name = 'First'
+            db_manager.save_object(user)
+            db_manager.commit()
+            assert add_shard_name_calls == []
+            user.username = 'renamed0'
+            db_manager.save_object(user)
+            assert add_shard_name_calls == []
+            db_manager.commit()
+            shard_name = sharded_db_adapter.get_shard_name(user_ids[0])
+            assert add_shard_name_calls == [('username', 'renamed0', shard_name)]
+            assert db_manager.find_user_by_username('renamed0').id == user_ids[0]
+        finally:
+            lookup_index.add_shard_name = add_shard_name
+
+        # Usernames that another shard holds are not remapped
+        other_shard_name = '1' if shard_name == '0' else '0'
+        other_shard_id = next(id for id in itertools.count(5000)
+                              if sharded_db_adapter.get_shard_name(id) == other_shard_name)
+        duplicate_index = [index for index, user_id in enumerate(user_ids)
+                           if sharded_db_adapter.get_shard_name(user_id) == shard_name][1]
+        duplicate_user = User(id=other_shard_id, username=usernames[duplicate_index].upper(), password='')
+        sharded_db_adapter.add_object(duplicate_user)
+        with pytest.raises(DuplicateValueError):
+            sharded_db_adapter.commit()
+        assert db_manager.find_user_by_username(usernames[duplicate_index]).id == user_ids[duplicate_index]
+        sharded_db_adapter.delete_object(duplicate_user)
+        sharded_db_adapter.commit()
+
+        # Usernames that no shard holds anymore are taken over
+        duplicate_user = User(id=other_shard_id, username=usernames[0], password='')
+        sharded_db_adapter.add_object(duplicate_user)
+        sharded_db_adapter.commit()
+        assert db_manager.find_user_by_username(usernames[0]).id == other_shard_id
+        sharded_db_adapter.delete_object(duplicate_user)
+        sharded_db_adapter.commit()
+
+        # Objects that belong to a user are assigned an ID on the shard of their user
+        user_email = app.UserEmailClass(user_id=user_ids[0], email='other@example.com')
+        sharded_db_adapter.add_object(user_email)
+        sharded_db_adapter.commit()
+        assert sharded_db_adapter.get_shard_name(user_email.id) == sharded_db_adapter.get_shard_name(user_ids[0])
+        assert sharded_db_adapter.find_objects(app.UserEmailClass, user_id=user_ids[0]) == [user_email]
+
+        # Adding a shard moves only the users that map to it
+        db_manager.db_adapter = ShardedDbAdapter(app, shard_db_adapters, lookup_index, id_generator)
+        sharded_db_adapter = db_manager.db_adapter
+        new_shard_user_ids = [user_id for user_id in user_ids if sharded_db_adapter.get_shard_name(user_id) == '2']
+        assert new_shard_user_ids
+
+        # Until they are moved, users are found on their old shard
+        for user_id in new_shard_user_ids:
+            user = db_manager.get_user_by_id(user_id)
+            assert user.id == user_id
+            assert sharded_db_adapter.get_db_adapter(user) is not shard_db_adapters[2]
+
+        assert sharded_db_adapter.rebalance(batch_size=5) == len(new_shard_user_ids)
+        assert sharded_db_adapter.rebalance(batch_size=5) == 0
+        assert sorted(user.id for user in shard_sessions[2].query(User)) == sorted(new_shard_user_ids)
+        assert sum(shard_session.query(User).count() for shard_session in shard_sessions) == len(user_ids)
+        for index, (user_id, username) in enumerate(zip(user_ids, usernames)):
+            user = db_manager.get_user_and_user_email_by_email(username+'@example.com')[0]
+            assert user.id == user_id
+            assert sorted(role.name for role in user.roles) == (['admin', 'agent'] if index % 2 else ['agent'])
+            if user_id in new_shard_user_ids:
+                assert all(role in shard_sessions[2] for role in user.roles)
+
+        assert sharded_db_adapter.rebuild_lookup_index() == len(user_ids)
+    finally:
+        db_manager.db_adapter = original_db_adapter
+        for shard_session in shard_sessions:
+            shard_session.remove()
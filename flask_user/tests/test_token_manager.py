@@ -0,0 +1,152 @@
+from flask_user import TokenManager
+from flask_user.lru_cache import LRUCache
+
+from .utils import utils_prepare_user
+
+
+def test_token_cache(app):
+    um = app.user_manager
+    User = um.db_manager.UserClass
+
+    user = utils_prepare_user(app)
+
+    um.token_cache = LRUCache(2, 60)
+    try:
+        with app.test_request_context():
+            # A verified session token is cached
+            token = user.get_id()
+            assert User.get_user_by_token(token).id == user.id
+            assert len(um.token_cache) == 1
+            assert User.get_user_by_token(token).id == user.id
+            assert um.token_cache.hits == 1
+
+            # Tokens with an expiration limit are not cached
+            session_version = user.password[-8:] if user.session_version is None else user.session_version
+            assert User.get_user_by_token(um.generate_token(user.id, session_version), 3600).id == user.id
+            assert len(um.token_cache) == 1
+
+            # Cached tokens are invalidated by user ID
+            um.token_cache.delete_matching(lambda token, data_items: data_items[0] == user.id)
+            assert len(um.token_cache) == 0
+    finally:
+        um.token_cache = None
+
+
+def test_token_cache_signals(app):
+    from flask_user import signals
+
+    um = app.user_manager
+    User = um.db_manager.UserClass
+
+    user = utils_prepare_user(app)
+
+    um.token_cache = LRUCache(2, 60)
+    try:
+        with app.test_request_context():
+            token = user.get_id()
+            for signal in (signals.user_changed_password, signals.user_reset_password):
+                assert User.get_user_by_token(token).id == user.id
+                assert len(um.token_cache) == 1
+
+                # Password change signals evict the cached tokens of the user
+                signal.send(app, user=user)
+                assert len(um.token_cache) == 0
+    finally:
+        um.token_cache = None
+
+
+def test_hmac_tokens(app):
+    token_manager = app.user_manager.token_manager
+
+    token_manager.token_format = 'hmac'
+    try:
+        token = token_manager.generate_token('abc', 123, 'xyz')
+        assert token.startswith(token_manager.HMAC_TOKEN_PREFIX)
+        assert token_manager.verify_token(token, 3600) == ['abc', 123, 'xyz']
+
+        # Tampered tokens are rejected
+        tampered_token = token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB')
+        assert token_manager.verify_token(tampered_token, 3600) is None
+        assert token_manager.verify_token('gQ' + '!' * 40, 3600) is None
+
+        # Expired tokens are rejected
+        assert token_manager.verify_token(token, -1) is None
+    finally:
+        token_manager.token_format = 'fernet'
+
+    # Fernet tokens remain valid alongside 'hmac' tokens
+    assert token_manager.verify_token(token, 3600) == ['abc', 123, 'xyz']
+    fernet_token = token_manager.generate_token('abc', 123, 'xyz')
+    assert len(token) < len(fernet_token)
+    assert token_manager.verify_token(fernet_token, 3600) == ['abc', 123, 'xyz']
+
+
+def test_binary_token_codec(app):
+    token_manager = app.user_manager.token_manager
+
+    # The text codec rejects data items that can not be decoded unambiguously
+    for data_item in ('a|b', '~abc', -1):
+        try:
+            token_manager.encode_data_items(data_item)
+            assert False, 'ValueError expected'
+        except ValueError:
+            pass
+
+    # The binary codec accepts any string and integer
+    data_items = ['a|b', '~abc', -1, 0, 2**100, 'x' * 100]
+    payload_bytes = token_manager.encode_data_items_binary(*data_items)
+    assert token_manager.decode_data_items_binary(payload_bytes) == data_items
+
+    token_manager.token_codec = 'binary'
+    try:
+        token = token_manager.generate_token(*data_items)
+    finally:
+        token_manager.token_codec = 'text'
+    assert token_manager.verify_token(token, 3600) == data_items
+
+
+def test_token_key_rotation(app):
+    um = app.user_manager
+    untagged_token = um.token_manager.generate_token('abc', 123)
+
+    try:
+        # Sign tokens with the old key
+        um.USER_TOKEN_KEYS = ['old secret key with at least 32 bytes']
+        old_token_manager = TokenManager(app)
+        old_token = old_token_manager.generate_token('abc', 123)
+        assert old_token.startswith(old_token_manager.key_id + '.')
+
+        # Untagged tokens are rejected, unless SECRET_KEY is listed
+        assert old_token_manager.verify_token(untagged_token) is None
+
+        # Rotate keys: new tokens use the new key, old tokens keep verifying
+        um.USER_TOKEN_KEYS = ['new secret key with at least 32 bytes', 'old secret key with at least 32 bytes',
+                              app.config['SECRET_KEY']]
+        new_token_manager = TokenManager(app)
+        new_token = new_token_manager.generate_token('abc', 123)
+        assert new_token_manager.key_id != old_token_manager.key_id
+        assert new_token_manager.verify_token(new_token, 3600) == ['abc', 123]
+        assert new_token_manager.verify_token(old_token, 3600) == ['abc', 123]
+        assert new_token_manager.verify_token(untagged_token, 3600) == ['abc', 123]
+
+        # Retire the old key and SECRET_KEY
+        um.USER_TOKEN_KEYS = ['new secret key with at least 32 bytes']
+        new_token_manager = TokenManager(app)
+        assert new_token_manager.verify_token(new_token, 3600) == ['abc', 123]
+        assert new_token_manager.verify_token(old_token, 3600) is None
+        assert new_token_manager.verify_token(untagged_token) is None
+        assert new_token_manager.verify_token('XXXX.' + new_token.split('.')[1], 3600) is None
+    finally:
+        um.USER_TOKEN_KEYS = []
+
+
+def test_verify_tokens(app):
+    token_manager = app.user_manager.token_manager
+    tokens = [token_manager.generate_token('abc', i) for i in range(200)]
+    tokens[3] = 'invalid'
+    tokens[5] = None
+    expected = [['abc', i] for i in range(200)]
+    expected[3] = expected[5] = None
+
+    assert list(token_manager.verify_tokens(tokens, 3600)) == expected
+    assert list(token_manager.verify_tokens(iter(tokens), 3600, max_workers=2)) == expected
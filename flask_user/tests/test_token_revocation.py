@@ -0,0 +1,44 @@
+import pytest
+
+from flask_user import ConfigError, TokenManager
+
+
+def test_token_revocation(app, tmpdir):
+    from flask_user.token_revocation import SQLiteTokenRevocationStore, TokenRevocationList
+
+    um = app.user_manager
+    database = str(tmpdir.join('revoked_tokens.sqlite'))
+
+    try:
+        um.USER_TOKEN_REVOCATION_DATABASE = database
+        token_manager = TokenManager(app)
+        other_token_manager = TokenManager(app)     # Another worker process, sharing the store
+        token = token_manager.generate_token('abc', 123)
+        other_token = token_manager.generate_token('abc', 456)
+        assert other_token_manager.verify_token(token, 3600) == ['abc', 123]
+
+        # Revoked tokens are rejected by this worker at once
+        token_manager.revoke_token(token)
+        assert token_manager.verify_token(token, 3600) is None
+        assert token_manager.verify_token(other_token, 3600) == ['abc', 456]
+
+        # ... and by other workers after their next reload
+        other_token_manager.revocation_list.reload()
+        assert other_token_manager.verify_token(token, 3600) is None
+        assert other_token_manager.verify_token(other_token, 3600) == ['abc', 456]
+
+        # Revocations of expired tokens are ignored, and are pruned from the store on reload
+        token_manager.revoke_token(other_token, expiration_in_seconds=-1)
+        assert token_manager.verify_token(other_token, 3600) == ['abc', 456]
+        store = SQLiteTokenRevocationStore(database)
+        revocation_list = TokenRevocationList(store, prune_interval=0)
+        revocation_list.reload()
+        assert store._get_connection().execute('SELECT COUNT(*) FROM flask_user_revoked_tokens').fetchone()[0] == 1
+        assert revocation_list.is_revoked(token)
+        assert not revocation_list.is_revoked(other_token)
+    finally:
+        um.USER_TOKEN_REVOCATION_DATABASE = None
+
+    # Revocation requires a store
+    with pytest.raises(ConfigError):
+        um.token_manager.revoke_token(token)
@@ -0,0 +1,47 @@
+import pytest
+
+from flask_user import ConfigError
+
+from .utils import utils_prepare_user
+
+
+def test_logout_user_everywhere(app):
+    um = app.user_manager
+    user = utils_prepare_user(app)
+    client = app.test_client()
+
+    with app.test_request_context():
+        user_token = user.get_id()
+    with client.session_transaction() as session:
+        session['_user_id'] = session['user_id'] = user_token
+    assert client.get('/user/profile').status_code == 200
+
+    # The user session token of the old session is rejected
+    um.logout_user_everywhere(user)
+    assert user.session_version == 1
+    response = client.get('/user/profile')
+    assert response.status_code == 302
+    assert '/user/sign-in' in response.headers['Location']
+
+    # Sessions can not be revoked without a session_version field
+    with pytest.raises(ConfigError):
+        um.logout_user_everywhere(object())
+
+
+def test_get_id_reuses_token(app):
+    user = utils_prepare_user(app)
+
+    with app.test_request_context():
+        # Repeated calls return the same token
+        token = user.get_id()
+        assert user.get_id() == token
+
+        # Without a session version, a password change issues a new token
+        password, session_version = user.password, user.session_version
+        user.session_version = None
+        token = user.get_id()
+        user.password = password[:-8] + 'abcdefgh'
+        try:
+            assert user.get_id() != token
+        finally:
+            user.password, user.session_version = password, session_version
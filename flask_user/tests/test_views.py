@@ -63,6 +63,7 @@ def test_change_password_view(app, client):
 
     # POST
     old_password_hash = user.password
+    old_session_version = user.session_version
     client.post_valid_form(
         url,
         old_password='Password1',
@@ -72,8 +73,9 @@ def test_change_password_view(app, client):
     # Verify operations
     assert user.password != old_password_hash
 
-    # Restore password
+    # Restore password, and the session version of the client's user session token
     user.password = old_password_hash
+    user.session_version = old_session_version
     app.db.session.commit()
 
 def test_change_username_view(app, client):
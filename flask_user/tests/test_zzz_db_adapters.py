@@ -90,3 +90,306 @@ def test_mongoengine_db_adapter(app):
 
 
 
+def test_mongo_db_adapter_create_all_tables(app):
+    # No MongoDB server is needed: collections are stubbed.
+    class StubCollection(object):
+        def __init__(self):
+            self.indexes = []
+
+        def create_index(self, keys, **kwargs):
+            self.indexes.append((keys, kwargs))
+
+    class StubField(object):
+        def __init__(self, db_field):
+            self.db_field = db_field
+
+    def stub_document_class(field_names):
+        collection = StubCollection()
+        return type('StubDocument', (object,), dict(
+            _fields=dict((field_name, StubField(field_name[:1])) for field_name in field_names),
+            _get_collection=staticmethod(lambda: collection)))
+
+    User = stub_document_class(['username', 'email', 'password'])
+    UserEmail = stub_document_class(['user_id', 'email'])
+    db_adapter = MongoDbAdapter(app, None)
+
+    # Indexes are created for the data-models passed in, with the case insensitive collation
+    db_adapter.create_all_tables(UserClass=User, UserEmailClass=UserEmail)
+    collation = MongoDbAdapter.CASE_INSENSITIVE_COLLATION
+    assert User._get_collection().indexes == [
+        ([('u', 1)], dict(name='u_ci', collation=collation)),
+        ([('e', 1)], dict(name='e_ci', collation=collation))]
+    assert UserEmail._get_collection().indexes == [
+        ([('e', 1)], dict(name='e_ci', collation=collation)),
+        ([('u', 1)], dict(name='u'))]
+
+def test_pynamo_db_adapter_key_schemas(app):
+    # Make sure PynamoDB is installed. No DynamoDB server is needed: queries are stubbed.
+    try:
+        from pynamodb.attributes import UnicodeAttribute
+        from pynamodb.indexes import AllProjection, GlobalSecondaryIndex, KeysOnlyProjection, LocalSecondaryIndex
+        from pynamodb.models import Model
+    except ImportError:
+        return
+    from flask_user.db_adapters import PynamoDbAdapter
+
+    class EmailIndex(LocalSecondaryIndex):
+        class Meta:
+            index_name = 'email-index'
+            projection = AllProjection()
+        account = UnicodeAttribute(hash_key=True)
+        email = UnicodeAttribute(range_key=True)
+
+    class UsernameIndex(GlobalSecondaryIndex):
+        class Meta:
+            index_name = 'username-index'
+            read_capacity_units = 1
+            write_capacity_units = 1
+            projection = KeysOnlyProjection()
+        username = UnicodeAttribute(hash_key=True)
+
+    class User(Model):
+        class Meta:
+            table_name = 'users'
+        account = UnicodeAttribute(hash_key=True)
+        id = UnicodeAttribute(range_key=True)
+        email = UnicodeAttribute(null=True)
+        username = UnicodeAttribute(null=True)
+        email_index = EmailIndex()
+        username_index = UsernameIndex()
+
+    db_adapter = PynamoDbAdapter(app)
+
+    # Local secondary indexes share the hash key of the table: they are selected by their range key
+    assert db_adapter._select_key_schema(User, dict(account='a', email='e')).index is User.email_index
+    assert db_adapter._select_key_schema(User, dict(account='a')).index is None
+    assert db_adapter._select_key_schema(User, dict(account='a', id='1', email='e')).index is None
+    assert db_adapter._select_key_schema(User, dict(email='e')) is None
+
+    # Indexes that project some attributes serve the fields that they project
+    key_schema = db_adapter._select_key_schema(User, dict(username='u'))
+    assert key_schema.index is User.username_index
+    assert key_schema.projects(['account', 'id', 'username'])
+    assert not key_schema.projects(['email']) and not key_schema.projects(None)
+
+    # Partial objects are reloaded with one BatchGetItem per chunk, in query order
+    queried_users = [User(account='a', id=str(i), username='u') for i in range(3)]
+    batch_gets = []
+    def query(cls, hash_key, **kwargs):
+        assert hash_key == 'u'
+        return iter(queried_users)
+    def batch_get(cls, keys, attributes_to_get=None):
+        batch_gets.append(list(keys))
+        return [User(account=account, id=id, username='u', email=id + '@example.com')
+                for account, id in reversed(keys)]
+    UsernameIndex.query = classmethod(query)
+    User.batch_get = classmethod(batch_get)
+    users = list(db_adapter.find_objects(User, username='u'))
+    assert [user.email for user in users] == ['0@example.com', '1@example.com', '2@example.com']
+    assert batch_gets == [[('a', '0')], [('a', '1'), ('a', '2')]]
+
+    # Projected fields are served by the index, without reloads
+    del batch_gets[:]
+    assert len(list(db_adapter.find_objects(User, load_fields=['account', 'id'], username='u'))) == 3
+    assert batch_gets == []
+
+class StubWriter(object):
+    """Records the calls of a DbAdapter commit() to bulk write methods."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name,) + args)
+
+
+def test_dynamo_db_adapter_commit(app):
+    # No DynamoDB server is needed: the Flywheel engine is stubbed.
+    from flask_user.db_adapters import DynamoDbAdapter
+
+    um = app.user_manager
+    engine = StubWriter()
+    db_adapter = DynamoDbAdapter(app, type('StubDb', (object,), dict(engine=engine)))
+    added, saved, added_and_saved, deleted = object(), object(), object(), object()
+
+    um.USER_BATCH_OBJECT_WRITES = True
+    try:
+        for operation, object_ in [('add', added), ('save', saved), ('add', added_and_saved), ('save', saved),
+                                   ('save', added_and_saved), ('add', deleted), ('delete', deleted)]:
+            db_adapter.buffer_write(operation, object_)
+        db_adapter.commit()
+    finally:
+        um.USER_BATCH_OBJECT_WRITES = False
+
+    # Each object is written once: added objects with one batch save, deleted objects with one batch delete
+    assert engine.calls == [('save', [added, added_and_saved]), ('sync', [saved]), ('delete', [deleted])]
+
+
+class StubFlywheelQuery(object):
+    """Scans the items of a Flywheel query like DynamoDB: a limit applies before the filters."""
+
+    def __init__(self, items):
+        self.items = items
+        self.filters = []
+        self.scan_limit = None
+
+    def filter(self, condition):
+        self.filters.append(condition)
+        return self
+
+    def limit(self, scan_limit):
+        self.scan_limit = scan_limit
+        return self
+
+    def first(self):
+        return next(self.gen(), None)
+
+    def gen(self):
+        for item in self.items[:self.scan_limit]:
+            if all(condition(item) for condition in self.filters):
+                yield item
+
+
+def test_dynamo_db_adapter_exists_object(app):
+    # No DynamoDB server is needed: the Flywheel engine and fields are stubbed.
+    from flask_user.db_adapters import DynamoDbAdapter
+
+    class StubField(object):
+        def __init__(self, name):
+            self.name = name
+        def __eq__(self, value):
+            return lambda item: item[self.name] == value
+        def __ne__(self, value):
+            return lambda item: item[self.name] != value
+
+    User = type('User', (object,), dict(username=StubField('username')))
+    items = [dict(username='other'), dict(username='user')]
+    engine = type('StubEngine', (object,), dict(query=lambda self, ObjectClass: StubFlywheelQuery(items)))()
+    db_adapter = DynamoDbAdapter(app, type('StubDb', (object,), dict(engine=engine)))
+
+    # The matching item is not in the first scanned item
+    assert db_adapter.exists_object(User, username='user')
+    assert not db_adapter.exists_object(User, username='nobody')
+
+
+def test_pynamo_db_adapter_commit(app):
+    # No DynamoDB server is needed: batch writes and transactions are stubbed.
+    from flask_user.db_adapters import PynamoDbAdapter
+
+    um = app.user_manager
+    batch = StubWriter()
+
+    class StubBatchWrite(object):
+        def __enter__(self):
+            return batch
+
+        def __exit__(self, *exc_info):
+            batch.calls.append(('write',))
+
+    class StubModel(object):
+        class Meta:
+            region = host = None
+
+        @classmethod
+        def batch_write(cls):
+            return StubBatchWrite()
+
+    db_adapter = PynamoDbAdapter(app)
+    added, saved, deleted = StubModel(), StubModel(), StubModel()
+    buffered_writes = [('add', added), ('save', saved), ('save', added), ('delete', deleted), ('add', deleted)]
+
+    um.USER_BATCH_OBJECT_WRITES = True
+    try:
+        # More than TRANSACT_WRITE_MAX_ITEMS objects are written with one BatchWriteItem, with their last operation
+        db_adapter.TRANSACT_WRITE_MAX_ITEMS = 2
+        for operation, object_ in buffered_writes:
+            db_adapter.buffer_write(operation, object_)
+        db_adapter.commit()
+        assert batch.calls == [('save', added), ('save', saved), ('save', deleted), ('write',)]
+        del db_adapter.TRANSACT_WRITE_MAX_ITEMS
+
+        # Fewer objects are written with one TransactWriteItems
+        try:
+            import pynamodb.transactions
+        except ImportError:
+            return
+        transaction = StubWriter()
+
+        class StubTransactWrite(object):
+            def __init__(self, connection):
+                pass
+
+            def __enter__(self):
+                return transaction
+
+            def __exit__(self, *exc_info):
+                transaction.calls.append(('commit',))
+
+        TransactWrite = pynamodb.transactions.TransactWrite
+        pynamodb.transactions.TransactWrite = StubTransactWrite
+        try:
+            for operation, object_ in buffered_writes[:4]:
+                db_adapter.buffer_write(operation, object_)
+            db_adapter.commit()
+        finally:
+            pynamodb.transactions.TransactWrite = TransactWrite
+        assert transaction.calls == [('save', added), ('save', saved), ('delete', deleted), ('commit',)]
+    finally:
+        um.USER_BATCH_OBJECT_WRITES = False
+
+
+def test_mongo_db_adapter_commit(app):
+    # Make sure PyMongo is installed. No MongoDB server is needed: collections are stubbed.
+    try:
+        from pymongo import DeleteOne, InsertOne, UpdateOne
+    except ImportError:
+        return
+
+    um = app.user_manager
+    collection = StubWriter()
+    collection.full_name = 'db.users'
+
+    class StubDocument(object):
+        def __init__(self, pk, created, delta=({}, {})):
+            self.pk, self._created, self.delta = pk, created, delta
+
+        def validate(self):
+            pass
+
+        def _get_collection(self):
+            return collection
+
+        def to_mongo(self):
+            return {'_id': self.pk} if self.pk is not None else {'username': 'new'}
+
+        def _delta(self):
+            return self.delta
+
+        def _clear_changed_fields(self):
+            self.delta = ({}, {})
+
+    db_adapter = MongoDbAdapter(app, None)
+    added = StubDocument(1, True)
+    added_without_id = StubDocument(None, True)
+    saved = StubDocument(2, False, ({'username': 'new'}, {'first_name': 1}))
+    unchanged = StubDocument(3, False)
+    deleted = StubDocument(4, False)
+
+    um.USER_BATCH_OBJECT_WRITES = True
+    try:
+        for operation, object_ in [('add', added), ('save', added), ('add', added_without_id), ('save', saved),
+                                   ('save', unchanged), ('save', saved), ('delete', deleted)]:
+            db_adapter.buffer_write(operation, object_)
+        db_adapter.commit()
+    finally:
+        um.USER_BATCH_OBJECT_WRITES = False
+
+    # One ordered bulk write per collection. Saved objects are updated with their changed fields only.
+    # New objects without an ID are assigned one.
+    assert added_without_id.pk is not None
+    assert collection.calls == [('bulk_write', [
+        InsertOne({'_id': 1}),
+        InsertOne({'username': 'new', '_id': added_without_id.pk}),
+        UpdateOne({'_id': 2}, {'$set': {'username': 'new'}, '$unset': {'first_name': 1}}),
+        DeleteOne({'_id': 4})])]
+    assert not added._created and saved.delta == ({}, {})
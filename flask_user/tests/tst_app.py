@@ -72,6 +72,11 @@ if ORM_type=='SQLAlchemy':
         email = db.Column(db.String(255, collation='NOCASE'), nullable=True, unique=True)
         email_confirmed_at = db.Column(db.DateTime())
         password = db.Column(db.String(255), nullable=False, server_default='')
+        session_version = db.Column(db.Integer(), nullable=True)
+
+        # Normalized shadow columns for USER_IFIND_MODE='normalized'
+        username_normalized = db.Column(db.String(50), nullable=True, index=True)
+        email_normalized = db.Column(db.String(255), nullable=True, index=True)
 
         # User information
         first_name = db.Column(db.String(100, collation='NOCASE'), nullable=False, server_default='')
@@ -132,6 +137,7 @@ if ORM_type == 'MongoEngine':
         email = db.StringField(default='')
         password = db.StringField()
         email_confirmed_at = db.DateTimeField(default=None)
+        session_version = db.IntField(default=None)
 
         # User information
         first_name = db.StringField(default='')
@@ -6,14 +6,20 @@ It uses cryptography to generate and verify tokens.
 # Copyright (c) 2013 Ling Thio
 
 import base64
+import binascii
+import hashlib
+import hmac
+import itertools
 import string
+import struct
+import time
 
 # Non-system imports are moved into the methods to make them an optional requirement
 
 from flask_user import ConfigError
 
 class TokenManager(object):
-    """Generate and verify timestamped, signed and encrypted tokens. """
+    """Generate and verify timestamped, signed and (optionally) encrypted tokens. """
 
     # *** Constants ***
 
@@ -24,43 +30,101 @@ class TokenManager(object):
     INTEGER_PREFIX = '~'
     SEPARATOR = '|'
 
+    # 'hmac' tokens are laid out as: version (1 byte) | timestamp (8 bytes) | payload | signature (16 bytes).
+    # The version byte differs from Fernet's 0x80, so that both token formats can be told apart.
+    HMAC_VERSION = b'\x81'
+    HMAC_TOKEN_PREFIX = 'gQ'        # base64 encoding of the HMAC_VERSION byte
+    HMAC_SIGNATURE_SIZE = 16        # HMAC-SHA256, truncated to 128 bits
+    MAX_CLOCK_SKEW = 60             # Same clock skew allowance as Fernet
+
+    # 'binary' payloads start with a NUL byte, which 'text' payloads never do.
+    # Each data item is encoded as a header byte, followed by the item bytes:
+    # - non-negative and negative integers: the big-endian magnitude bytes.
+    # - strings: the UTF-8 bytes.
+    # The header byte holds the item type in its top 2 bits and the item length in its low 6 bits.
+    # Lengths of 63 bytes or more are stored as BINARY_LONG_LENGTH, followed by a varint length.
+    BINARY_PREFIX = b'\x00'
+    BINARY_POSITIVE_INT = 0x40
+    BINARY_NEGATIVE_INT = 0x80
+    BINARY_STRING = 0xC0
+    BINARY_TYPE_MASK = 0xC0
+    BINARY_LONG_LENGTH = 0x3F
+
+    # With USER_TOKEN_KEYS, tokens are prefixed with the ID of their signing key and a '.'
+    # The '.' character does not occur in URL-safe base64 and can not be confused with token data.
+    KEY_ID_SEPARATOR = '.'
+
     # *** Public methods ***
 
     def __init__(self, app):
-        """Check config settings and initialize the Fernet encryption cypher.
+        """Check config settings and initialize the Fernet encryption cyphers and the HMAC signing keys.
 
         Fernet is basically AES128 in CBC mode, with a timestamp and a signature.
+        HMAC tokens are timestamped and signed with HMAC-SHA256, but not encrypted.
+        The USER_TOKEN_FORMAT setting selects the format of newly generated tokens.
 
         Args:
             app(Flask): The Flask application instance.
         """
 
         self.app = app
+        self.user_manager = app.user_manager
+
+        # Check the token format setting
+        self.token_format = self.user_manager.USER_TOKEN_FORMAT
+        if self.token_format not in ('fernet', 'hmac'):
+            raise ConfigError("Config setting USER_TOKEN_FORMAT must be 'fernet' or 'hmac'.")
+
+        # Check the token codec setting
+        self.token_codec = self.user_manager.USER_TOKEN_CODEC
+        if self.token_codec not in ('text', 'binary'):
+            raise ConfigError("Config setting USER_TOKEN_CODEC must be 'text' or 'binary'.")
 
         # Use the applications's SECRET_KEY if flask_secret_key is not specified.
         flask_secret_key = app.config.get('SECRET_KEY', None)
         if not flask_secret_key:
             raise ConfigError('Config setting SECRET_KEY is missing.')
 
-        # Print a warning if SECRET_KEY is too short
-        key = flask_secret_key.encode()
-        if len(key)<32:
-            print('WARNING: Flask-User TokenManager: SECRET_KEY is shorter than 32 bytes.')
-            key = key + b' '*32    # Make sure the key is at least 32 bytes long
+        # Untagged tokens are signed with keys derived from SECRET_KEY.
+        # With USER_TOKEN_KEYS, they are accepted only while SECRET_KEY is listed, so that it can be retired.
+        self.fernet, self.hmac_key = self._derive_keys(flask_secret_key, 'SECRET_KEY')
+        self.secret_key_keys = (self.fernet, self.hmac_key)
+        if self.user_manager.USER_TOKEN_KEYS and flask_secret_key not in self.user_manager.USER_TOKEN_KEYS:
+            self.secret_key_keys = None
+
+        # With USER_TOKEN_KEYS, tokens are tagged with a key ID and signed with the first key.
+        # All listed keys are used to verify tokens, selected by the key ID of the token.
+        self.key_id = None
+        self.keys = {}  # key ID -> (fernet, hmac_key)
+        for secret_key in self.user_manager.USER_TOKEN_KEYS:
+            key_id = self._get_key_id(secret_key)
+            if key_id in self.keys:
+                raise ConfigError('Config setting USER_TOKEN_KEYS contains duplicate keys.')
+            self.keys[key_id] = self._derive_keys(secret_key, 'USER_TOKEN_KEYS')
+            if self.key_id is None:
+                self.key_id = key_id
+                self.fernet, self.hmac_key = self.keys[key_id]
+
+        # With USER_TOKEN_REVOCATION_DATABASE, tokens can be revoked before they expire.
+        # Set ``revocation_list`` to a TokenRevocationList to use a custom TokenRevocationStore.
+        self.revocation_list = None
+        if self.user_manager.USER_TOKEN_REVOCATION_DATABASE:
+            from .token_revocation import SQLiteTokenRevocationStore, TokenRevocationList
+            self.revocation_list = TokenRevocationList(
+                SQLiteTokenRevocationStore(self.user_manager.USER_TOKEN_REVOCATION_DATABASE),
+                reload_interval=self.user_manager.USER_TOKEN_REVOCATION_RELOAD_INTERVAL)
 
-        key32 = key[:32]
-        base64_key32 = base64.urlsafe_b64encode(key32)
+    def generate_token(self, *args):
+        """ Convert a list of integers or strings, specified by ``*args``, into a timestamped and signed token.
 
-        # Create a Fernet cypher to encrypt data -- basically AES128 in CBC mode,
-        # Encrypt, timestamp, sign, and base64-encode
-        from cryptography.fernet import Fernet
-        self.fernet = Fernet(base64_key32)
+        Tokens are encrypted with Fernet if USER_TOKEN_FORMAT is 'fernet' (the default),
+        and are signed but not encrypted if USER_TOKEN_FORMAT is 'hmac'.
 
-    def generate_token(self, *args):
-        """ Convert a list of integers or strings, specified by ``*args``, into an encrypted, timestamped, and signed token.
+        Data items are encoded with ``encode_data_items()`` if USER_TOKEN_CODEC is 'text' (the default),
+        and with the more compact ``encode_data_items_binary()`` if USER_TOKEN_CODEC is 'binary'.
 
-        Note: strings may not contain any ``'|'`` characters, nor start with a ``'~'`` character
-        as these are used as separators and integer indicators for encoding.
+        Note: With the 'text' codec, strings may not contain any ``'|'`` characters, nor start with
+        a ``'~'`` character as these are used as separators and integer indicators for encoding.
 
         Example:
 
@@ -72,8 +136,19 @@ class TokenManager(object):
             password_ends_with = user.password[-8:0]
             token = token_manager.generate_token(user_id, password_ends_with)
         """
-        concatenated_str = self.encode_data_items(*args)
-        token = self.encrypt_string(concatenated_str)
+        if self.token_codec == 'binary':
+            payload_bytes = self.encode_data_items_binary(*args)
+        else:
+            payload_bytes = self.encode_data_items(*args).encode()
+
+        if self.token_format == 'hmac':
+            token = self.sign_bytes(payload_bytes)
+        else:
+            token = self.encrypt_bytes(payload_bytes)
+
+        # Tag the token with the ID of its signing key
+        if self.key_id:
+            token = self.key_id + self.KEY_ID_SEPARATOR + token
         return token
 
     def verify_token(self, token, expiration_in_seconds=None):
@@ -82,6 +157,15 @@ class TokenManager(object):
         | Returns None if token is expired or invalid.
         | Returns a list of strings and integers on success.
 
+        Both 'fernet' and 'hmac' tokens, with 'text' or 'binary' payloads, are accepted regardless
+        of the USER_TOKEN_FORMAT and USER_TOKEN_CODEC settings, so that outstanding tokens
+        remain valid when these settings change.
+
+        Tokens tagged with a key ID are verified with the matching key from USER_TOKEN_KEYS.
+        Untagged tokens are verified with SECRET_KEY, if USER_TOKEN_KEYS is empty or lists SECRET_KEY.
+
+        Tokens revoked with ``revoke_token()`` are rejected.
+
         Implemented as::
 
             concatenated_str = self.decrypt_string(token, expiration_in_seconds)
@@ -104,22 +188,135 @@ class TokenManager(object):
 
         from cryptography.fernet import InvalidToken
 
+        # Select the verification keys by key ID
+        key_id, separator, untagged_token = token.rpartition(self.KEY_ID_SEPARATOR)
+        keys = self.keys.get(key_id) if separator else self.secret_key_keys
+        if not keys:
+            return None
+        fernet, hmac_key = keys
+
         try:
-            concatenated_str = self.decrypt_string(token, expiration_in_seconds)
-            data_items = self.decode_data_items(concatenated_str)
-        except InvalidToken:
+            if untagged_token.startswith(self.HMAC_TOKEN_PREFIX):
+                payload_bytes = self.unsign_bytes(untagged_token, expiration_in_seconds, hmac_key)
+            else:
+                payload_bytes = self.decrypt_bytes(untagged_token, expiration_in_seconds, fernet)
+
+            if payload_bytes.startswith(self.BINARY_PREFIX):
+                data_items = self.decode_data_items_binary(payload_bytes)
+            else:
+                data_items = self.decode_data_items(payload_bytes.decode('utf-8'))
+        except (InvalidToken, ValueError):
+            data_items = None
+
+        # Only valid tokens are checked for revocation
+        if data_items and self.is_token_revoked(token):
             data_items = None
 
         return data_items
 
+    def verify_tokens(self, tokens, expiration_in_seconds=None, max_workers=None):
+        """ Verify a batch of tokens. See ``verify_token()``.
+
+        | Yields a list of strings and integers for each valid token, in the order of ``tokens``.
+        | Yields None for each expired, invalid or revoked token. No exceptions are raised.
+
+        With ``max_workers``, tokens are verified by a pool of threads, as the ``cryptography``
+        primitives release the GIL. Tokens are read from ``tokens`` in chunks, so that large
+        iterables are not loaded into memory at once.
+        The thread pool requires Python 3, or the ``futures`` package on Python 2.
+
+        Example:
+
+        ::
+
+            for token, data_items in zip(tokens, token_manager.verify_tokens(tokens, 3600, max_workers=4)):
+                if data_items is None:
+                    print('Invalid token:', token)
+        """
+
+        def verify(token):
+            try:
+                return self.verify_token(token, expiration_in_seconds)
+            except (AttributeError, TypeError):
+                return None     # Not a token string
+
+        # Verify tokens in this thread
+        if not max_workers or max_workers < 2:
+            for token in tokens:
+                yield verify(token)
+            return
+
+        # Verify tokens in a thread pool
+        from concurrent.futures import ThreadPoolExecutor
+        chunk_size = max_workers * 64
+        token_iterator = iter(tokens)
+        executor = ThreadPoolExecutor(max_workers)
+        try:
+            while True:
+                chunk = list(itertools.islice(token_iterator, chunk_size))
+                if not chunk:
+                    break
+                for data_items in executor.map(verify, chunk):
+                    yield data_items
+        finally:
+            executor.shutdown(wait=False)
+
+    def revoke_token(self, token, expiration_in_seconds=None):
+        """ Revoke ``token``, so that ``verify_token()`` rejects it before it expires.
+
+        Requires USER_TOKEN_REVOCATION_DATABASE, or a custom ``revocation_list``.
+        Other worker processes reject the token within USER_TOKEN_REVOCATION_RELOAD_INTERVAL seconds.
+
+        The revocation is kept for ``expiration_in_seconds`` -- the longest expiration with which
+        the token is verified -- or for USER_TOKEN_REVOCATION_RETENTION seconds if not specified.
+        """
+        if self.revocation_list is None:
+            raise ConfigError('Config setting USER_TOKEN_REVOCATION_DATABASE is missing.')
+        if expiration_in_seconds is None:
+            expiration_in_seconds = self.user_manager.USER_TOKEN_REVOCATION_RETENTION
+        self.revocation_list.revoke(token, time.time() + expiration_in_seconds)
+
+        # Discard the token from this process' verified token cache
+        token_cache = getattr(self.user_manager, 'token_cache', None)
+        if token_cache is not None:
+            token_cache.delete(token)
+
+    def is_token_revoked(self, token):
+        """| Returns True if ``token`` has been revoked with ``revoke_token()``.
+        | Returns False otherwise.
+        """
+        return self.revocation_list is not None and self.revocation_list.is_revoked(token)
+
     def encrypt_string(self, concatenated_str):
         """Timestamp, sign and encrypt a string into a token using ``cryptography.fernet.Fernet()``."""
+        return self.encrypt_bytes(concatenated_str.encode())
 
-        # Convert string to bytes
-        concatenated_bytes = concatenated_str.encode()
+    def decrypt_string(self, token_str, expiration_in_seconds=None):
+        """Verify signature, verify timestamp, and decrypt a token using ``cryptography.fernet.Fernet()``."""
+        return self.decrypt_bytes(token_str, expiration_in_seconds).decode('utf-8')
+
+    def sign_string(self, concatenated_str):
+        """Timestamp and sign a string into a token using HMAC-SHA256. The string is not encrypted."""
+        return self.sign_bytes(concatenated_str.encode())
+
+    def unsign_string(self, token_str, expiration_in_seconds=None):
+        """Verify signature and verify timestamp of a token generated by ``sign_string()``.
+
+        Raises ``cryptography.fernet.InvalidToken`` if the token is expired or invalid,
+        just like ``decrypt_string()``.
+        """
+        from cryptography.fernet import InvalidToken
+
+        try:
+            return self.unsign_bytes(token_str, expiration_in_seconds).decode('utf-8')
+        except UnicodeDecodeError:
+            raise InvalidToken
+
+    def encrypt_bytes(self, payload_bytes):
+        """Timestamp, sign and encrypt bytes into a token using ``cryptography.fernet.Fernet()``."""
 
         # Encrypt, timestamp, sign, and base64-encode
-        encrypted_bytes = self.fernet.encrypt(concatenated_bytes)
+        encrypted_bytes = self.fernet.encrypt(payload_bytes)
 
         # Convert bytes to string
         encrypted_str = encrypted_bytes.decode('utf-8')
@@ -128,8 +325,11 @@ class TokenManager(object):
         token_str = encrypted_str.strip('=')
         return token_str
 
-    def decrypt_string(self, token_str, expiration_in_seconds=None):
-        """Verify signature, verify timestamp, and decrypt a token using ``cryptography.fernet.Fernet()``."""
+    def decrypt_bytes(self, token_str, expiration_in_seconds=None, fernet=None):
+        """Verify signature, verify timestamp, and decrypt a token into bytes using ``cryptography.fernet.Fernet()``.
+
+        Uses the Fernet cypher of the current signing key, unless ``fernet`` is specified.
+        """
 
         # Add '=' padding if needed
         if len(token_str) % 4:
@@ -139,35 +339,87 @@ class TokenManager(object):
         encrypted_bytes = token_str.encode()
 
         # Verify signature, verify expiration, and decrypt using ``cryptography.fernet.Fernet()``
-        concatenated_bytes = self.fernet.decrypt(encrypted_bytes, expiration_in_seconds)
-        concatenated_str = concatenated_bytes.decode('utf-8')
+        fernet = fernet or self.fernet
+        return fernet.decrypt(encrypted_bytes, expiration_in_seconds)
 
-        return concatenated_str
+    def sign_bytes(self, payload_bytes):
+        """Timestamp and sign bytes into a token using HMAC-SHA256. The bytes are not encrypted."""
+
+        # Concatenate version, timestamp and payload bytes
+        current_time = int(time.time())
+        signed_bytes = self.HMAC_VERSION + struct.pack('>Q', current_time) + payload_bytes
+
+        # Sign and base64-encode
+        signature = hmac.new(self.hmac_key, signed_bytes, hashlib.sha256).digest()[:self.HMAC_SIGNATURE_SIZE]
+        token_bytes = base64.urlsafe_b64encode(signed_bytes + signature)
+
+        # Convert bytes to string and remove '=' padding if needed
+        token_str = token_bytes.decode('utf-8').strip('=')
+        return token_str
+
+    def unsign_bytes(self, token_str, expiration_in_seconds=None, hmac_key=None):
+        """Verify signature and verify timestamp of a token generated by ``sign_bytes()``.
+
+        Uses the HMAC key of the current signing key, unless ``hmac_key`` is specified.
+        Raises ``cryptography.fernet.InvalidToken`` if the token is expired or invalid.
+        """
+        from cryptography.fernet import InvalidToken
+
+        # Add '=' padding if needed
+        if len(token_str) % 4:
+            token_str += '=' * (4 - len(token_str) % 4)
+
+        # Base64-decode
+        try:
+            token_bytes = base64.urlsafe_b64decode(token_str.encode())
+        except (TypeError, ValueError, binascii.Error):
+            raise InvalidToken
+        if len(token_bytes) < 9 + self.HMAC_SIGNATURE_SIZE or token_bytes[:1] != self.HMAC_VERSION:
+            raise InvalidToken
+
+        # Verify signature
+        signed_bytes = token_bytes[:-self.HMAC_SIGNATURE_SIZE]
+        signature = hmac.new(hmac_key or self.hmac_key, signed_bytes, hashlib.sha256).digest()[:self.HMAC_SIGNATURE_SIZE]
+        if not hmac.compare_digest(signature, token_bytes[-self.HMAC_SIGNATURE_SIZE:]):
+            raise InvalidToken
+
+        # Verify timestamp
+        timestamp, = struct.unpack('>Q', signed_bytes[1:9])
+        current_time = int(time.time())
+        if expiration_in_seconds is not None and timestamp + expiration_in_seconds < current_time:
+            raise InvalidToken
+        if current_time + self.MAX_CLOCK_SKEW < timestamp:
+            raise InvalidToken
+
+        return signed_bytes[9:]
 
     def encode_data_items(self, *args):
         """ Encodes a list of integers and strings into a concatenated string.
 
         - encode string items as-is.
-        - encode integer items as base-64 with a ``'~'`` prefix.
+        - encode non-negative integer items as base-64 with a ``'~'`` prefix.
         - concatenate encoded items with a ``'|'`` separator.
 
+        Raises ValueError for items that can not be decoded unambiguously: strings that contain
+        a ``'|'`` character or that start with a ``'~'`` or a NUL character, and negative integers.
+
         Example:
             ``encode_data_items('abc', 123, 'xyz')`` returns ``'abc|~B7|xyz'``
         """
         str_list = []
         for arg in args:
 
-            # encode string items as-is
-            if isinstance(arg, str):
-                arg_str = arg
-
             # encode integer items as base-64 strings with a '~' character in front
-            elif isinstance(arg, int):
+            if isinstance(arg, int) and not isinstance(arg, str):
+                if arg < 0:
+                    raise ValueError("TokenManager: Negative integer %d can not be encoded as text." % arg)
                 arg_str = self.INTEGER_PREFIX + self.encode_int(arg)
 
-            # convert other types to string
+            # encode string items as-is, and convert other types to string
             else:
-                arg_str = str(arg)
+                arg_str = arg if isinstance(arg, str) else str(arg)
+                if self.SEPARATOR in arg_str or arg_str[:1] in (self.INTEGER_PREFIX, '\x00'):
+                    raise ValueError("TokenManager: String '%s' can not be encoded as text." % arg_str)
 
             str_list.append(arg_str)
 
@@ -200,6 +452,90 @@ class TokenManager(object):
         # Return list of data items
         return data_items
 
+    def encode_data_items_binary(self, *args):
+        """ Encodes a list of integers and strings into compact bytes.
+
+        - encode integer items as a header byte and their big-endian magnitude bytes.
+        - encode string items as a header byte and their UTF-8 bytes.
+        - convert other types to string.
+
+        Unlike ``encode_data_items()``, any string and any integer can be encoded.
+
+        Example:
+            ``encode_data_items_binary('abc', 123)`` returns ``b'\\x00\\xc3abcA{'``
+        """
+        parts = [self.BINARY_PREFIX]
+        for arg in args:
+
+            # encode integer items as magnitude bytes
+            if isinstance(arg, int) and not isinstance(arg, str):
+                item_type = self.BINARY_POSITIVE_INT if arg >= 0 else self.BINARY_NEGATIVE_INT
+                hex_str = '%x' % abs(arg) if arg else ''
+                if len(hex_str) % 2:
+                    hex_str = '0' + hex_str
+                item_bytes = binascii.unhexlify(hex_str)
+
+            # encode string items, and convert other types to string
+            else:
+                item_type = self.BINARY_STRING
+                arg_str = arg if isinstance(arg, str) else str(arg)
+                item_bytes = arg_str.encode('utf-8')
+
+            # Prepend the item type and length
+            length = len(item_bytes)
+            if length < self.BINARY_LONG_LENGTH:
+                parts.append(bytes(bytearray([item_type | length])))
+            else:
+                parts.append(bytes(bytearray([item_type | self.BINARY_LONG_LENGTH])))
+                parts.append(self._encode_varint(length))
+            parts.append(item_bytes)
+
+        return b''.join(parts)
+
+    def decode_data_items_binary(self, payload_bytes):
+        """Decodes bytes generated by ``encode_data_items_binary()`` into a list of integers and strings.
+
+        Raises ValueError on malformed input.
+
+        Example:
+            ``decode_data_items_binary(b'\\x00\\xc3abcA{')`` returns ``['abc', 123]``
+        """
+        payload = bytearray(payload_bytes)
+        if payload[:1] != bytearray(self.BINARY_PREFIX):
+            raise ValueError("TokenManager: Invalid binary payload.")
+
+        data_items = []
+        position = 1
+        payload_length = len(payload)
+        while position < payload_length:
+            # Decode the item type and length
+            header = payload[position]
+            item_type = header & self.BINARY_TYPE_MASK
+            length = header & self.BINARY_LONG_LENGTH
+            start = position + 1
+            if length == self.BINARY_LONG_LENGTH:
+                length, start = self._decode_varint(payload, start)
+            position = start + length
+            if position > payload_length:
+                raise ValueError("TokenManager: Invalid binary payload.")
+
+            # Decode strings from their UTF-8 bytes
+            if item_type == self.BINARY_STRING:
+                item = payload[start:position].decode('utf-8')
+
+            # Decode integers from their magnitude bytes
+            elif item_type == self.BINARY_POSITIVE_INT:
+                item = int(binascii.hexlify(payload[start:position]), 16) if length else 0
+            elif item_type == self.BINARY_NEGATIVE_INT:
+                item = -int(binascii.hexlify(payload[start:position]), 16) if length else 0
+
+            else:
+                raise ValueError("TokenManager: Invalid binary payload.")
+
+            data_items.append(item)
+
+        return data_items
+
     def encode_int(self, n):
         """ Encodes an integer into a short Base64 string.
 
@@ -223,3 +559,56 @@ class TokenManager(object):
         for c in str:
             n = n * self.BASE + self.ALPHABET_REVERSE[c]
         return n
+
+    # *** Private methods ***
+
+    def _derive_keys(self, secret_key, setting_name):
+        # Derives a Fernet cypher and an HMAC-SHA256 signing key from a secret key string.
+
+        # Print a warning if the secret key is too short
+        key = secret_key.encode()
+        if len(key)<32:
+            print('WARNING: Flask-User TokenManager: %s is shorter than 32 bytes.' % setting_name)
+            key = key + b' '*32    # Make sure the key is at least 32 bytes long
+
+        key32 = key[:32]
+        base64_key32 = base64.urlsafe_b64encode(key32)
+
+        # Create a Fernet cypher to encrypt data -- basically AES128 in CBC mode,
+        # Encrypt, timestamp, sign, and base64-encode
+        from cryptography.fernet import Fernet
+        fernet = Fernet(base64_key32)
+
+        # Derive a separate HMAC-SHA256 signing key from the full secret key
+        hmac_key = hashlib.sha256(b'flask_user.token_manager.hmac:' + secret_key.encode()).digest()
+
+        return fernet, hmac_key
+
+    def _get_key_id(self, secret_key):
+        # Derives a short, stable key ID from a secret key, without revealing the key.
+        key_hash = hashlib.sha256(b'flask_user.token_manager.key_id:' + secret_key.encode()).digest()
+        return base64.urlsafe_b64encode(key_hash[:3]).decode('utf-8')
+
+    def _encode_varint(self, n):
+        # Encodes a non-negative integer into 7-bit groups, least significant group first.
+        varint = bytearray()
+        while n > 0x7f:
+            varint.append((n & 0x7f) | 0x80)
+            n >>= 7
+        varint.append(n)
+        return bytes(varint)
+
+    def _decode_varint(self, payload, position):
+        # Decodes a varint from a bytearray, starting at ``position``.
+        # Returns the integer and the position right after the varint.
+        n = 0
+        shift = 0
+        while True:
+            if position >= len(payload) or shift > 28:
+                raise ValueError("TokenManager: Invalid binary payload.")
+            byte = payload[position]
+            n |= (byte & 0x7f) << shift
+            position += 1
+            if not byte & 0x80:
+                return n, position
+            shift += 7
@@ -0,0 +1,231 @@
+"""This module implements token revocation for Flask-User.
+
+Revoked tokens are recorded in a shared TokenRevocationStore. Each worker process
+keeps a Bloom filter of revoked token hashes in memory, so that the store is only
+queried for the rare tokens that may have been revoked.
+"""
+
+# Author: Ling Thio <ling.thio@gmail.com>
+# Copyright (c) 2013 Ling Thio
+
+import hashlib
+import math
+import os
+import threading
+import time
+
+
+class TokenRevocationStore(object):
+    """ Define the interface of the shared store of revoked token hashes.
+
+    Every revocation is assigned an increasing revocation ID,
+    so that workers can incrementally load new revocations.
+    Revocations are kept until the revoked token expires, at ``expires_at``.
+    """
+
+    def add_token_hash(self, token_hash, expires_at):
+        """ Record a revoked token hash, until the ``expires_at`` timestamp.
+        Adding the same token hash twice has no effect."""
+        raise NotImplementedError
+
+    def contains_token_hash(self, token_hash):
+        """| Returns True if ``token_hash`` has been revoked, and has not expired.
+        | Returns False otherwise.
+        """
+        raise NotImplementedError
+
+    def get_token_hashes_since(self, revocation_id):
+        """ Return a list of (revocation_id, token_hash) tuples, ordered by revocation_id,
+        of all unexpired revocations after ``revocation_id``.
+        """
+        raise NotImplementedError
+
+    def delete_expired_token_hashes(self):
+        """ Delete the revocations of expired tokens."""
+        raise NotImplementedError
+
+
+class SQLiteTokenRevocationStore(TokenRevocationStore):
+    """ Store revoked token hashes in a local SQLite database file,
+    shared by all worker processes on the same host."""
+
+    def __init__(self, database):
+        """
+        Args:
+            database(str): The path of the SQLite database file.
+        """
+        self.database = database
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+
+    def add_token_hash(self, token_hash, expires_at):
+        with self._lock:
+            self._get_connection().execute(
+                'INSERT OR IGNORE INTO flask_user_revoked_tokens (token_hash, revoked_at, expires_at) '
+                'VALUES (?, ?, ?)',
+                (token_hash, time.time(), expires_at))
+
+    def contains_token_hash(self, token_hash):
+        with self._lock:
+            row = self._get_connection().execute(
+                'SELECT 1 FROM flask_user_revoked_tokens WHERE token_hash = ? AND expires_at > ?',
+                (token_hash, time.time())).fetchone()
+        return row is not None
+
+    def get_token_hashes_since(self, revocation_id):
+        with self._lock:
+            return self._get_connection().execute(
+                'SELECT id, token_hash FROM flask_user_revoked_tokens WHERE id > ? AND expires_at > ? ORDER BY id',
+                (revocation_id, time.time())).fetchall()
+
+    def delete_expired_token_hashes(self):
+        with self._lock:
+            self._get_connection().execute(
+                'DELETE FROM flask_user_revoked_tokens WHERE expires_at <= ?', (time.time(),))
+
+    def _get_connection(self):
+        # SQLite connections can not be shared across processes:
+        # (re)connect in each worker process, after a fork.
+        pid = os.getpid()
+        if self._connection is None or self._connection_pid != pid:
+            import sqlite3
+            connection = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS flask_user_revoked_tokens ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'token_hash TEXT NOT NULL UNIQUE, '
+                'revoked_at REAL NOT NULL, '
+                'expires_at REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS flask_user_revoked_tokens_expires_at '
+                'ON flask_user_revoked_tokens (expires_at)')
+            self._connection = connection
+            self._connection_pid = pid
+        return self._connection
+
+
+class BloomFilter(object):
+    """ A fixed-size Bloom filter of hexadecimal SHA-256 digests.
+
+    Membership tests may return false positives, at a rate of about ``error_rate``,
+    but never return false negatives.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        Args:
+            capacity(int): The number of items for which ``error_rate`` holds.
+            error_rate(float): The false positive rate at ``capacity`` items.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, digest):
+        for position in self._get_positions(digest):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest):
+        for position in self._get_positions(digest):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _get_positions(self, digest):
+        # The digest is already uniformly distributed: derive all positions
+        # from two of its 64-bit parts, using double hashing.
+        hash1 = int(digest[0:16], 16)
+        hash2 = int(digest[16:32], 16) | 1
+        return [(hash1 + i * hash2) % self.num_bits for i in range(self.num_hashes)]
+
+
+class TokenRevocationList(object):
+    """ Check tokens against a TokenRevocationStore, through an in-memory Bloom filter.
+
+    New revocations from other worker processes are loaded incrementally,
+    at most every ``reload_interval`` seconds.
+    Every ``prune_interval`` seconds, expired revocations are deleted from the store,
+    and the Bloom filter is rebuilt from the remaining revocations.
+    """
+
+    def __init__(self, store, reload_interval=10, capacity=10000, error_rate=0.0001, prune_interval=3600):
+        """
+        Args:
+            store(TokenRevocationStore): The shared store of revoked token hashes.
+            reload_interval(int): Maximum age, in seconds, of the Bloom filter
+                before new revocations are loaded from the store.
+            capacity(int): Initial number of revocations for which ``error_rate`` holds.
+                The Bloom filter is rebuilt with double the capacity when it fills up.
+            error_rate(float): The rate at which never-revoked tokens are looked up in the store.
+            prune_interval(int): Interval, in seconds, at which expired revocations are dropped.
+        """
+        self.store = store
+        self.reload_interval = reload_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.prune_interval = prune_interval
+        self._bloom_filter = BloomFilter(capacity, error_rate)
+        self._num_token_hashes = 0
+        self._last_revocation_id = 0
+        self._next_reload_at = 0
+        self._next_prune_at = time.time() + prune_interval
+        self._lock = threading.Lock()
+
+    def revoke(self, token, expires_at):
+        """Revoke ``token`` until the ``expires_at`` timestamp, for all worker processes sharing the store."""
+        token_hash = self.hash_token(token)
+        self.store.add_token_hash(token_hash, expires_at)
+        with self._lock:
+            self._bloom_filter.add(token_hash)
+
+    def is_revoked(self, token):
+        """| Returns True if ``token`` has been revoked.
+        | Returns False otherwise.
+        """
+        if time.time() >= self._next_reload_at:
+            self.reload()
+
+        # Only tokens that may have been revoked are looked up in the store
+        token_hash = self.hash_token(token)
+        if token_hash not in self._bloom_filter:
+            return False
+        return self.store.contains_token_hash(token_hash)
+
+    def reload(self):
+        """Load new revocations from the store into the Bloom filter.
+
+        Every ``prune_interval`` seconds, expired revocations are deleted from the store first,
+        and the Bloom filter is rebuilt from the remaining revocations.
+        """
+        with self._lock:
+            prune = time.time() >= self._next_prune_at
+            if prune:
+                self.store.delete_expired_token_hashes()
+                self._next_prune_at = time.time() + self.prune_interval
+            rows = self.store.get_token_hashes_since(0 if prune else self._last_revocation_id)
+
+            # Rebuild the Bloom filter when pruning, or with double the capacity when it is full
+            if prune or self._num_token_hashes + len(rows) > self._bloom_filter.capacity:
+                num_token_hashes = len(rows) if prune else self._num_token_hashes + len(rows)
+                capacity = self.capacity
+                while capacity < num_token_hashes:
+                    capacity *= 2
+                self._bloom_filter = BloomFilter(capacity, self.error_rate)
+                self._num_token_hashes = 0
+                if not prune:
+                    rows = self.store.get_token_hashes_since(0)
+
+            for revocation_id, token_hash in rows:
+                self._bloom_filter.add(token_hash)
+                self._num_token_hashes += 1
+                self._last_revocation_id = revocation_id
+
+            self._next_reload_at = time.time() + self.reload_interval
+
+    @staticmethod
+    def hash_token(token):
+        """Return the hexadecimal SHA-256 digest of ``token``. Tokens themselves are never stored."""
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
@@ -12,14 +12,17 @@ from wtforms import ValidationError
 
 from . import ConfigError
 from . import forms
+from . import signals
 from .db_manager import DBManager
 from .email_manager import EmailManager
+from .lru_cache import LRUCache
 from .password_manager import PasswordManager
 from .token_manager import TokenManager
 from .translation_utils import lazy_gettext as _  # map _() to lazy_gettext()
 from .user_manager__settings import UserManager__Settings
 from .user_manager__utils import UserManager__Utils
 from .user_manager__views import UserManager__Views
+from .user_mixin import _get_preloaded_user
 
 
 # The UserManager is implemented across several source code files.
@@ -40,6 +43,11 @@ class UserManager(UserManager__Settings, UserManager__Utils, UserManager__Views)
                 Required for the 'multiple emails per user' feature.
             UserInvitationClass: The optional UserInvitation class (*not* an instance!).
                 Required for the 'register by invitation' feature.
+            read_replica_db: The optional read replica of a SQLAlchemy ``db``:
+                a ``scoped_session`` bound to the replica engine, for example to a Flask-SQLAlchemy bind:
+                ``scoped_session(sessionmaker(bind=db.get_engine(app, bind='replica')))``.
+                A second Flask-SQLAlchemy instance would connect to SQLALCHEMY_DATABASE_URI, not to the replica.
+                Read-only lookups are sent to the replica. See USER_READ_REPLICA_LAG.
 
         Example:
             ``user_manager = UserManager(app, db, User, UserEmailClass=UserEmail)``
@@ -60,6 +68,7 @@ class UserManager(UserManager__Settings, UserManager__Utils, UserManager__Views)
         UserInvitationClass=None,
         UserEmailClass=None,
         RoleClass=None,    # Only used for testing
+        read_replica_db=None,
         ):
 
         # See http://flask.pocoo.org/docs/0.12/extensiondev/#the-extension-code
@@ -127,6 +136,10 @@ class UserManager(UserManager__Settings, UserManager__Utils, UserManager__Views)
         # Flask-Login calls this function to retrieve a User record by token.
         @self.login_manager.user_loader
         def load_user_by_user_token(user_token):
+            # Users loaded by async_support.load_current_user_async() are not loaded again
+            preloaded_user = _get_preloaded_user(user_token)
+            if preloaded_user is not None:
+                return preloaded_user[0]
             user = self.db_manager.UserClass.get_user_by_token(user_token)
             return user
 
@@ -179,7 +192,8 @@ class UserManager(UserManager__Settings, UserManager__Utils, UserManager__Views)
         # Set default managers
         # --------------------
         # Setup DBManager
-        self.db_manager = DBManager(app, db, UserClass, UserEmailClass, UserInvitationClass, RoleClass)
+        self.db_manager = DBManager(app, db, UserClass, UserEmailClass, UserInvitationClass, RoleClass,
+                                    read_replica_db=read_replica_db)
 
         # Setup PasswordManager
         self.password_manager = PasswordManager(app)
@@ -196,6 +210,27 @@ class UserManager(UserManager__Settings, UserManager__Utils, UserManager__Views)
         # Setup TokenManager
         self.token_manager = TokenManager(app)
 
+        # Setup the optional verified user session token cache
+        self.token_cache = None
+        if self.USER_TOKEN_CACHE_SIZE:
+            self.token_cache = LRUCache(self.USER_TOKEN_CACHE_SIZE, self.USER_TOKEN_CACHE_TTL)
+
+        # Invalidate cached tokens when a password changes
+        def invalidate_cached_user_tokens(sender, user, **extra):
+            if self.token_cache is not None:
+                self.token_cache.delete_matching(lambda token, data_items: str(data_items[0]) == str(user.id))
+
+        try:
+            signals.user_changed_password.connect(invalidate_cached_user_tokens, app, weak=False)
+            signals.user_reset_password.connect(invalidate_cached_user_tokens, app, weak=False)
+        except RuntimeError:
+            # Blinker is not installed. Stale tokens are still rejected
+            # by the password check in UserMixin.get_user_by_token().
+            pass
+
+        # Optional AsyncDbAdapter, used by the async functions in flask_user.async_support
+        self.async_db_adapter = None
+
         # Allow developers to customize UserManager
         self.customize(app)
 
@@ -292,6 +327,20 @@ class UserManager(UserManager__Settings, UserManager__Utils, UserManager__Views)
                 ' Specify UserInvitationClass with UserManager(app, db, User, UserInvitationClass=...' \
                 ' or set USER_ENABLE_INVITE_USER=False.')
 
+        # Check USER_IFIND_MODE
+        if self.USER_IFIND_MODE not in ('ifind', 'nocase_collation', 'normalized'):
+            raise ConfigError("Config setting USER_IFIND_MODE must be 'ifind', 'nocase_collation' or 'normalized'.")
+
+        # Check the normalized shadow fields for USER_IFIND_MODE='normalized'
+        if self.USER_IFIND_MODE == 'normalized':
+            UserEmailClass = self.db_manager.UserEmailClass or self.db_manager.UserClass
+            if self.USER_ENABLE_USERNAME and not hasattr(self.db_manager.UserClass, 'username_normalized'):
+                raise ConfigError(
+                    'UserClass.username_normalized is missing while USER_IFIND_MODE is \'normalized\'.')
+            if self.USER_ENABLE_EMAIL and not hasattr(UserEmailClass, 'email_normalized'):
+                raise ConfigError(
+                    '%s.email_normalized is missing while USER_IFIND_MODE is \'normalized\'.' % UserEmailClass.__name__)
+
         # Check for deprecated settings
         # -----------------------------
 
@@ -100,6 +100,10 @@ class UserManager__Settings(object):
     #: | - 'nocase_collation': username and email fields must be configured
     #: |     with an case insensitve collation (collation='NOCASE' in SQLAlchemy)
     #: |     so that a regular find_first_object() can be performed.
+    #: | - 'normalized': username and email fields must be shadowed by
+    #: |     ``username_normalized`` and ``email_normalized`` fields, which Flask-User keeps
+    #: |     lowercase and NFKC-normalized, so that an indexed find_first_object() can be performed.
+    #: |     Existing rows can be filled with ``db_manager.backfill_normalized_fields()``.
     USER_IFIND_MODE = 'ifind'
 
     #: | Send notification email after a password change.
@@ -159,6 +163,102 @@ class UserManager__Settings(object):
     #: | Default is 2 days (2*24*3600 seconds).
     USER_RESET_PASSWORD_EXPIRATION = 2*24*3600
 
+    #: | Store signed auth claims (email confirmation status and role names) in the Flask session.
+    #: | @login_required, @roles_required, etc. authorize from these claims,
+    #: |   without probing the database for a confirmed email or loading the user's roles.
+    #: | The user itself is still loaded, so that password changes, ``logout_user_everywhere()``
+    #: |   and revoked user session tokens take effect immediately.
+    #: | Role changes and email confirmation changes take effect once the claims expire
+    #: |   (see USER_AUTH_CLAIMS_EXPIRATION).
+    USER_ENABLE_AUTH_CLAIMS = False
+
+    #: | Auth claims expiration in seconds.
+    #: | Expired claims are re-issued from the database by the next protected view.
+    #: | Default is 5 minutes (5*60 seconds).
+    USER_AUTH_CLAIMS_EXPIRATION = 5*60
+
+    #: | The format of newly generated tokens.
+    #: | Valid options are:
+    #: | - 'fernet' (default): Timestamped, signed and encrypted tokens (AES128-CBC and HMAC-SHA256).
+    #: | - 'hmac': Timestamped and signed tokens (HMAC-SHA256) that are about half the size.
+    #: |     Token contents (user IDs, etc.) are not encrypted.
+    #: | Tokens of both formats are always accepted.
+    USER_TOKEN_FORMAT = 'fernet'
+
+    #: | The encoding of data items (user IDs, etc.) inside newly generated tokens.
+    #: | Valid options are:
+    #: | - 'text' (default): ``'|'``-separated strings, with base-64 encoded integers.
+    #: | - 'binary': Compact type-tagged bytes. Accepts any string.
+    #: | Tokens with either encoding are always accepted.
+    USER_TOKEN_CODEC = 'text'
+
+    #: | Ordered list of secret keys used to sign and verify tokens, instead of SECRET_KEY.
+    #: | New tokens are signed with the first key and tagged with its key ID.
+    #: | Tokens signed with any listed key remain valid until they expire,
+    #: |   so keys can be rotated without logging out all users.
+    #: | Untagged tokens, signed with SECRET_KEY before this setting was used,
+    #: |   remain valid only while SECRET_KEY is listed here.
+    #: | Example: ``['new-secret-key', 'previous-secret-key']``
+    USER_TOKEN_KEYS = []
+
+    #: | Maximum number of verified user session tokens kept in a process-wide cache.
+    #: | Cached tokens skip signature verification and decryption on subsequent requests.
+    #: | Default is 0, which disables the cache.
+    USER_TOKEN_CACHE_SIZE = 0
+
+    #: | Verified user session token cache expiration in seconds.
+    #: | Default is 5 minutes (5*60 seconds).
+    USER_TOKEN_CACHE_TTL = 5*60
+
+    #: | Maximum number of User objects kept in a process-wide cache, by User ID.
+    #: | Cached users skip the database lookup that follows user session token verification.
+    #: | Users are removed from the cache when they are saved or deleted through the DBManager,
+    #: |   once the change is committed.
+    #: | With a read replica, user session tokens are verified against the primary database, not the cache.
+    #: | Default is 0, which disables the cache.
+    USER_USER_CACHE_SIZE = 0
+
+    #: | User cache expiration in seconds.
+    #: | Changes made by other processes take effect once cached users expire.
+    #: | Without a read replica, this is also how long user sessions that were ended
+    #: |   by ``logout_user_everywhere()`` or a password change in another process keep working.
+    #: | Default is 1 minute (60 seconds).
+    USER_USER_CACHE_TTL = 60
+
+    #: | Path of the SQLite database file that records revoked tokens,
+    #: |   shared by all worker processes on the host.
+    #: | Enables ``user_manager.token_manager.revoke_token(token)``.
+    #: | Default is None, which disables token revocation.
+    USER_TOKEN_REVOCATION_DATABASE = None
+
+    #: | Interval, in seconds, at which worker processes load new token revocations.
+    #: | Default is 10 seconds.
+    USER_TOKEN_REVOCATION_RELOAD_INTERVAL = 10
+
+    #: | Time, in seconds, for which token revocations are kept,
+    #: |   unless ``revoke_token()`` is called with an ``expiration_in_seconds``.
+    #: | User session tokens are verified without an expiration:
+    #: |   keep this at least as long as Flask-Login's REMEMBER_COOKIE_DURATION.
+    #: | Default is 365 days (365*24*3600 seconds).
+    USER_TOKEN_REVOCATION_RETENTION = 365*24*3600
+
+    #: | Buffer the adds, saves and deletes of object-based DbAdapters
+    #: |   (MongoDbAdapter, DynamoDbAdapter and PynamoDbAdapter) until ``commit()``,
+    #: |   and write them in bulk: one round-trip per collection or table, or one transaction.
+    #: | Buffered writes are not visible to queries until ``commit()``,
+    #: |   and are discarded if the request ends without a ``commit()``.
+    #: | With MongoDbAdapter, the bulk writes of different collections are not atomic.
+    #: | Default is False, which writes each object immediately.
+    USER_BATCH_OBJECT_WRITES = False
+
+    #: | Seconds during which a user session reads from the primary database after it wrote to it,
+    #: |   when UserManager is given a ``read_replica_db``.
+    #: | Should exceed the replication lag of the read replica, so that users read their own writes.
+    #: | User session tokens are always verified against the primary database,
+    #: |   so that password changes and ``logout_user_everywhere()`` end other user sessions immediately.
+    #: | Default is 5 seconds.
+    USER_READ_REPLICA_LAG = 5
+
     #: | User session token expiration in seconds.
     #: | Default is 1 hour (1*3600 seconds).
     #:
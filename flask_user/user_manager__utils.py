@@ -4,6 +4,10 @@
 # Author: Ling Thio <ling.thio@gmail.com>
 # Copyright (c) 2013 Ling Thio
 
+import csv
+import datetime
+import itertools
+import json
 try:
     from urllib.parse import urlsplit, urlunsplit   # Python 3
 except ImportError:
@@ -12,6 +16,8 @@ except ImportError:
 
 from flask_login import current_user
 
+from . import ConfigError
+
 
 # This class mixes into the UserManager class.
 # Mixins allow for maintaining code and docs across several files.
@@ -43,6 +49,53 @@ class UserManager__Utils(object):
         user, user_email = self.db_manager.get_user_and_user_email_by_email(new_email)
         return (user == None)
 
+    def export_users_csv(self, file, batch_size=1000, fields=None, since_id=None):
+        """Write all users to ``file``, as CSV rows with a header row. See ``db_manager.iter_users()``.
+
+        | ``'roles'`` and ``'emails'`` columns hold ``'|'``-separated role names and email addresses.
+        | Users are streamed to ``file`` as they are retrieved, in batches of ``batch_size`` users.
+        | Returns the number of written users.
+
+        Example::
+
+            with open('users.csv', 'w') as file:
+                user_manager.export_users_csv(file)
+        """
+        fields = self.db_manager.get_user_export_fields(fields)
+        writer = csv.writer(file)
+        writer.writerow(fields)
+        num_users = 0
+        for user_dict in self.db_manager.iter_users(batch_size, fields=fields, since_id=since_id):
+            row = []
+            for field_name in fields:
+                value = user_dict[field_name]
+                if field_name == 'emails':
+                    value = '|'.join(user_email['email'] for user_email in value)
+                elif field_name == 'roles':
+                    value = '|'.join(value)
+                row.append(_export_value(value) if value is not None else '')
+            writer.writerow(row)
+            num_users += 1
+        return num_users
+
+    def export_users_jsonl(self, file, batch_size=1000, fields=None, since_id=None):
+        """Write all users to ``file``, as one JSON object per line. See ``db_manager.iter_users()``.
+
+        | Users are streamed to ``file`` as they are retrieved, in batches of ``batch_size`` users.
+        | Returns the number of written users.
+
+        Example::
+
+            with open('users.jsonl', 'w') as file:
+                user_manager.export_users_jsonl(file, since_id=last_exported_user_id)
+        """
+        num_users = 0
+        for user_dict in self.db_manager.iter_users(batch_size, fields=fields, since_id=since_id):
+            file.write(json.dumps(user_dict, default=_export_value, sort_keys=True))
+            file.write('\n')
+            num_users += 1
+        return num_users
+
     def generate_token(self, *args):
         """Convenience method that calls self.token_manager.generate_token(\*args)."""
         return self.token_manager.generate_token(*args)
@@ -51,6 +104,134 @@ class UserManager__Utils(object):
         """Convenience method that calls self.password_manager.hash_password(password)."""
         return self.password_manager.hash_password(password)
 
+    def import_users(self, user_records, batch_size=1000, workers=None):
+        """Create users in bulk, from an iterable of dicts with User properties.
+
+        A ``'password'`` item holds a plaintext password, which is hashed.
+        A ``'roles'`` item holds a list of role names. See ``db_manager.add_users()``.
+
+        Records are read lazily and stored in batches of ``batch_size`` users, with bulk writes.
+        With ``workers``, passwords are hashed by a pool of ``workers`` processes.
+        A batch that fails to store is retried one record at a time, to single out failing records.
+        Users that a failed batch wrote anyway, on databases that can not roll back writes, are not retried.
+
+        Yields a (record_index, error) tuple for each record, in order, once its batch is stored.
+        ``error`` is None for imported records, and an error message otherwise.
+
+        Example::
+
+            for record_index, error in user_manager.import_users(records, workers=4):
+                if error:
+                    print('Record %d: %s' % (record_index, error))
+        """
+        executor = None
+        if workers and workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(workers)
+
+        try:
+            indexed_user_records = enumerate(user_records)
+            while True:
+                batch = list(itertools.islice(indexed_user_records, batch_size))
+                if not batch:
+                    break
+                for result in self._import_user_batch(batch, executor):
+                    yield result
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _import_user_batch(self, batch, executor):
+        # Store a batch of (record_index, user_record) tuples.
+        # Yields a (record_index, error) tuple for each record.
+        errors = {}
+
+        # Check the records
+        valid_batch = []
+        for record_index, user_record in batch:
+            error = self._check_user_record(user_record)
+            if error:
+                errors[record_index] = error
+            else:
+                valid_batch.append((record_index, dict(user_record)))
+
+        # Hash the passwords
+        batch_with_passwords = [(record_index, user_record) for record_index, user_record in valid_batch
+                                if 'password' in user_record]
+        password_hashes = self.password_manager.hash_passwords(
+            [user_record['password'] for record_index, user_record in batch_with_passwords], executor)
+        for (record_index, user_record), password_hash in zip(batch_with_passwords, password_hashes):
+            if isinstance(password_hash, Exception):
+                errors[record_index] = 'Password could not be hashed: %s' % password_hash
+            else:
+                user_record['password'] = password_hash
+        valid_batch = [(record_index, user_record) for record_index, user_record in valid_batch
+                       if record_index not in errors]
+
+        # Assign IDs upfront, where the DbAdapter supports it,
+        # to find the users that a failed batch wrote anyway
+        new_user_ids = {}
+        for record_index, user_record in valid_batch:
+            if user_record.get('id') is None:
+                user_id = self.db_manager.db_adapter.new_object_id(self.db_manager.UserClass)
+                if user_id is not None:
+                    user_record['id'] = new_user_ids[record_index] = user_id
+
+        # Store the batch, or else store the records one at a time
+        try:
+            self.db_manager.add_users([user_record for record_index, user_record in valid_batch])
+            self.db_manager.commit()
+        except Exception:
+            self.db_manager.rollback()
+            for record_index, user_record in valid_batch:
+                # Object-based ODMs can not roll back the writes of the failed batch
+                if record_index in new_user_ids and \
+                        self.db_manager.db_adapter.get_object(self.db_manager.UserClass, new_user_ids[record_index]):
+                    continue
+                try:
+                    self.db_manager.add_users([user_record])
+                    self.db_manager.commit()
+                except Exception as e:
+                    self.db_manager.rollback()
+                    errors[record_index] = str(e)
+
+        for record_index, user_record in batch:
+            yield (record_index, errors.get(record_index))
+
+    def _check_user_record(self, user_record):
+        # Returns an error message if user_record can not be imported. Returns None otherwise.
+        if not isinstance(user_record, dict):
+            return 'User record must be a dict.'
+        UserEmailClass = self.db_manager.UserEmailClass
+        for key in user_record:
+            if key in ('password', 'roles'):
+                continue
+            if hasattr(self.db_manager.UserClass, key):
+                continue
+            if UserEmailClass and key in ('email', 'email_confirmed_at'):
+                continue
+            return "Unknown User property '%s'." % key
+        return None
+
+    def logout_user_everywhere(self, user):
+        """Invalidate all user session tokens of ``user``, signing them out on all devices.
+
+        Requires a ``session_version`` field on the User data-model.
+        Raises ConfigError otherwise.
+
+        With USER_USER_CACHE_SIZE and without a read replica, other processes may keep serving
+        the cached user, and its user sessions, for up to USER_USER_CACHE_TTL seconds.
+
+        Example::
+
+            user_manager.logout_user_everywhere(current_user)
+        """
+        if not hasattr(user, 'session_version'):
+            raise ConfigError('logout_user_everywhere() requires a session_version field on the User data-model.')
+        self.db_manager.bump_session_version(user)
+        self.db_manager.save_object(user)
+        self.db_manager.commit()
+
     def make_safe_url(self, url):
         """Makes a URL safe by removing optional hostname and port.
 
@@ -85,3 +266,13 @@ class UserManager__Utils(object):
     def verify_token(self, token, expiration_in_seconds=None):
         """Convenience method that calls self.token_manager.verify_token(token, expiration_in_seconds)."""
         return self.token_manager.verify_token(token, expiration_in_seconds)
+
+
+def _export_value(value):
+    # Convert dates and datetimes to ISO 8601 strings,
+    # and other values that JSON can not serialize (like ObjectIds) to strings
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, (bool, int, float, type(u''))):
+        return value
+    return str(value)
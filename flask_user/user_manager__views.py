@@ -10,10 +10,10 @@ try:
 except ImportError:
     from urllib import quote, unquote          # Python 2
 
-from flask import current_app, flash, redirect, render_template, request, url_for
+from flask import current_app, flash, redirect, render_template, request, session, url_for
 from flask_login import current_user, login_user, logout_user
 
-from .decorators import login_required
+from .decorators import login_required, AUTH_CLAIMS_SESSION_KEY
 from . import signals
 from .translation_utils import gettext as _    # map _() to gettext()
 
@@ -101,8 +101,9 @@ class UserManager__Views(object):
             new_password = form.new_password.data
             password_hash = self.hash_password(new_password)
 
-            # Update user.password
+            # Update user.password and invalidate existing user sessions
             current_user.password = password_hash
+            self.db_manager.bump_session_version(current_user)
             self.db_manager.save_object(current_user)
             self.db_manager.commit()
 
@@ -384,13 +385,13 @@ class UserManager__Views(object):
             # Retrieve User
             user = None
             user_email = None
-            if self.USER_ENABLE_USERNAME:
+            if self.USER_ENABLE_USERNAME and self.USER_ENABLE_EMAIL:
+                # Find user record by username or by email (with form.username)
+                user, user_email, matched_field_name = \
+                    self.db_manager.find_user_by_username_or_email(login_form.username.data)
+            elif self.USER_ENABLE_USERNAME:
                 # Find user record by username
                 user = self.db_manager.find_user_by_username(login_form.username.data)
-
-                # Find user record by email (with form.username)
-                if not user and self.USER_ENABLE_EMAIL:
-                    user, user_email = self.db_manager.get_user_and_user_email_by_email(login_form.username.data)
             else:
                 # Find user by email (with form.email)
                 user, user_email = self.db_manager.get_user_and_user_email_by_email(login_form.email.data)
@@ -418,6 +419,9 @@ class UserManager__Views(object):
         # Use Flask-Login to sign out user
         logout_user()
 
+        # Discard signed auth claims
+        session.pop(AUTH_CLAIMS_SESSION_KEY, None)
+
         # Flash a system message
         flash(_('You have signed out successfully.'), 'success')
 
@@ -584,6 +588,7 @@ class UserManager__Views(object):
             # Change password
             password_hash = self.hash_password(form.new_password.data)
             user.password=password_hash
+            self.db_manager.bump_session_version(user)
             self.db_manager.save_object(user)
             self.db_manager.commit()
 
@@ -2,7 +2,9 @@
 This Mixin adds required methods to User data-model.
 """
 
-from flask import current_app
+import time
+
+from flask import current_app, g, request
 from flask_login import UserMixin as FlaskLoginUserMixin
 
 class UserMixin(FlaskLoginUserMixin):
@@ -14,20 +16,36 @@ class UserMixin(FlaskLoginUserMixin):
     """
 
     def get_id(self):
-        """Converts a User ID and parts of a User password hash to a token."""
+        """Converts a User ID and a User session version (or parts of a User password hash) to a token."""
 
         # This function is used by Flask-Login to store a User ID securely as a browser cookie.
-        # The last part of the password is included to invalidate tokens when password change.
-        # user_id and password_ends_with are encrypted, timestamped and signed.
+        # The session version, or the last part of the password if the User data-model has
+        # no ``session_version`` field, is included to invalidate tokens when passwords change.
+        # user_id and session_version/password_ends_with are encrypted, timestamped and signed.
         # This function works in tandem with UserMixin.get_user_by_token()
         user_manager = current_app.user_manager
 
         user_id = self.id
-        password_ends_with = '' if user_manager.USER_ENABLE_AUTH0 else self.password[-8:]
+        session_version = getattr(self, 'session_version', None)
+        if session_version is None:
+            session_version = '' if user_manager.USER_ENABLE_AUTH0 else self.password[-8:]
+
+        # Reuse the token issued by a previous call, unless the user ID or session version changed,
+        # or unless the token is older than half the user session expiration.
+        current_time = time.time()
+        max_token_age = user_manager.USER_USER_SESSION_EXPIRATION / 2
+        cached_token = getattr(self, '_flask_user_cached_token', None)
+        if cached_token:
+            cached_user_id, cached_session_version, issued_at, user_token = cached_token
+            if cached_user_id == user_id and cached_session_version == session_version \
+                    and (not max_token_age or current_time - issued_at < max_token_age):
+                return user_token
+
         user_token = user_manager.generate_token(
             user_id,               # User ID
-            password_ends_with,    # Last 8 characters of user password
+            session_version,       # Session version or last 8 characters of user password
         )
+        self._flask_user_cached_token = (user_id, session_version, current_time, user_token)
         # print("UserMixin.get_id: ID:", self.id, "token:", user_token)
         return user_token
 
@@ -35,26 +53,22 @@ class UserMixin(FlaskLoginUserMixin):
     def get_user_by_token(cls, token, expiration_in_seconds=None):
         # This function works in tandem with UserMixin.get_id()
         # Token signatures and timestamps are verified.
-        # user_id and password_ends_with are decrypted.
+        # user_id and session_version/password_ends_with are decrypted.
 
-        # Verifies a token and decrypts a User ID and parts of a User password hash
+        # Verifies a token and decrypts a User ID and a session version or parts of a User password hash
         user_manager = current_app.user_manager
-        data_items = user_manager.verify_token(token, expiration_in_seconds)
-
-        # Verify password_ends_with
-        token_is_valid = False
-        if data_items:
+        data_items = verify_user_token(token, expiration_in_seconds)
+        if not data_items:
+            return None
 
-            # Load user by User ID
-            user_id = data_items[0]
-            password_ends_with = data_items[1]
-            user = user_manager.db_manager.get_user_by_id(user_id)
-            user_password = '' if user_manager.USER_ENABLE_AUTH0 else user.password[-8:]
+        # Load user by User ID
+        user_id = data_items[0]
+        session_version = data_items[1]
+        # Read the user from the primary database, so that ended user sessions end without replica lag
+        user = user_manager.db_manager.get_user_by_id(user_id, read_primary=True)
 
-            # Make sure that last 8 characters of user password matches
-            token_is_valid = user and user_password==password_ends_with
-
-        return user if token_is_valid else None
+        # Verify session_version or password_ends_with
+        return user if user and match_session_version(user, session_version) else None
 
     def has_roles(self, *requirements):
         """ Return True if the user has all of the specified roles. Return False otherwise.
@@ -74,30 +88,80 @@ class UserMixin(FlaskLoginUserMixin):
             Translates to:
                 User has role 'a' AND (role 'b' OR role 'c') AND role 'd'"""
 
-        # Translates a list of role objects to a list of role_names
+        # Retrieves the set of role_names, cached for the duration of the request
         user_manager = current_app.user_manager
-        role_names = user_manager.db_manager.get_user_roles(self)
-
-        # has_role() accepts a list of requirements
-        for requirement in requirements:
-            if isinstance(requirement, (list, tuple)):
-                # this is a tuple_of_role_names requirement
-                tuple_of_role_names = requirement
-                authorized = False
-                for role_name in tuple_of_role_names:
-                    if role_name in role_names:
-                        # tuple_of_role_names requirement was met: break out of loop
-                        authorized = True
-                        break
-                if not authorized:
-                    return False                    # tuple_of_role_names requirement failed: return False
-            else:
-                # this is a role_name requirement
-                role_name = requirement
-                # the user must have this role
-                if not role_name in role_names:
-                    return False                    # role_name requirement failed: return False
-
-        # All requirements have been met: return True
-        return True
+        role_names = user_manager.db_manager.get_user_role_set(self)
+
+        return match_role_requirements(role_names, compile_role_requirements(*requirements))
+
+
+def verify_user_token(token, expiration_in_seconds=None):
+    """| Returns the (user_id, session_version) data items of a valid user token.
+    | Returns None otherwise.
+
+    Tokens without an expiration limit (user session tokens) may be served
+    from the verified token cache, to skip signature checks and decryption.
+    Verifying a token is CPU-bound: it is shared by the sync and async user lookups.
+    """
+    user_manager = current_app.user_manager
+    token_cache = user_manager.token_cache if expiration_in_seconds is None else None
+    data_items = token_cache.get(token) if token_cache is not None else None
+    if data_items and user_manager.token_manager.is_token_revoked(token):
+        data_items = None   # Token was revoked by another worker process
+    elif not data_items:
+        data_items = user_manager.verify_token(token, expiration_in_seconds)
+        if data_items and token_cache is not None:
+            token_cache.set(token, data_items)
+    return data_items or None
+
+
+def match_session_version(user, session_version):
+    """| Returns True if the ``session_version`` of a user token matches the session version of ``user``
+        (or the last 8 characters of the user password, without a ``session_version`` field).
+    | Returns False otherwise.
+    """
+    user_manager = current_app.user_manager
+    user_session_version = getattr(user, 'session_version', None)
+    if user_session_version is None:
+        user_session_version = '' if user_manager.USER_ENABLE_AUTH0 else user.password[-8:]
+    return user_session_version==session_version
+
+
+def compile_role_requirements(*requirements):
+    """ Compile has_roles() requirements into a tuple of frozensets of role_names.
+
+    A role_name requirement compiles to a frozenset with one role_name.
+    A tuple_of_role_names requirement compiles to a frozenset of these role_names.
+    The decorators compile their requirements once, when views are decorated.
+    """
+    return tuple(
+        frozenset(requirement) if isinstance(requirement, (list, tuple)) else frozenset((requirement,))
+        for requirement in requirements)
+
+
+def match_role_requirements(role_names, compiled_requirements):
+    """| Returns True if the set of ``role_names`` meets all ``compiled_requirements``.
+    | Returns False otherwise.
+
+    Each requirement is met when ``role_names`` contains ONE of its role_names.
+    """
+    for requirement in compiled_requirements:
+        if role_names.isdisjoint(requirement):
+            return False                    # requirement failed: return False
+
+    # All requirements have been met: return True
+    return True
+
+
+def _get_preloaded_user(user_token):
+    # Returns a (user,) tuple if async_support.load_current_user_async() loaded the user of user_token
+    # in this request, with user None for invalid tokens. Returns None otherwise.
+    # flask.g may outlive a request: the user is tagged with the request that it belongs to.
+    preloaded_request, preloaded_user_token, user = getattr(g, '_flask_user_preloaded_user', None) or (None, None, None)
+    if preloaded_request is not request._get_current_object() or preloaded_user_token != user_token:
+        return None
+    return (user,)
+
 
+def _set_preloaded_user(user_token, user):
+    g._flask_user_preloaded_user = (request._get_current_object(), user_token, user)